@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Drive the Linux and Windows generators against the local FakeSession and report
+# wall time, API calls, peak memory and YAML bytes per phase, for each fleet size.
+#
+#   benchmarks/benchgenerator.py --instances 10 1000 50000 --metrics 1 10 50
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+CONST_HELPER_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sceptre', 'helper-scripts')
+sys.path.insert(0, os.path.abspath(CONST_HELPER_SCRIPTS_DIR))
+
+import yaml
+
+from fakeaws import FakeFleet, FakeSession
+from fleetgenerator import FleetGenerator
+from generatorclasses import CONST_GENERATOR_CLASSES
+
+CONST_MODES = ['serial', 'fleet', 'bulk', 'async', 'pipeline']
+CONST_ALARM_ACTION = 'arn:aws:sns:ap-southeast-2:123456789012:benchmark'
+
+class PhaseRecorder:
+  def __init__(self, session, trace_memory=True) -> None:
+      self.session = session
+      self.trace_memory = trace_memory
+      self.phases = {}
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    result = self.phases.setdefault(name, {'seconds': 0.0, 'api_calls': {}, 'peak_bytes': 0, 'yaml_bytes': 0})
+    self.session.reset_calls()
+    if self.trace_memory:
+      tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+      yield result
+    finally:
+      result['seconds'] += time.perf_counter() - start
+      if self.trace_memory:
+        result['peak_bytes'] = max(result['peak_bytes'], tracemalloc.get_traced_memory()[1])
+      for api_name, count in self.session.reset_calls().items():
+        result['api_calls'][api_name] = result['api_calls'].get(api_name, 0) + count
+
+# One generator per instance in a loop, the way deploy-cwalarm.sh runs them. The account and the
+# Name tag are looked up lazily, they are read while constructing to keep their calls out of render.
+def run_serial(generator_class, fleet, session, recorder):
+  for instance_id in fleet.instance_ids:
+    with recorder.phase('construct'):
+      config_generator = generator_class('InstanceId', instance_id, os.devnull,
+                          CONST_ALARM_ACTION, CONST_ALARM_ACTION, '', '',
+                          'true', 'benchmark', '',
+                          session=session)
+      config_generator.aws_account_id
+      config_generator.instance_tag_name
+    with recorder.phase('discovery'):
+      metrics = list(config_generator.get_metrics())
+    with recorder.phase('render'):
+      parsed_data = config_generator.get_alarm_list(metrics)
+    with recorder.phase('serialize') as result:
+      result['yaml_bytes'] += len(yaml.dump(parsed_data).encode('utf-8'))
+
+def run_fleet(generator_class, fleet, session, recorder, workers, bulk_discovery, engine, render_processes=0):
+  with tempfile.TemporaryDirectory() as output_dir:
+    with recorder.phase('fleet') as result:
+      fleet_generator = FleetGenerator(generator_class, 'InstanceId', fleet.instance_ids, output_dir,
+                          CONST_ALARM_ACTION, CONST_ALARM_ACTION, '', '',
+                          'true', 'benchmark', '',
+                          workers, bulk_discovery,
+                          session=session,
+                          engine=engine,
+                          render_processes=render_processes)
+      with contextlib.redirect_stdout(io.StringIO()):
+        outputs, errors = fleet_generator.generate()
+      result['failed'] = result.get('failed', 0) + len(errors)
+      result['yaml_bytes'] += sum(os.path.getsize(output_file) for output_file in outputs.values())
+
+def run_case(platform, mode, instance_count, metrics_per_instance, workers, trace_memory, max_tps, latency,
+              render_processes):
+  fleet = FakeFleet(instance_count, metrics_per_instance, platform)
+  session = FakeSession(fleet, max_tps, latency)
+  recorder = PhaseRecorder(session, trace_memory)
+  generator_class = CONST_GENERATOR_CLASSES[platform]
+  start = time.perf_counter()
+  if mode == 'serial':
+    run_serial(generator_class, fleet, session, recorder)
+  else:
+    run_fleet(generator_class, fleet, session, recorder, workers, mode in ['bulk', 'pipeline'],
+      'async' if mode == 'async' else 'threads', render_processes if mode == 'pipeline' else 0)
+  return({
+    'platform': platform,
+    'mode': mode,
+    'instances': instance_count,
+    'metrics_per_instance': metrics_per_instance,
+    'seconds': time.perf_counter() - start,
+    'throttled_calls': session.throttled_calls,
+    'phases': recorder.phases
+  })
+
+def print_case(case):
+  print("{0} {1} instances={2} metrics={3} total={4:.3f}s".format(
+      case['platform'], case['mode'], case['instances'], case['metrics_per_instance'], case['seconds']))
+  if len(case['throttled_calls']) > 0:
+    print("  throttled: {0}".format(' '.join("{0}={1}".format(api_name, count) for api_name, count in sorted(case['throttled_calls'].items()))))
+  for name, result in case['phases'].items():
+    api_calls = ' '.join("{0}={1}".format(api_name, count) for api_name, count in sorted(result['api_calls'].items()))
+    print("  {0:<10} {1:9.3f}s  peak={2:>11,}B  yaml={3:>13,}B  {4}{5}".format(
+        name, result['seconds'], result['peak_bytes'], result['yaml_bytes'], api_calls,
+        "  FAILED={0}".format(result['failed']) if result.get('failed') else ''))
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Benchmark the alarm config generators against a local AWS stand-in")
+  parser.add_argument('--instances', dest='instances', type=int, nargs='+', default=[10, 100],
+                    help='The fleet sizes to run')
+  parser.add_argument('--metrics', dest='metrics', type=int, nargs='+', default=[5, 20],
+                    help='The number of metrics published per instance')
+  parser.add_argument('--platform', dest='platforms', nargs='+', default=['linux', 'windows'],
+                    choices=list(CONST_GENERATOR_CLASSES), help='The generators to run')
+  parser.add_argument('--mode', dest='modes', nargs='+', default=CONST_MODES, choices=CONST_MODES,
+                    help='serial: one generator per instance, fleet: FleetGenerator, bulk: FleetGenerator with bulk discovery, '
+                    'async: FleetGenerator with the async discovery engine, '
+                    'pipeline: FleetGenerator with bulk discovery and render processes')
+  parser.add_argument('--workers', dest='workers', type=int, default=16,
+                    help='The worker threads for the fleet modes')
+  parser.add_argument('--render-processes', dest='render_processes', type=int, default=os.cpu_count(),
+                    help='The render processes for the pipeline mode')
+  parser.add_argument('--max-tps', dest='max_tps', type=int,
+                    help='Throttle every fake API above this many calls per second')
+  parser.add_argument('--latency', dest='latency', type=float, default=0.0,
+                    help='Seconds of simulated latency added to every fake API call')
+  parser.add_argument('--no-memory', dest='trace_memory', action='store_false',
+                    help='Do not trace peak memory, tracemalloc slows every phase down')
+  parser.add_argument('--json', dest='json_file', help='Also write the results to this JSON file')
+
+  args = parser.parse_args()
+  if args.trace_memory:
+    tracemalloc.start()
+  cases = []
+  for platform in args.platforms:
+    for mode in args.modes:
+      for instance_count in args.instances:
+        for metrics_per_instance in args.metrics:
+          case = run_case(platform, mode, instance_count, metrics_per_instance, args.workers, args.trace_memory,
+                    args.max_tps, args.latency, args.render_processes)
+          print_case(case)
+          cases.append(case)
+  if args.json_file:
+    with open(args.json_file, 'w') as file:
+      json.dump(cases, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the STS, EC2 and CloudWatch calls made by the generators.
+# FakeSession can be injected wherever a boto3 session is accepted.
+
+import copy
+import threading
+import time
+
+CONST_FAKE_ACCOUNT_ID = '123456789012'
+CONST_FAKE_REGION = 'ap-southeast-2'
+CONST_LIST_METRICS_PAGE_SIZE = 500
+CONST_DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+CONST_DESCRIBE_ALARMS_PAGE_SIZE = 100
+# describe_alarms returns these put_metric_alarm parameters as numbers of these types.
+CONST_ALARM_NUMBER_TYPES = {'Threshold': float, 'Period': int, 'EvaluationPeriods': int, 'DatapointsToAlarm': int}
+CONST_LINUX_BASE_METRICS = [
+  ('AWS/EC2', 'CPUUtilization'),
+  ('AWS/EC2', 'StatusCheckFailed'),
+  ('AWS/EC2', 'StatusCheckFailed_Instance'),
+  ('AWS/EC2', 'StatusCheckFailed_System'),
+  ('AWS/EC2', 'CPUCreditBalance'),
+  ('CWAgent', 'mem_used_percent')
+]
+CONST_WINDOWS_BASE_METRICS = [
+  ('AWS/EC2', 'CPUUtilization'),
+  ('AWS/EC2', 'StatusCheckFailed'),
+  ('AWS/EC2', 'StatusCheckFailed_Instance'),
+  ('AWS/EC2', 'StatusCheckFailed_System'),
+  ('AWS/EC2', 'CPUCreditBalance'),
+  ('CWAgent', 'Memory % Committed Bytes In Use')
+]
+
+# Synthetic fleet: instance i-<n> publishes metrics_per_instance metrics, the base
+# metrics first and then one disk metric per mounted path or drive.
+class FakeFleet:
+  def __init__(self, instance_count, metrics_per_instance, platform='linux') -> None:
+      self.platform = platform
+      self.instance_ids = ["i-{0:017x}".format(ii) for ii in range(instance_count)]
+      self.metrics = {}
+      self.metrics_by_namespace = {}
+      for instance_id in self.instance_ids:
+        for metric in self.get_instance_metrics(instance_id, metrics_per_instance):
+          self.metrics.setdefault((metric['Namespace'], instance_id), []).append(metric)
+          self.metrics_by_namespace.setdefault(metric['Namespace'], []).append(metric)
+
+  def get_instance_metrics(self, instance_id, metrics_per_instance):
+    base_metrics = CONST_WINDOWS_BASE_METRICS if self.platform == 'windows' else CONST_LINUX_BASE_METRICS
+    metrics = []
+    for namespace, metric_name in base_metrics[:metrics_per_instance]:
+      metrics.append({
+        'Namespace': namespace,
+        'MetricName': metric_name,
+        'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]
+      })
+    for ii in range(metrics_per_instance - len(metrics)):
+      if self.platform == 'windows':
+        dimensions = [
+          {'Name': 'InstanceId', 'Value': instance_id},
+          {'Name': 'instance', 'Value': "D{0:02d}:".format(ii)},
+          {'Name': 'objectname', 'Value': 'LogicalDisk'}
+        ]
+        metric_name = 'LogicalDisk % Free Space'
+      else:
+        dimensions = [
+          {'Name': 'InstanceId', 'Value': instance_id},
+          {'Name': 'path', 'Value': '/' if ii == 0 else "/mnt/data{0:02d}".format(ii)},
+          {'Name': 'device', 'Value': "nvme{0}n1".format(ii)},
+          {'Name': 'fstype', 'Value': 'xfs'}
+        ]
+        metric_name = 'disk_used_percent'
+      metrics.append({'Namespace': 'CWAgent', 'MetricName': metric_name, 'Dimensions': dimensions})
+    return(metrics)
+
+class FakeThrottlingError(Exception):
+  def __init__(self, api_name) -> None:
+      super().__init__("Rate exceeded for {0}".format(api_name))
+      self.response = {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}
+
+class FakePaginator:
+  def __init__(self, operation) -> None:
+      self.operation = operation
+
+  def paginate(self, **kwargs):
+    next_token = None
+    while True:
+      if next_token is not None:
+        kwargs['NextToken'] = next_token
+      page = self.operation(**kwargs)
+      yield page
+      next_token = page.get('NextToken')
+      if next_token is None:
+        break
+
+class FakeClient:
+  def __init__(self, session, service_name) -> None:
+      self.session = session
+      self.fleet = session.fleet
+      self.service_name = service_name
+
+  def get_paginator(self, operation_name):
+    return(FakePaginator(getattr(self, operation_name)))
+
+  def get_caller_identity(self):
+    self.session.record_call('sts.GetCallerIdentity')
+    return({'Account': CONST_FAKE_ACCOUNT_ID, 'Arn': "arn:aws:iam::{0}:user/benchmark".format(CONST_FAKE_ACCOUNT_ID)})
+
+  def describe_tags(self, DryRun=False, Filters=None, MaxResults=None, NextToken=None):
+    self.session.record_call('ec2.DescribeTags')
+    resource_ids = []
+    for tag_filter in Filters or []:
+      if tag_filter['Name'] == 'resource-id':
+        resource_ids = tag_filter['Values']
+    tags = [{'Key': 'Name', 'Value': "bench-{0}".format(resource_id), 'ResourceId': resource_id,
+              'ResourceType': 'instance'} for resource_id in resource_ids]
+    return({'Tags': tags})
+
+  def describe_instances(self, Filters=None, InstanceIds=None, NextToken=None, MaxResults=None):
+    self.session.record_call('ec2.DescribeInstances')
+    instance_ids = InstanceIds or self.fleet.instance_ids
+    start = int(NextToken or 0)
+    end = start + CONST_DESCRIBE_INSTANCES_PAGE_SIZE
+    instances = [{
+      'InstanceId': instance_id,
+      'InstanceType': 't3.medium',
+      'State': {'Name': 'running'},
+      'Platform': 'windows' if self.fleet.platform == 'windows' else None,
+      'Tags': [{'Key': 'Name', 'Value': "bench-{0}".format(instance_id)}]
+    } for instance_id in instance_ids[start:end]]
+    response = {'Reservations': [{'Instances': instances}]}
+    if end < len(instance_ids):
+      response['NextToken'] = str(end)
+    return(response)
+
+  def list_metrics(self, Namespace=None, MetricName=None, Dimensions=None, NextToken=None):
+    self.session.record_call('cloudwatch.ListMetrics')
+    dimension_value = None
+    for dimension in Dimensions or []:
+      dimension_value = dimension.get('Value')
+    if dimension_value is not None:
+      metrics = self.fleet.metrics.get((Namespace, dimension_value), [])
+    else:
+      metrics = self.fleet.metrics_by_namespace.get(Namespace, [])
+    start = int(NextToken or 0)
+    end = start + CONST_LIST_METRICS_PAGE_SIZE
+    # Real responses are fresh objects, callers may keep or mutate them.
+    response = {'Metrics': [dict(metric) for metric in metrics[start:end]]}
+    if end < len(metrics):
+      response['NextToken'] = str(end)
+    return(response)
+
+  # The alarms are kept in the session, see FakeSession.alarms.
+  def describe_alarms(self, AlarmNamePrefix='', AlarmTypes=None, NextToken=None, MaxRecords=None):
+    self.session.record_call('cloudwatch.DescribeAlarms')
+    alarm_names = sorted(alarm_name for alarm_name in self.session.alarms if alarm_name.startswith(AlarmNamePrefix))
+    start = int(NextToken or 0)
+    end = start + CONST_DESCRIBE_ALARMS_PAGE_SIZE
+    response = {'MetricAlarms': [copy.deepcopy(self.session.alarms[alarm_name]) for alarm_name in alarm_names[start:end]]}
+    if end < len(alarm_names):
+      response['NextToken'] = str(end)
+    return(response)
+
+  def put_metric_alarm(self, **kwargs):
+    self.session.record_call('cloudwatch.PutMetricAlarm')
+    alarm = copy.deepcopy(kwargs)
+    for field, number_type in CONST_ALARM_NUMBER_TYPES.items():
+      if field in alarm:
+        alarm[field] = number_type(alarm[field])
+    self.session.alarms[alarm['AlarmName']] = alarm
+    return({})
+
+  def delete_alarms(self, AlarmNames):
+    self.session.record_call('cloudwatch.DeleteAlarms')
+    if len(AlarmNames) > 100:
+      raise ValueError('delete_alarms accepts up to 100 alarm names')
+    for alarm_name in AlarmNames:
+      self.session.alarms.pop(alarm_name, None)
+    return({})
+
+class FakeCredentials:
+  access_key = 'AKIAFAKEBENCHMARK'
+
+# With max_tps, calls to an API beyond that many per second raise FakeThrottlingError
+# and simulated_latency adds that many seconds to every call.
+class FakeSession:
+  def __init__(self, fleet, max_tps=None, simulated_latency=0.0) -> None:
+      self.fleet = fleet
+      self.region_name = CONST_FAKE_REGION
+      self.api_calls = {}
+      self.throttled_calls = {}
+      self.max_tps = max_tps
+      self.simulated_latency = simulated_latency
+      self.windows = {}
+      # Alarm name -> the put_metric_alarm parameters, as describe_alarms returns them.
+      self.alarms = {}
+      self.lock = threading.Lock()
+
+  def client(self, service_name, **kwargs):
+    return(FakeClient(self, service_name))
+
+  def get_credentials(self):
+    return(FakeCredentials())
+
+  def record_call(self, api_name):
+    with self.lock:
+      self.api_calls[api_name] = self.api_calls.get(api_name, 0) + 1
+      throttled = False
+      if self.max_tps is not None:
+        second = int(time.monotonic())
+        window_second, window_calls = self.windows.get(api_name, (second, 0))
+        if window_second != second:
+          window_second, window_calls = second, 0
+        self.windows[api_name] = (window_second, window_calls + 1)
+        if window_calls + 1 > self.max_tps:
+          self.throttled_calls[api_name] = self.throttled_calls.get(api_name, 0) + 1
+          throttled = True
+    if self.simulated_latency > 0:
+      time.sleep(self.simulated_latency)
+    if throttled:
+      raise FakeThrottlingError(api_name)
+
+  def reset_calls(self):
+    with self.lock:
+      api_calls = self.api_calls
+      self.api_calls = {}
+    return(api_calls)
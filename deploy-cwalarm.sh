@@ -2,7 +2,7 @@
 
 set -eEu -o pipefail +x
 
-CWALARM_MANIFEST=""
+CWALARM_MANIFEST=()
 SNS_TOPIC_ARN=""
 SNS_TOPIC_CFN_NAME=""
 SNS_TOPIC_OUTPUT_NAME=""
@@ -13,6 +13,8 @@ AWS_ROLE_TO_ASSUME=FAODeployerRole
 PARAMS=""
 SCRIPT_ACTION=""
 CFN_CONFIG=""
+FORCE_DEPLOY=""
+DEPLOY_STATE_FILE="sceptre/generated-config/deploy-state.json"
 
 get_short_term_credentials() {
     AWS_ACCESS_KEY=$(grep -A6 "\[${SHORT_AWS_PROFILE}\]" ~/.aws/credentials | grep aws_access_key_id | awk '{print $NF}')
@@ -61,112 +63,49 @@ assume_role() {
     echo "Assumed AWS_ACCESS_KEY is $AWS_ACCESS_KEY"
 }
 
-get_aws_account_id() {
-  local account_id=$(aws sts get-caller-identity \
-    --query "Account" \
-    --output text)
-  echo "${account_id}"
-}
-
-get_aws_account_name() {
-  local aws_account_id=$(get_aws_account_id)
-  local account_name=$(cat accounts.json \
-    | jq --arg id "${aws_account_id}" -r '.Accounts[] | select(.Id==$id) | .Name' \
-    2>/dev/null || echo 'UNKNOWN_AWS_ACCOUNT')
-  echo "${account_name}"
-}
-
-get_instance_id() {
-  local instance_id=$(aws ec2 describe-instances \
-    --filters Name=tag:Name,Values="${INSTANCE_NAME}" \
-    Name=instance-state-name,Values=running \
-    --query Reservations[0].Instances[0].InstanceId --output text)
-  echo "${instance_id}"
-}
-
-get_sns_topic_arn() {
-  local topic_arn=""
-  if [ "${SNS_TOPIC_ARN}" != "" ]; then
-    topic_arn="${SNS_TOPIC_ARN}"
-  else
-    topic_arn=  $(aws cloudformation describe-stacks \
-      --stack-name "${SNS_TOPIC_CFN_NAME}" \
-      --query "Stacks[0].Outputs[?OutputKey=='${SNS_TOPIC_OUTPUT_NAME}'].OutputValue" \
-      --output text)
+# Create the virtualenv once, and install the requirements again only when they change
+prepare_virtualenv() {
+  local envdir=$1
+  local requirements_stamp="${envdir}/requirements.sha256"
+  if [ ! -d "${envdir}" ]; then
+    virtualenv -p /usr/bin/python3 "${envdir}"
+  fi
+  source "${envdir}/bin/activate"
+  if ! sha256sum --check --status "${requirements_stamp}" 2>/dev/null; then
+    pip install -r ./requirements.txt
+    sha256sum ./requirements.txt > "${requirements_stamp}"
   fi
-  echo "${topic_arn}"
-}
-
-get_platform() {
-  local instance_id=$1
-  local platform=$(aws ec2 describe-instances \
-    --instance-ids "${instance_id}" \
-    --query "Reservations[0].Instances[0].Platform" \
-    --output text 2>/dev/null || echo "none"
-  )
-  echo "${platform}"
 }
 
 launch() {
     local SCRIPT_ACTION=$1
 
-    local SOURCE_REPO_URL=$(git remote get-url origin | cut -d':' -f2)
-    local SOURCE_REPO_BRANCH=$(git branch| grep -e '^*' | awk '{print $2}')
-
-    local instance_id=$(get_instance_id)
-    local aws_account_name=$(get_aws_account_name)
-    local platform=$(get_platform "${instance_id}")
-    local sns_topic_arn=$(get_sns_topic_arn)
     local envdir=".venv"
-    local manifest_argument=()
-    local template_config_path=sceptre/helper-templates/cwalarm-config-template.yaml
-    local sceptre_item="cwalarm/$(echo ${INSTANCE_NAME} | sed 's/\W//g').yaml"
-    local sceptre_config_path="sceptre/config/${sceptre_item}"
-    local cwalarm_yaml="sceptre/generated-config/ec2instance.yaml"
-    local generate_script="cwalarmlinux.py"
-    echo "platform is [${platform}]"
-    if [ "${platform}" == "windows" ]; then
-      generate_script="cwalarmwindows.py"
-    fi
-
-    rm -f "${cwalarm_yaml}" "${sceptre_config_path}"
+    local driver_argument=()
 
-    if [ "${CWALARM_MANIFEST}" != "" ]; then
-      manifest_argument=("-m" "${CWALARM_MANIFEST}")
+    # Layered manifests, a later one overrides an earlier one
+    for manifest in ${CWALARM_MANIFEST[@]+"${CWALARM_MANIFEST[@]}"}; do
+      driver_argument+=("-m" "${manifest}")
+    done
+    if [ "${SNS_TOPIC_ARN}" != "" ]; then
+      driver_argument+=("--sns-topic-arn" "${SNS_TOPIC_ARN}")
+    else
+      driver_argument+=("--sns-topic-cfn-name" "${SNS_TOPIC_CFN_NAME}" "--sns-topic-output-name" "${SNS_TOPIC_OUTPUT_NAME}")
     fi
-    virtualenv -p /usr/bin/python3 "${envdir}"
-    source "${envdir}/bin/activate"
-    pip install -r ./requirements.txt
-
-    # Generate the YAML to be invoked by the sceptre config
-    sceptre/helper-scripts/"${generate_script}" \
-      -k InstanceId \
-      -v "${instance_id}" \
-      -i1 "${sns_topic_arn}" \
-      -x1 "${sns_topic_arn}" \
-      -a "${aws_account_name}" \
-      ${manifest_argument[@]} \
-      -o "${cwalarm_yaml}"
-
-    echo "cp '${template_config_path}' '${sceptre_config_path}'"
-    cp "${template_config_path}" "${sceptre_config_path}"
-    # Remove the old CloudFormation stack if exists
-    ./deploy-cfn-nodocker.sh \
-      -e aws_region=${AWS_DEFAULT_REGION} \
-      -n "destroy" \
-      -i "${sceptre_item}"
-
-    # Deploy the CloudFormation stack if required
-    if [ "${SCRIPT_ACTION}" != "destroy" ]; then
-      ./deploy-cfn-nodocker.sh \
-        -e aws_region=${AWS_DEFAULT_REGION} \
-        -n "${SCRIPT_ACTION}" \
-        -i "${sceptre_item}"
+    if [ "${FORCE_DEPLOY}" != "" ]; then
+      driver_argument+=("--force")
     fi
-
-    EXIT_STATUS=$?
+    prepare_virtualenv "${envdir}"
+
+    # Look up the instance, account and SNS topic, generate the alarms and deploy the
+    # CloudFormation stack, or reconcile the alarms without one, in one Python process
+    EXIT_STATUS=0
+    sceptre/helper-scripts/cwalarmdeploy.py \
+      -i "${INSTANCE_NAME}" \
+      -n "${SCRIPT_ACTION}" \
+      --state-file "${DEPLOY_STATE_FILE}" \
+      "${driver_argument[@]}" || EXIT_STATUS=$?
     deactivate
-    # rm -rf "${envdir}"
     exit ${EXIT_STATUS}
 
 }
@@ -205,13 +144,17 @@ parse_arguments() {
           shift 2
           ;;
         -m|--cwalarm-manifest)
-          CWALARM_MANIFEST=$2
+          CWALARM_MANIFEST+=("$2")
           shift 2
           ;;
         -n|--action)
           SCRIPT_ACTION=$2
           shift 2
           ;;
+        -f|--force)
+          FORCE_DEPLOY=1
+          shift
+          ;;
         --) # end argument parsing
           shift
           break
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from asyncdiscovery import CONST_DEFAULT_CALL_TIMEOUT, ThrottledCaller, parse_api_rate
+from cfntemplate import CONST_FORMAT_SCEPTRE, CONST_OUTPUT_FORMATS
+from clientpool import ClientPool, add_client_pool_arguments, get_client_settings
+from discoverycache import add_cache_arguments, get_cache
+from fleetgenerator import (CONST_DEFAULT_FLEET_OUTPUT_DIR, CONST_DEFAULT_FLEET_WORKERS, CONST_ENGINE_THREADS,
+                            CONST_FLEET_ENGINES, FleetGenerator, check_tag_filter, find_instances)
+from generatorclasses import CONST_GENERATOR_CLASSES
+
+CONST_DEFAULT_ROLE_NAME = 'FAODeployerRole'
+CONST_DEFAULT_SESSION_DURATION = 3600
+CONST_DEFAULT_PARALLELISM = 4
+CONST_ACCOUNT_PARAMETER = '/target/account/{0}'
+# deploy-cwalarm.sh assumes the role through this region.
+CONST_STS_REGION = 'us-west-1'
+
+# A botocore credential provider that always returns the same credentials, e.g. the
+# RefreshableCredentials of an assumed role.
+class FixedCredentialProvider:
+  METHOD = 'cwalarm-fixed'
+
+  def __init__(self, credentials) -> None:
+      self.credentials = credentials
+
+  def load(self):
+    return(self.credentials)
+
+# A botocore session that resolves to credentials, through the public credential resolver
+# instead of the private _credentials attribute of the session.
+def get_botocore_session(credentials):
+  import botocore.session
+  botocore_session = botocore.session.get_session()
+  credential_resolver = botocore_session.get_component('credential_provider')
+  credential_resolver.insert_before(credential_resolver.providers[0].METHOD, FixedCredentialProvider(credentials))
+  return(botocore_session)
+
+# Assumes the role once per account and keeps the credentials, botocore refreshes them
+# shortly before they expire. Every region of an account shares the same credentials.
+class RoleSessionProvider:
+  def __init__(self,
+                base_session=None,
+                role_name=CONST_DEFAULT_ROLE_NAME,
+                role_session_name=None,
+                duration_seconds=CONST_DEFAULT_SESSION_DURATION,
+                client_settings=None) -> None:
+      if base_session is None:
+        import boto3
+        base_session = boto3.session.Session()
+      self.base_session = base_session
+      # The botocore Config of the clients of every account and region, see ClientPool.
+      self.client_settings = client_settings
+      self.role_name = role_name
+      self.role_session_name = role_session_name
+      self.duration_seconds = duration_seconds
+      self.sts_client = None
+      self.credentials = {}
+      self.sessions = {}
+      self.lock = threading.Lock()
+
+  def get_sts_client(self):
+    if self.sts_client is None:
+      self.sts_client = self.base_session.client('sts', region_name=CONST_STS_REGION)
+    return(self.sts_client)
+
+  def get_role_session_name(self):
+    if self.role_session_name is None:
+      # The name of the caller, like deploy-cwalarm.sh, e.g. jane.doe for an SSO user.
+      arn = self.get_sts_client().get_caller_identity()['Arn']
+      self.role_session_name = arn.split('/')[-1][:64]
+    return(self.role_session_name)
+
+  def assume_role(self, account_id):
+    response = self.get_sts_client().assume_role(
+                  RoleArn="arn:aws:iam::{0}:role/{1}".format(account_id, self.role_name),
+                  RoleSessionName=self.role_session_name,
+                  DurationSeconds=self.duration_seconds)
+    credentials = response['Credentials']
+    return({
+      'access_key': credentials['AccessKeyId'],
+      'secret_key': credentials['SecretAccessKey'],
+      'token': credentials['SessionToken'],
+      'expiry_time': credentials['Expiration'].isoformat()
+    })
+
+  def get_credentials(self, account_id):
+    with self.lock:
+      if account_id not in self.credentials:
+        from botocore.credentials import RefreshableCredentials
+        self.get_role_session_name()
+        self.credentials[account_id] = RefreshableCredentials.create_from_metadata(
+                                          metadata=self.assume_role(account_id),
+                                          refresh_using=functools.partial(self.assume_role, account_id),
+                                          method='sts-assume-role')
+      return(self.credentials[account_id])
+
+  # Without an account ID, the base credentials in the given region.
+  def get_session(self, account_id, region_name):
+    credentials = self.get_credentials(account_id) if account_id else self.base_session.get_credentials()
+    with self.lock:
+      if (account_id, region_name) not in self.sessions:
+        import boto3
+        # A botocore session per region, the region is part of the botocore session config.
+        session = boto3.session.Session(botocore_session=get_botocore_session(credentials), region_name=region_name)
+        self.sessions[(account_id, region_name)] = ClientPool(session, self.client_settings)
+      return(self.sessions[(account_id, region_name)])
+
+# accounts.json, optionally with the Regions of every account.
+def load_accounts(accounts_file):
+  if not accounts_file or not os.path.exists(accounts_file):
+    return([])
+  with open(accounts_file, 'r') as file:
+    return([account for account in json.load(file).get('Accounts', []) if account.get('Status', 'ACTIVE') == 'ACTIVE'])
+
+# An account is given by ID or by name, a name missing from accounts.json is looked up
+# in the /target/account/<name> SSM parameter the way deploy-cwalarm.sh does.
+def resolve_account(account, accounts, session):
+  for item in accounts:
+    if account in [item['Id'], item.get('Name')]:
+      return(item)
+  if account.isdigit():
+    return({'Id': account, 'Name': account})
+  response = session.client('ssm').get_parameter(Name=CONST_ACCOUNT_PARAMETER.format(account))
+  return({'Id': response['Parameter']['Value'], 'Name': account})
+
+# Returns (account ID, account name, region) for every account/region pair to generate.
+def get_targets(account_names, regions, accounts_file, session):
+  accounts = load_accounts(accounts_file)
+  if len(account_names) > 0:
+    accounts = [resolve_account(account, accounts, session) for account in account_names]
+  if len(accounts) == 0:
+    # The account of the caller, without assuming a role.
+    accounts = [{'Id': '', 'Name': 'unknown account'}]
+  targets = []
+  for account in accounts:
+    for region in (regions or account.get('Regions') or [session.region_name]):
+      targets.append((account['Id'], account['Name'], region))
+  return(list(dict.fromkeys(targets)))
+
+# Every instance is generated by the generator of its platform, generator_classes maps the
+# platforms to generate to their classes, the instances of other platforms are skipped. The
+# instances are found by tag, so the alarms are always keyed by InstanceId.
+class AccountOrchestrator:
+  def __init__(self,
+                generator_classes,
+                targets,
+                session_provider,
+                output_dir,
+                in_alarm_warning,
+                ok_alarm_warning,
+                in_alarm_critical,
+                ok_alarm_critical,
+                use_recover='false',
+                manifest_yaml_file='',
+                tag_filters=None,
+                parallelism=CONST_DEFAULT_PARALLELISM,
+                max_workers=CONST_DEFAULT_FLEET_WORKERS,
+                bulk_discovery=False,
+                cache=None,
+                output_format=CONST_FORMAT_SCEPTRE,
+                engine=CONST_ENGINE_THREADS,
+                call_timeout=CONST_DEFAULT_CALL_TIMEOUT,
+                api_rates=None) -> None:
+      self.generator_classes = generator_classes
+      self.targets = targets
+      self.session_provider = session_provider
+      self.output_dir = output_dir
+      self.in_alarm_warning = in_alarm_warning
+      self.ok_alarm_warning = ok_alarm_warning
+      self.in_alarm_critical = in_alarm_critical
+      self.ok_alarm_critical = ok_alarm_critical
+      self.use_recover = use_recover
+      self.manifest_yaml_file = manifest_yaml_file
+      self.tag_filters = tag_filters or []
+      # The account/region pairs generated concurrently, each with up to max_workers threads.
+      self.parallelism = max(1, int(parallelism))
+      self.max_workers = max_workers
+      self.bulk_discovery = bulk_discovery
+      self.cache = cache
+      self.output_format = output_format
+      self.engine = engine
+      self.call_timeout = call_timeout
+      self.api_rates = api_rates or {}
+
+  def get_output_dir(self, account_name, region):
+    return(os.path.join(self.output_dir, account_name, region))
+
+  def generate_target(self, account_id, account_name, region):
+    session = self.session_provider.get_session(account_id, region)
+    instances = find_instances(self.tag_filters, session)
+    outputs = {}
+    errors = {}
+    for platform, generator_class in self.generator_classes.items():
+      values = [instance_id for instance_id, instance_attributes in instances.items()
+                  if instance_attributes['platform'] == platform]
+      if len(values) == 0:
+        continue
+      fleet_generator = FleetGenerator(
+                          generator_class,
+                          'InstanceId', values,
+                          self.get_output_dir(account_name, region),
+                          self.in_alarm_warning, self.ok_alarm_warning,
+                          self.in_alarm_critical, self.ok_alarm_critical,
+                          self.use_recover, account_name,
+                          self.manifest_yaml_file,
+                          self.max_workers,
+                          self.bulk_discovery,
+                          self.cache,
+                          self.output_format,
+                          session=session,
+                          engine=self.engine,
+                          caller=ThrottledCaller(max_concurrency=self.max_workers,
+                                  call_timeout=self.call_timeout,
+                                  api_rates=self.api_rates))
+      # The assumed role already tells the account, no get_caller_identity per account/region.
+      fleet_generator.aws_account_id = account_id
+      # Described already, selectors on tags or the instance type need no describe_instances.
+      fleet_generator.instance_attributes = {value: instances[value] for value in values}
+      platform_outputs, platform_errors = fleet_generator.generate()
+      outputs.update(platform_outputs)
+      errors.update(platform_errors)
+    return(outputs, errors)
+
+  # Returns (account name, region) -> (outputs, errors) and (account name, region) -> exception.
+  def generate(self):
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+      futures = {executor.submit(self.generate_target, *target): target for target in self.targets}
+      for future in as_completed(futures):
+        account_id, account_name, region = futures[future]
+        try:
+          results[(account_name, region)] = future.result()
+          outputs, target_errors = results[(account_name, region)]
+          print("{0} {1}: {2} generated, {3} failed".format(account_name, region, len(outputs), len(target_errors)))
+        except Exception as exc:
+          errors[(account_name, region)] = exc
+          print("failed to generate {0} {1}: {2}".format(account_name, region, exc))
+    return(results, errors)
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Generate the alarm configs of many accounts and regions concurrently")
+  parser.add_argument('--account', dest='accounts', action='append', default=[],
+                    help='The account ID or name to generate, names are resolved through accounts.json or the '
+                    '/target/account/<name> SSM parameter. Can be repeated, defaults to every account in the accounts file')
+  parser.add_argument('--region', dest='regions', action='append', default=[],
+                    help='The region to generate. Can be repeated, defaults to the Regions of the account or the current region')
+  parser.add_argument('--accounts-file', dest='accounts_file', default='accounts.json',
+                    help='The accounts file, see accounts.json.example')
+  parser.add_argument('--role-name', dest='role_name', default=CONST_DEFAULT_ROLE_NAME,
+                    help='The IAM role to assume in every account')
+  parser.add_argument('--role-session-name', dest='role_session_name',
+                    help='The role session name, defaults to the name of the caller')
+  parser.add_argument('--profile', dest='profile',
+                    help='The AWS profile of the credentials that assume the roles')
+  parser.add_argument('--parallelism', dest='parallelism', type=int, default=CONST_DEFAULT_PARALLELISM,
+                    help='The maximum number of account/region pairs generated concurrently')
+  parser.add_argument('--platform', dest='platforms', action='append', choices=list(CONST_GENERATOR_CLASSES),
+                    help='Only generate the instances of this platform. Can be repeated, defaults to every platform, '
+                    'each instance generated with the rules of its own')
+  parser.add_argument('-r', dest='userecover', default='false',
+                    help='Add the EC2 recover action to the status check alarms')
+  parser.add_argument('-i1', dest='in_alarm_warning', default='',
+                    help='The ARN for in alarm action for [WARNING]')
+  parser.add_argument('-x1', dest='ok_alarm_warning', default='',
+                    help='The ARN for OK action for [WARNING]')
+  parser.add_argument('-i2', dest='in_alarm_critical', default='',
+                    help='The ARN for in alarm action for [CRITICAL]')
+  parser.add_argument('-x2', dest='ok_alarm_critical', default='',
+                    help='The ARN for OK action for [CRITICAL]')
+  parser.add_argument('-m', dest='manifest', action='append',
+                    help='The path to manifest YAML. Can be repeated, a later manifest overrides an earlier one')
+  parser.add_argument('-f', '--format', dest='output_format', default=CONST_FORMAT_SCEPTRE, choices=CONST_OUTPUT_FORMATS,
+                    help='The output format, sceptre_user_data YAML or a CloudFormation template')
+  parser.add_argument('--tag-filter', dest='tag_filters', action='append', default=[], type=check_tag_filter,
+                    help='Select running instances by tag, Key=Value[,Value...]. Can be repeated, defaults to every running instance')
+  parser.add_argument('--output-dir', dest='output_dir', default=CONST_DEFAULT_FLEET_OUTPUT_DIR,
+                    help='The directory for the output files, one <account name>/<region> directory per pair')
+  parser.add_argument('--workers', dest='workers', type=int, default=CONST_DEFAULT_FLEET_WORKERS,
+                    help='The maximum number of instances discovered concurrently per account/region')
+  parser.add_argument('--bulk-discovery', dest='bulk_discovery', action='store_true',
+                    help='List metrics once per namespace for every account/region instead of once per instance')
+  parser.add_argument('--engine', dest='engine', default=CONST_ENGINE_THREADS, choices=CONST_FLEET_ENGINES,
+                    help='threads runs one discovery per instance, async rate limits every API and backs off on throttling')
+  parser.add_argument('--api-rate', dest='api_rates', action='append', default=[], type=parse_api_rate,
+                    help='Async engine: override the rate limit of an API per account/region, API=RATE[:BURST]. Can be repeated')
+  parser.add_argument('--call-timeout', dest='call_timeout', type=float, default=CONST_DEFAULT_CALL_TIMEOUT,
+                    help='Async engine: the connect and read timeout in seconds of every API call')
+  add_cache_arguments(parser)
+  add_client_pool_arguments(parser)
+
+  args = parser.parse_args()
+  # Imported after parsing, boto3 is slow to import and --help does not need it.
+  import boto3
+  base_session = boto3.session.Session(profile_name=args.profile)
+  # Every worker of a pair gets a pooled connection to each service.
+  session_provider = RoleSessionProvider(base_session, args.role_name, args.role_session_name,
+                      client_settings=get_client_settings(args, args.workers))
+  targets = get_targets(args.accounts, args.regions, args.accounts_file, base_session)
+  orchestrator = AccountOrchestrator(
+                    {platform: CONST_GENERATOR_CLASSES[platform] for platform in (args.platforms or CONST_GENERATOR_CLASSES)},
+                    targets,
+                    session_provider,
+                    args.output_dir,
+                    args.in_alarm_warning, args.ok_alarm_warning,
+                    args.in_alarm_critical, args.ok_alarm_critical,
+                    args.userecover,
+                    args.manifest,
+                    args.tag_filters,
+                    args.parallelism,
+                    args.workers,
+                    args.bulk_discovery,
+                    get_cache(args),
+                    args.output_format,
+                    args.engine,
+                    args.call_timeout,
+                    dict(args.api_rates))
+  results, errors = orchestrator.generate()
+  failed = len(errors) + sum(len(target_errors) for outputs, target_errors in results.values())
+  print("orchestration done: {0} account/region pairs, {1} failed".format(len(targets), failed))
+  sys.exit(0 if failed == 0 else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cfntemplate import CONST_FORMAT_SCEPTRE, CONST_OUTPUT_FORMATS
+from clientpool import CONST_DEFAULT_MAX_POOL_CONNECTIONS, ClientPool, ClientSettings, add_client_pool_arguments, \
+  get_client_pool
+from deploystate import add_state_arguments, get_deploy_state, get_state_key
+from fleetgenerator import CONST_DEFAULT_FLEET_OUTPUT_DIR, CONST_DEFAULT_FLEET_WORKERS, CONST_DESCRIBE_INSTANCES_BATCH, \
+  FleetGenerator, check_tag_filter, parse_tag_filter
+from generatorclasses import CONST_GENERATOR_CLASSES
+from manifestcompiler import get_instance_attributes
+
+CONST_STATE_CHANGE_EVENT = 'EC2 Instance State-change Notification'
+CONST_TAG_CHANGE_EVENT = 'Tag Change on Resource'
+# Not an AWS event: sent by whatever notices an instance publishing new CWAgent metrics.
+CONST_METRICS_CHANGE_EVENT = 'CWAlarm Metrics Change'
+CONST_REMOVED_STATES = ['shutting-down', 'terminated']
+CONST_DEFAULT_DEBOUNCE_SECONDS = 30.0
+# A host that keeps sending events is regenerated at least this many debounce periods apart.
+CONST_MAX_DEBOUNCE_PERIODS = 10
+# Put on the event queue by a reader at the end of its input.
+CONST_END_OF_EVENTS = None
+
+# What the daemon knows about one instance, from describe_instances and the events since.
+class InstanceRecord:
+  def __init__(self, instance_id) -> None:
+      self.instance_id = instance_id
+      self.state = None
+      self.tags = {}
+      self.platform = None
+      self.instance_type = ''
+
+  def get_tag_name(self):
+    return(self.tags.get('Name', ''))
+
+  # What manifest selectors match on.
+  def get_instance_attributes(self):
+    return({'platform': self.platform, 'instance_type': self.instance_type, 'tags': self.tags})
+
+# Turns an EventBridge event into (instance ID, changes), or None for an event about anything else.
+def parse_event(event):
+  detail_type = event.get('detail-type')
+  detail = event.get('detail', {})
+  if detail_type == CONST_STATE_CHANGE_EVENT:
+    return(detail['instance-id'], {'state': detail['state']})
+  if detail_type == CONST_TAG_CHANGE_EVENT and detail.get('resource-type') == 'instance':
+    # The detail carries every tag of the resource after the change, not only the changed ones.
+    return(event['resources'][0].split('/')[-1], {'tags': detail.get('tags', {})})
+  if detail_type == CONST_METRICS_CHANGE_EVENT:
+    return(detail['instance-id'], {})
+  return(None)
+
+# Collapses a burst of events about one key into one action, taken once the key has been
+# quiet for delay seconds, or max_delay seconds after its first event at the latest.
+class Debouncer:
+  def __init__(self, delay, max_delay) -> None:
+      self.delay = delay
+      self.max_delay = max_delay
+      self.first_seen = {}
+      self.due = {}
+
+  def touch(self, key, now):
+    first_seen = self.first_seen.setdefault(key, now)
+    self.due[key] = min(now + self.delay, first_seen + self.max_delay)
+
+  def get_timeout(self, now):
+    if len(self.due) == 0:
+      return(None)
+    return(max(0.0, min(self.due.values()) - now))
+
+  def pop_due(self, now=None):
+    keys = sorted(key for key, due in self.due.items() if now is None or due <= now)
+    for key in keys:
+      del self.due[key]
+      del self.first_seen[key]
+    return(keys)
+
+# Puts the JSON events of a JSON-lines stream on the queue, following a file as it grows.
+def read_events(stream, events, follow=False, poll_interval=1.0):
+  while True:
+    line = stream.readline()
+    if not line:
+      if not follow:
+        break
+      time.sleep(poll_interval)
+      continue
+    line = line.strip()
+    if line:
+      try:
+        events.put(json.loads(line))
+      except ValueError as exc:
+        print("skipping malformed event: {0}".format(exc))
+  events.put(CONST_END_OF_EVENTS)
+
+# Long-running mode around the generators. Keeps a model of the fleet, and regenerates or
+# removes the alarm config of only the instances an event is about.
+class AlarmDaemon:
+  def __init__(self,
+                events,
+                output_dir,
+                in_alarm_warning,
+                ok_alarm_warning,
+                in_alarm_critical,
+                ok_alarm_critical,
+                use_recover='false',
+                aws_account_name='unknown account',
+                manifest_yaml_file='',
+                tag_filters=None,
+                debounce_seconds=CONST_DEFAULT_DEBOUNCE_SECONDS,
+                max_workers=CONST_DEFAULT_FLEET_WORKERS,
+                output_format=CONST_FORMAT_SCEPTRE,
+                deploy_state=None,
+                skip_unchanged=False,
+                session=None) -> None:
+      # A queue.Queue of event dicts, fed by read_events or directly by the caller.
+      self.events = events
+      self.tag_filters = [parse_tag_filter(tag_filter) for tag_filter in (tag_filters or [])]
+      self.debouncer = Debouncer(debounce_seconds, debounce_seconds * CONST_MAX_DEBOUNCE_PERIODS)
+      self.max_workers = max_workers
+      self.deploy_state = deploy_state
+      # Shared with the generators of both platforms, every worker gets a pooled connection.
+      self.session = session if session is not None else \
+                      ClientPool(settings=ClientSettings(max(CONST_DEFAULT_MAX_POOL_CONNECTIONS, max_workers)))
+      self.instances = {}
+      # generate_one writes straight into the output directory, unlike FleetGenerator.generate.
+      os.makedirs(output_dir, exist_ok=True)
+      self.fleet_generators = {
+        platform: FleetGenerator(generator_class, 'InstanceId', [], output_dir,
+                    in_alarm_warning, ok_alarm_warning, in_alarm_critical, ok_alarm_critical,
+                    use_recover, aws_account_name, manifest_yaml_file, max_workers,
+                    output_format=output_format,
+                    session=self.session,
+                    deploy_state=deploy_state,
+                    skip_unchanged=skip_unchanged)
+        for platform, generator_class in CONST_GENERATOR_CLASSES.items()
+      }
+      self.aws_account_id = ''
+      self.regenerated = 0
+      self.removed = 0
+
+  def is_selected(self, record):
+    for tag_filter in self.tag_filters:
+      if record.tags.get(tag_filter['Name'][len('tag:'):]) not in tag_filter['Values']:
+        return(False)
+    return(True)
+
+  def add_instances(self, pages):
+    instance_ids = []
+    for page in pages:
+      for reservation in page['Reservations']:
+        for instance in reservation['Instances']:
+          record = self.instances.setdefault(instance['InstanceId'], InstanceRecord(instance['InstanceId']))
+          record.state = instance['State']['Name']
+          instance_attributes = get_instance_attributes(instance)
+          record.tags = instance_attributes['tags']
+          record.platform = instance_attributes['platform']
+          record.instance_type = instance_attributes['instance_type']
+          instance_ids.append(instance['InstanceId'])
+    return(instance_ids)
+
+  # One describe_instances per batch. An instance-id filter, unlike InstanceIds, does not
+  # fail the whole call on an instance that is already gone.
+  def describe_instances(self, instance_ids):
+    paginator = self.session.client('ec2').get_paginator('describe_instances')
+    found = set()
+    for ii in range(0, len(instance_ids), CONST_DESCRIBE_INSTANCES_BATCH):
+      batch = instance_ids[ii:ii + CONST_DESCRIBE_INSTANCES_BATCH]
+      found.update(self.add_instances(paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': batch}])))
+    for instance_id in instance_ids:
+      if instance_id not in found:
+        self.instances.setdefault(instance_id, InstanceRecord(instance_id)).state = 'terminated'
+
+  # Seed the model with the running instances, generating only those without an output file.
+  def bootstrap(self):
+    paginator = self.session.client('ec2').get_paginator('describe_instances')
+    filters = list(self.tag_filters) + [{'Name': 'instance-state-name', 'Values': ['running']}]
+    instance_ids = self.add_instances(paginator.paginate(Filters=filters))
+    missing = [instance_id for instance_id in instance_ids
+                if not os.path.exists(self.fleet_generators[self.instances[instance_id].platform].get_output_file(instance_id))]
+    self.update(missing)
+
+  def handle_event(self, event, now):
+    parsed_event = parse_event(event)
+    if parsed_event is None:
+      return
+    instance_id, changes = parsed_event
+    record = self.instances.setdefault(instance_id, InstanceRecord(instance_id))
+    if 'state' in changes:
+      record.state = changes['state']
+    if 'tags' in changes:
+      record.tags = changes['tags']
+    self.debouncer.touch(instance_id, now)
+
+  def remove(self, record):
+    output_files = [fleet_generator.get_output_file(record.instance_id) for fleet_generator in self.fleet_generators.values()]
+    output_files = [output_file for output_file in dict.fromkeys(output_files) if os.path.exists(output_file)]
+    if len(output_files) == 0:
+      return
+    for output_file in output_files:
+      os.remove(output_file)
+    if self.deploy_state is not None:
+      self.deploy_state.forget(get_state_key(self.aws_account_id, self.session, 'InstanceId', record.instance_id))
+    self.removed += 1
+    print("removed {0}".format(record.instance_id))
+
+  def regenerate(self, record):
+    return(self.fleet_generators[record.platform].generate_one(record.instance_id, record.get_tag_name(),
+            instance_attributes=record.get_instance_attributes()))
+
+  # The instances new to the model described, and the account looked up once.
+  def prepare(self, instance_ids):
+    unknown = [instance_id for instance_id in instance_ids
+                if self.instances[instance_id].platform is None and self.instances[instance_id].state not in CONST_REMOVED_STATES]
+    if len(unknown) > 0:
+      self.describe_instances(unknown)
+    if not self.aws_account_id:
+      self.aws_account_id = self.fleet_generators['linux'].get_aws_account_id()
+      for fleet_generator in self.fleet_generators.values():
+        fleet_generator.aws_account_id = self.aws_account_id
+
+  # Debounced again, a failed instance is retried once it has been quiet for another period.
+  def retry_later(self, instance_ids):
+    now = time.monotonic()
+    for instance_id in instance_ids:
+      self.debouncer.touch(instance_id, now)
+
+  # Regenerate or remove the given instances. A failure, e.g. a throttled describe_instances,
+  # is logged and the instances it concerns are retried later, it never stops the daemon.
+  def update(self, instance_ids):
+    if len(instance_ids) == 0:
+      return
+    try:
+      self.prepare(instance_ids)
+    except Exception as exc:
+      print("failed to describe {0} instances, retrying later: {1}".format(len(instance_ids), exc))
+      self.retry_later(instance_ids)
+      return
+    failed = []
+    to_regenerate = []
+    for instance_id in instance_ids:
+      record = self.instances[instance_id]
+      if record.state in CONST_REMOVED_STATES or not self.is_selected(record):
+        try:
+          self.remove(record)
+        except Exception as exc:
+          print("failed to remove {0}: {1}".format(instance_id, exc))
+          failed.append(instance_id)
+          continue
+        if record.state in CONST_REMOVED_STATES:
+          del self.instances[instance_id]
+      elif record.state == 'running':
+        to_regenerate.append(record)
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      for record, future in [(record, executor.submit(self.regenerate, record)) for record in to_regenerate]:
+        try:
+          output_file = future.result()
+          self.regenerated += 1
+          print("regenerated {0}".format(output_file if output_file is not None else "{0}, unchanged".format(record.instance_id)))
+        except Exception as exc:
+          print("failed to regenerate {0}: {1}".format(record.instance_id, exc))
+          failed.append(record.instance_id)
+    self.retry_later(failed)
+    if self.deploy_state is not None:
+      try:
+        self.deploy_state.save()
+      except Exception as exc:
+        # Kept in memory, saved again after the next update.
+        print("failed to save the deploy state: {0}".format(exc))
+
+  # Runs until a reader puts CONST_END_OF_EVENTS on the queue.
+  def run(self):
+    while True:
+      try:
+        event = self.events.get(timeout=self.debouncer.get_timeout(time.monotonic()))
+      except queue.Empty:
+        event = {}
+      if event is CONST_END_OF_EVENTS:
+        self.update(self.debouncer.pop_due())
+        if len(self.debouncer.due) > 0:
+          print("{0} instances failed and were not retried".format(len(self.debouncer.due)))
+        break
+      self.handle_event(event, time.monotonic())
+      self.update(self.debouncer.pop_due(time.monotonic()))
+    print("daemon done: {0} regenerated, {1} removed".format(self.regenerated, self.removed))
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Regenerate the alarm config of the instances EC2 events are about")
+  parser.add_argument('--events', dest='events', default='-',
+                    help='The JSON-lines file of EventBridge EC2 state-change and tag-change events, - for stdin')
+  parser.add_argument('--follow', dest='follow', action='store_true',
+                    help='Keep reading the events file as it grows, instead of stopping at its end')
+  parser.add_argument('--debounce', dest='debounce', type=float, default=CONST_DEFAULT_DEBOUNCE_SECONDS,
+                    help='Seconds an instance has to be quiet before it is regenerated')
+  parser.add_argument('--bootstrap', dest='bootstrap', action='store_true',
+                    help='Describe the running instances first and generate those without an output file')
+  parser.add_argument('-r', dest='userecover', default='false',
+                    help='Add the EC2 recover action to the status check alarms')
+  parser.add_argument('-i1', dest='in_alarm_warning', default='',
+                    help='The ARN for in alarm action for [WARNING]')
+  parser.add_argument('-x1', dest='ok_alarm_warning', default='',
+                    help='The ARN for OK action for [WARNING]')
+  parser.add_argument('-i2', dest='in_alarm_critical', default='',
+                    help='The ARN for in alarm action for [CRITICAL]')
+  parser.add_argument('-x2', dest='ok_alarm_critical', default='',
+                    help='The ARN for OK action for [CRITICAL]')
+  parser.add_argument('-a', dest='account_alias', default='unknown account',
+                    help='The AWS account name/alias')
+  parser.add_argument('-m', dest='manifest', action='append',
+                    help='The path to manifest YAML. Can be repeated, a later manifest overrides an earlier one')
+  parser.add_argument('-f', '--format', dest='output_format', default=CONST_FORMAT_SCEPTRE, choices=CONST_OUTPUT_FORMATS,
+                    help='The output format, sceptre_user_data YAML or a CloudFormation template')
+  parser.add_argument('--tag-filter', dest='tag_filters', action='append', default=[], type=check_tag_filter,
+                    help='Only keep alarm config for instances with this tag, Key=Value[,Value...]. Can be repeated')
+  parser.add_argument('--output-dir', dest='output_dir', default=CONST_DEFAULT_FLEET_OUTPUT_DIR,
+                    help='The directory for the per-instance output files')
+  parser.add_argument('--workers', dest='workers', type=int, default=CONST_DEFAULT_FLEET_WORKERS,
+                    help='The maximum number of instances regenerated concurrently')
+  add_state_arguments(parser)
+  add_client_pool_arguments(parser)
+
+  args = parser.parse_args()
+  events = queue.Queue()
+  alarm_daemon = AlarmDaemon(
+                    events,
+                    args.output_dir,
+                    args.in_alarm_warning, args.ok_alarm_warning,
+                    args.in_alarm_critical, args.ok_alarm_critical,
+                    args.userecover, args.account_alias,
+                    args.manifest,
+                    args.tag_filters,
+                    args.debounce,
+                    args.workers,
+                    args.output_format,
+                    get_deploy_state(args),
+                    args.skip_unchanged,
+                    get_client_pool(args, workers=args.workers))
+  if args.bootstrap:
+    alarm_daemon.bootstrap()
+  with contextlib.nullcontext(sys.stdin) if args.events == '-' else open(args.events, 'r') as stream:
+    reader = threading.Thread(target=read_events, args=(stream, events, args.follow), daemon=True)
+    reader.start()
+    alarm_daemon.run()
+
+if __name__ == "__main__":
+    main()
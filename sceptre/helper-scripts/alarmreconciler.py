@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+from cfntemplate import CONST_RECOVER_SUB, get_alarm_properties
+from clientpool import ClientPool
+from discoverycache import get_region_name
+from groupalarms import get_dimension_condition
+
+# delete_alarms accepts up to 100 alarm names per call.
+CONST_DELETE_ALARMS_BATCH = 100
+CONST_RECOVER_ARN = 'arn:aws:automate:{0}:ec2:recover'
+# The put_metric_alarm fields compared against describe_alarms.
+CONST_ALARM_FIELDS = ['AlarmDescription', 'ActionsEnabled', 'AlarmActions', 'OKActions', 'ComparisonOperator',
+                      'DatapointsToAlarm', 'EvaluationPeriods', 'Period', 'Threshold', 'MetricName', 'Namespace',
+                      'Statistic', 'Dimensions', 'Metrics']
+
+# The alarm names of the rules start with their severity, e.g. '[CRITICAL] '.
+def get_alarm_name_prefixes(alarm_rules):
+  return(sorted(set("[{0}] ".format(level_name) for rule in alarm_rules.values()
+                      for level, level_name, threshold_key in rule.severities)))
+
+# Map one alarm of ConfigGenerator.get_alarm_list to put_metric_alarm parameters,
+# resolving the recover action the CloudFormation template leaves to Fn::Sub.
+def get_alarm_request(alarm_data, region_name):
+  request = get_alarm_properties(alarm_data)
+  for actions_key in ['AlarmActions', 'OKActions']:
+    request[actions_key] = [CONST_RECOVER_ARN.format(region_name) if action == CONST_RECOVER_SUB else action
+                              for action in request[actions_key]]
+  return(request)
+
+# describe_alarms returns numbers as floats and dimensions in any order.
+def get_comparable_value(field, value):
+  if field == 'Dimensions':
+    return(sorted((dimension['Name'], dimension['Value']) for dimension in value or []))
+  if field in ['DatapointsToAlarm', 'EvaluationPeriods', 'Period', 'Threshold']:
+    return(float(value) if value is not None else None)
+  if field in ['AlarmActions', 'OKActions']:
+    return(sorted(value or []))
+  if field == 'Metrics':
+    return([(query.get('Id'), query.get('Expression'), float(query.get('Period', 0)), query.get('ReturnData', True))
+              for query in value or []])
+  return(value)
+
+def get_changed_fields(existing_alarm, request):
+  changed_fields = {}
+  for field in CONST_ALARM_FIELDS:
+    old_value = get_comparable_value(field, existing_alarm.get(field))
+    new_value = get_comparable_value(field, request.get(field))
+    if old_value != new_value:
+      changed_fields[field] = (existing_alarm.get(field), request.get(field))
+  return(changed_fields)
+
+class AlarmDiff:
+  def __init__(self) -> None:
+      self.created = []
+      self.updated = []
+      self.deleted = []
+      self.unchanged = []
+
+  def has_changes(self):
+    return(len(self.created) + len(self.updated) + len(self.deleted) > 0)
+
+  def print_report(self):
+    for request in self.created:
+      print("+ {0}".format(request['AlarmName']))
+    for request, changed_fields in self.updated:
+      print("~ {0}".format(request['AlarmName']))
+      for field, (old_value, new_value) in changed_fields.items():
+        print("    {0}: {1} -> {2}".format(field, old_value, new_value))
+    for alarm_name in self.deleted:
+      print("- {0}".format(alarm_name))
+    print("{0} to create, {1} to update, {2} to delete, {3} unchanged".format(
+        len(self.created), len(self.updated), len(self.deleted), len(self.unchanged)))
+
+# Applies the alarms of a generator straight through the CloudWatch API instead of a
+# CloudFormation stack. The existing alarms are those whose name starts with one of the
+# prefixes and whose dimensions include key=value, alarms of other instances are never touched.
+class AlarmReconciler:
+  def __init__(self,
+                key,
+                values,
+                alarm_name_prefixes,
+                session=None) -> None:
+      self.dimension_key = key
+      self.dimension_values = set(values)
+      self.alarm_name_prefixes = alarm_name_prefixes
+      self.session = session
+      self.region_name = get_region_name(session)
+
+  def get_client(self, service_name):
+    if self.session is None:
+      self.session = ClientPool()
+    return(self.session.client(service_name))
+
+  def is_managed_alarm(self, alarm):
+    for dimension in alarm.get('Dimensions', []):
+      if dimension['Name'] == self.dimension_key and dimension['Value'] in self.dimension_values:
+        return(True)
+    # The group alarms have a query instead of dimensions.
+    for query in alarm.get('Metrics', []):
+      for dimension_value in self.dimension_values:
+        if get_dimension_condition(self.dimension_key, dimension_value) in query.get('Expression', ''):
+          return(True)
+    return(False)
+
+  def get_existing_alarms(self, client):
+    existing_alarms = {}
+    paginator = client.get_paginator('describe_alarms')
+    for alarm_name_prefix in self.alarm_name_prefixes:
+      for page in paginator.paginate(AlarmNamePrefix=alarm_name_prefix, AlarmTypes=['MetricAlarm']):
+        for alarm in page['MetricAlarms']:
+          if self.is_managed_alarm(alarm):
+            existing_alarms[alarm['AlarmName']] = alarm
+    return(existing_alarms)
+
+  def diff(self, alarms, client=None):
+    client = client if client is not None else self.get_client('cloudwatch')
+    existing_alarms = self.get_existing_alarms(client)
+    alarm_diff = AlarmDiff()
+    requests = {}
+    for alarm_data in alarms:
+      request = get_alarm_request(alarm_data, self.region_name)
+      requests[request['AlarmName']] = request
+    for alarm_name, request in requests.items():
+      if alarm_name not in existing_alarms:
+        alarm_diff.created.append(request)
+        continue
+      changed_fields = get_changed_fields(existing_alarms[alarm_name], request)
+      if len(changed_fields) > 0:
+        alarm_diff.updated.append((request, changed_fields))
+      else:
+        alarm_diff.unchanged.append(alarm_name)
+    alarm_diff.deleted = sorted(alarm_name for alarm_name in existing_alarms if alarm_name not in requests)
+    return(alarm_diff)
+
+  def apply(self, alarm_diff, client=None):
+    client = client if client is not None else self.get_client('cloudwatch')
+    for request in alarm_diff.created + [request for request, changed_fields in alarm_diff.updated]:
+      client.put_metric_alarm(**request)
+    for ii in range(0, len(alarm_diff.deleted), CONST_DELETE_ALARMS_BATCH):
+      client.delete_alarms(AlarmNames=alarm_diff.deleted[ii:ii + CONST_DELETE_ALARMS_BATCH])
+
+  # Returns the AlarmDiff, applied unless dry_run.
+  def reconcile(self, alarms, dry_run=False):
+    client = self.get_client('cloudwatch')
+    alarm_diff = self.diff(alarms, client)
+    alarm_diff.print_report()
+    if not dry_run and alarm_diff.has_changes():
+      self.apply(alarm_diff, client)
+    return(alarm_diff)
+
+def add_reconcile_arguments(parser):
+  parser.add_argument('--reconcile', dest='reconcile', action='store_true',
+                    help='Apply the alarms with the CloudWatch API instead of writing the output, '
+                    'creating, updating and deleting only the alarms that differ')
+  parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                    help='With --reconcile, only report the differences')
+  parser.add_argument('--alarm-name-prefix', dest='alarm_name_prefixes', action='append', default=[],
+                    help='With --reconcile, the name prefix of the existing alarms, defaults to the severities, '
+                    'e.g. "[CRITICAL] ". Can be repeated')
+
+def run_reconcile(config_generator, args):
+  alarms = config_generator.get_alarm_list(config_generator.get_metrics())
+  alarm_name_prefixes = args.alarm_name_prefixes or get_alarm_name_prefixes(config_generator.alarm_rules)
+  alarm_reconciler = AlarmReconciler(config_generator.dimension_key, [config_generator.dimension_value],
+                        alarm_name_prefixes, config_generator.session)
+  alarm_reconciler.reconcile(alarms, args.dry_run)
+  return(0)
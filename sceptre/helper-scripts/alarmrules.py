@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+CONST_CWAGENT_NAMESPACE = 'CWAgent'
+CONST_AWSEC2_NAMESPACE = 'AWS/EC2'
+CONST_RECOVER_ACTION = '!Sub "arn:aws:automate:${AWS::Region}:ec2:recover"'
+CONST_DEFAULT_SEVERITIES = ['critical', 'warning']
+# Name template for rules from a manifest that do not set their own.
+CONST_DEFAULT_NAME_TEMPLATE = "'[{level}] AWS [{account_id}][{account_name}] {metric_name} on [{tag_name}] {key}:{value}'"
+CONST_MANIFEST_RULES_KEY = 'alarm_rules'
+
+# A declarative alarm definition for one metric name. The name template may use
+# {level}, {metric_name}, {key}, {value}, {tag_name}, {account_id}, {account_name}
+# and every field of dimension_fields, which maps a template field to a dimension name.
+class AlarmRule:
+  def __init__(self,
+                config_key,
+                namespace,
+                comparison_operator,
+                datapoints_to_alarm,
+                evaluation_period,
+                name_template,
+                period='60',
+                statistic='Average',
+                severities=CONST_DEFAULT_SEVERITIES,
+                threshold=None,
+                dimension_fields=None,
+                skip_dimensions=None,
+                recover_metrics=None) -> None:
+      self.config_key = config_key
+      self.namespace = namespace
+      self.comparison_operator = comparison_operator
+      self.datapoints_to_alarm = str(datapoints_to_alarm)
+      self.evaluation_period = str(evaluation_period)
+      self.period = str(period)
+      self.statistic = statistic
+      self.name_template = name_template
+      # Bound once, rendering an alarm name is then a single format_map call.
+      self.format_name = name_template.format_map
+      # (level, LEVEL, alert_config threshold key) in emission order.
+      self.severities = [(level, level.upper(), "{0}_threshold".format(level)) for level in severities]
+      # A fixed threshold, instead of the alert_config one.
+      self.threshold = threshold
+      self.dimension_fields = dimension_fields or {}
+      # Metrics carrying any of these dimensions are not alarmed on.
+      self.skip_dimensions = skip_dimensions or []
+      self.recover_metrics = recover_metrics or []
+
+def get_status_check_rule():
+  return(AlarmRule('status_check_failed', CONST_AWSEC2_NAMESPACE,
+            'GreaterThanThreshold', '2', '2',
+            "'[{level}] {metric_name} AWS [{account_id}][{account_name}] on [{tag_name}] {key}:{value}'",
+            severities=['critical'],
+            threshold='2',
+            recover_metrics=['StatusCheckFailed_System']))
+
+# Metric name -> rule, for the metrics of both the Linux and Windows CloudWatch agents.
+CONST_ALARM_RULES = {
+  'disk_used_percent': AlarmRule('disk_used_percent', CONST_CWAGENT_NAMESPACE,
+                          'GreaterThanThreshold', '2', '3',
+                          "'[{level}] AWS [{account_id}][{account_name}] high disk usage on [{tag_name}] {key}:{value} on path {path}'",
+                          dimension_fields={'path': 'path'}),
+  'LogicalDisk % Free Space': AlarmRule('disk_free_percent', CONST_CWAGENT_NAMESPACE,
+                          'LessThanThreshold', '2', '3',
+                          "'[{level}] AWS [{account_id}][{account_name}] high disk usage on [{tag_name}] {key}:{value} on path {path}'",
+                          dimension_fields={'path': 'instance'}),
+  'mem_used_percent': AlarmRule('mem_used_percent', CONST_CWAGENT_NAMESPACE,
+                          'GreaterThanThreshold', '2', '3',
+                          "'[{level}] AWS [{account_id}][{account_name}] high memory usage on [{tag_name}] {key}:{value}'",
+                          skip_dimensions=['ImageId']),
+  'Memory % Committed Bytes In Use': AlarmRule('mem_used_percent', CONST_CWAGENT_NAMESPACE,
+                          'GreaterThanThreshold', '2', '3',
+                          "'[{level}] AWS [{account_id}][{account_name}] high memory usage on [{tag_name}] {key}:{value}'"),
+  'CPUUtilization': AlarmRule('cpu_utilization', CONST_AWSEC2_NAMESPACE,
+                          'GreaterThanThreshold', '5', '5',
+                          "'[{level}] AWS [{account_id}][{account_name}] high CPU Utilization on [{tag_name}] {key}:{value}'"),
+  'CPUCreditBalance': AlarmRule('cpu_credit_balance', CONST_AWSEC2_NAMESPACE,
+                          'LessThanOrEqualToThreshold', '5', '5',
+                          "'[{level}] AWS [{account_id}][{account_name}] low CPU credit balance on [{tag_name}] {key}:{value}'"),
+  'StatusCheckFailed': get_status_check_rule(),
+  'StatusCheckFailed_Instance': get_status_check_rule(),
+  'StatusCheckFailed_System': get_status_check_rule()
+}
+
+CONST_RULE_REQUIRED_KEYS = ['namespace', 'comparison_operator', 'datapoints_to_alarm', 'evaluation_period']
+CONST_RULE_OPTIONAL_KEYS = ['config_key', 'name_template', 'period', 'statistic', 'severities',
+                            'threshold', 'dimension_fields', 'skip_dimensions', 'recover_metrics']
+
+# Build an AlarmRule from a manifest entry, e.g.
+#   alarm_rules:
+#     swap_used_percent:
+#       namespace: CWAgent
+#       comparison_operator: GreaterThanThreshold
+#       datapoints_to_alarm: 2
+#       evaluation_period: 3
+def build_alarm_rule(metric_name, rule_spec):
+  if not isinstance(rule_spec, dict):
+    raise ValueError("alarm rule for '{0}' must be a mapping".format(metric_name))
+  missing_keys = [key for key in CONST_RULE_REQUIRED_KEYS if key not in rule_spec]
+  if len(missing_keys) > 0:
+    raise ValueError("alarm rule for '{0}' is missing {1}".format(metric_name, missing_keys))
+  unknown_keys = [key for key in rule_spec if key not in CONST_RULE_REQUIRED_KEYS + CONST_RULE_OPTIONAL_KEYS]
+  if len(unknown_keys) > 0:
+    raise ValueError("alarm rule for '{0}' has unknown keys {1}".format(metric_name, unknown_keys))
+  rule_args = dict(rule_spec)
+  rule_args.setdefault('config_key', metric_name)
+  rule_args.setdefault('name_template', CONST_DEFAULT_NAME_TEMPLATE)
+  return(AlarmRule(**rule_args))
+
+# Pop the alarm_rules section off a parsed manifest and return metric name -> AlarmRule.
+def pop_manifest_rules(manifest_vars):
+  rule_specs = manifest_vars.pop(CONST_MANIFEST_RULES_KEY, None) or {}
+  return({metric_name: build_alarm_rule(metric_name, rule_spec) for metric_name, rule_spec in rule_specs.items()})
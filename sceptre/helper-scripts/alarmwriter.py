@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+import yaml
+
+from cfntemplate import CONST_ALARM_RESOURCE_TYPE, CONST_FORMAT_CFN_JSON, CONST_FORMAT_SCEPTRE, CONST_TEMPLATE_VERSION, \
+  CONST_YAML_DUMPER, get_alarm_properties, unquote
+
+# Output written by one AlarmWriter, identical to dumping the whole alarm list or template
+# at once: the sceptre_user_data list and the Resources of a template are written one alarm
+# at a time, to a temporary file that replaces the output file only once it is complete.
+class AlarmWriter:
+  def __init__(self, output_file, output_format=CONST_FORMAT_SCEPTRE, description='') -> None:
+      self.output_file = output_file
+      self.output_format = output_format
+      self.description = description
+      self.temp_file = output_file + '.tmp'
+      self.file = None
+      self.alarm_count = 0
+      self.byte_count = 0
+
+  def open(self):
+    os.makedirs(os.path.dirname(self.output_file) or '.', exist_ok=True)
+    self.file = open(self.temp_file, 'w')
+    self.write_text(self.get_header())
+    return(self)
+
+  def write_text(self, text):
+    self.file.write(text)
+    self.byte_count += len(text.encode('utf-8'))
+
+  def get_header(self):
+    if self.output_format == CONST_FORMAT_SCEPTRE:
+      return('')
+    header = {'AWSTemplateFormatVersion': CONST_TEMPLATE_VERSION}
+    if self.description:
+      header['Description'] = self.description
+    if self.output_format == CONST_FORMAT_CFN_JSON:
+      lines = ['{'] + [" {0}:{1},".format(json.dumps(key), json.dumps(value)) for key, value in header.items()]
+      return('\n'.join(lines) + '\n "Resources":{')
+    return(yaml.dump(header, Dumper=CONST_YAML_DUMPER, sort_keys=False, default_flow_style=False, width=1000))
+
+  # The text of one alarm, without what separates it from the previous one.
+  def format_alarm(self, alarm_data):
+    if self.output_format == CONST_FORMAT_SCEPTRE:
+      return(yaml.dump([alarm_data], Dumper=CONST_YAML_DUMPER, default_flow_style=False))
+    resource = {'Type': CONST_ALARM_RESOURCE_TYPE, 'Properties': get_alarm_properties(alarm_data)}
+    if self.output_format == CONST_FORMAT_CFN_JSON:
+      return("\n  {0}:{1}".format(json.dumps(alarm_data['name']),
+                json.dumps(resource, indent=1, separators=(',', ':')).replace('\n', '\n  ')))
+    text = yaml.dump({alarm_data['name']: resource}, Dumper=CONST_YAML_DUMPER, sort_keys=False,
+              default_flow_style=False, width=1000)
+    return(''.join("  {0}".format(line) for line in text.splitlines(True)))
+
+  def get_separator(self):
+    if self.output_format == CONST_FORMAT_CFN_JSON and self.alarm_count > 0:
+      return(',')
+    if self.output_format not in [CONST_FORMAT_SCEPTRE, CONST_FORMAT_CFN_JSON] and self.alarm_count == 0:
+      return('Resources:\n')
+    return('')
+
+  def get_footer(self):
+    if self.output_format == CONST_FORMAT_SCEPTRE:
+      return('[]\n' if self.alarm_count == 0 else '')
+    if self.output_format == CONST_FORMAT_CFN_JSON:
+      return('}\n}' if self.alarm_count == 0 else '\n }\n}')
+    return('Resources: {}\n' if self.alarm_count == 0 else '')
+
+  # The bytes alarm_text would add to the file, including its separator.
+  def get_size(self, alarm_text):
+    return(len((self.get_separator() + alarm_text).encode('utf-8')))
+
+  def write(self, alarm_data, alarm_text=None):
+    if alarm_text is None:
+      alarm_text = self.format_alarm(alarm_data)
+    self.write_text(self.get_separator() + alarm_text)
+    self.alarm_count += 1
+
+  # Completes the temporary file without replacing the output file yet.
+  def finish(self):
+    self.write_text(self.get_footer())
+    self.file.close()
+
+  def commit(self):
+    os.replace(self.temp_file, self.output_file)
+    return(self.output_file)
+
+  def close(self):
+    self.finish()
+    return(self.commit())
+
+  # Leaves the previous output file as it was.
+  def abort(self):
+    if self.file is not None:
+      self.file.close()
+    if os.path.exists(self.temp_file):
+      os.remove(self.temp_file)
+
+# Streams alarms into output_file, or into several files:
+# - shard_dimension, one file per value of that alarm dimension, e.g. InstanceId when the
+#   generator dimension is an AutoScalingGroupName: output-i-0123456789abcdef0.yaml
+# - max_alarms and max_bytes, a new file once the current one is full: output-002.yaml,
+#   e.g. to stay below the 500 resources of a CloudFormation template.
+# Every file is committed when the block exits without an exception, none is otherwise. The
+# output files replace the previous ones only once all of them are complete. The files of a split
+# output are listed in output.shards, the next run removes the listed files it did not write, so
+# the files are never a mix of two runs. Files not listed there are never removed.
+class ShardedAlarmWriter:
+  def __init__(self,
+                output_file,
+                output_format=CONST_FORMAT_SCEPTRE,
+                description='',
+                max_alarms=None,
+                max_bytes=None,
+                shard_dimension=None) -> None:
+      self.output_file = output_file
+      self.output_format = output_format
+      self.description = description
+      self.max_alarms = max_alarms
+      self.max_bytes = max_bytes
+      self.shard_dimension = shard_dimension
+      # Shard key -> (number of its current file, its AlarmWriter).
+      self.writers = {}
+      self.finished = []
+      self.output_files = []
+
+  def __enter__(self):
+    return(self)
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+    return(False)
+
+  def get_shard_key(self, alarm_data):
+    if self.shard_dimension is None:
+      return('')
+    return(str(unquote(alarm_data['dimensions'].get(self.shard_dimension, ''))).replace(os.sep, '_'))
+
+  def get_shard_file(self, shard_key, number):
+    base, extension = os.path.splitext(self.output_file)
+    parts = [base] + ([shard_key] if shard_key else []) + (["{0:03d}".format(number)] if number > 1 else [])
+    return('-'.join(parts) + extension)
+
+  def open_writer(self, shard_key, number):
+    writer = AlarmWriter(self.get_shard_file(shard_key, number), self.output_format, self.description).open()
+    self.writers[shard_key] = (number, writer)
+    return(writer)
+
+  def is_full(self, writer, alarm_text):
+    if writer.alarm_count == 0:
+      return(False)
+    if self.max_alarms is not None and writer.alarm_count >= self.max_alarms:
+      return(True)
+    if self.max_bytes is not None and \
+      writer.byte_count + writer.get_size(alarm_text) + len(writer.get_footer().encode('utf-8')) > self.max_bytes:
+      return(True)
+    return(False)
+
+  def write(self, alarm_data):
+    shard_key = self.get_shard_key(alarm_data)
+    number, writer = self.writers.get(shard_key, (0, None))
+    if writer is None:
+      writer = self.open_writer(shard_key, 1)
+    alarm_text = writer.format_alarm(alarm_data)
+    if self.is_full(writer, alarm_text):
+      self.finished.append(writer)
+      writer = self.open_writer(shard_key, number + 1)
+    writer.write(alarm_data, alarm_text)
+
+  def get_writers(self):
+    return(self.finished + [writer for number, writer in self.writers.values()])
+
+  def is_split(self):
+    return(self.max_alarms is not None or self.max_bytes is not None or self.shard_dimension is not None)
+
+  def get_index_file(self):
+    return(os.path.splitext(self.output_file)[0] + '.shards')
+
+  # The files the previous split run listed in the index, next to the output file.
+  def load_index(self):
+    index_file = self.get_index_file()
+    if not os.path.exists(index_file):
+      return([])
+    with open(index_file, 'r') as index_handler:
+      try:
+        shard_names = json.load(index_handler)
+      except ValueError:
+        print("ignoring the unreadable shard index {0}".format(index_file))
+        return([])
+    output_dir = os.path.dirname(self.output_file)
+    # Only plain file names, an index cannot point outside the output directory.
+    return([os.path.join(output_dir, shard_name) for shard_name in shard_names
+            if isinstance(shard_name, str) and shard_name and os.path.basename(shard_name) == shard_name])
+
+  def save_index(self):
+    index_file = self.get_index_file()
+    if not self.is_split():
+      if os.path.exists(index_file):
+        os.remove(index_file)
+      return
+    with open(index_file + '.tmp', 'w') as index_handler:
+      json.dump([os.path.basename(output_file) for output_file in self.output_files], index_handler, indent=1)
+    os.replace(index_file + '.tmp', index_file)
+
+  def close(self):
+    # No alarm at all still gives an empty output file.
+    if len(self.writers) == 0:
+      self.open_writer('', 1)
+    writers = self.get_writers()
+    try:
+      for writer in writers:
+        writer.finish()
+    except Exception:
+      self.abort()
+      raise
+    for writer in writers:
+      self.output_files.append(writer.commit())
+    for shard_file in self.load_index():
+      if shard_file not in self.output_files and os.path.isfile(shard_file):
+        os.remove(shard_file)
+    self.save_index()
+    return(self.output_files)
+
+  def abort(self):
+    for writer in self.get_writers():
+      writer.abort()
+
+def add_output_arguments(parser):
+  parser.add_argument('--max-alarms-per-file', dest='max_alarms_per_file', type=int,
+                    help='Start a new output file, output-002.yaml and so on, after this many alarms')
+  parser.add_argument('--max-file-bytes', dest='max_file_bytes', type=int,
+                    help='Start a new output file before one grows past this many bytes')
+  parser.add_argument('--shard-by', dest='shard_dimension',
+                    help='Write one output file per value of this alarm dimension, e.g. InstanceId')
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import functools
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from clientpool import ClientSettings
+from configgenerator import get_alarm_metric
+
+CONST_THROTTLING_ERROR_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException',
+                                'RequestLimitExceeded', 'TooManyRequestsException', 'RequestThrottled']
+# Requests per second and burst, from the published EC2 and CloudWatch API throttles.
+CONST_DEFAULT_API_RATES = {
+  'sts.GetCallerIdentity': (10.0, 10),
+  'ec2.DescribeTags': (20.0, 100),
+  'cloudwatch.ListMetrics': (25.0, 25)
+}
+CONST_DEFAULT_API_RATE = (10.0, 10)
+CONST_DEFAULT_MAX_CONCURRENCY = 32
+CONST_DEFAULT_CALL_TIMEOUT = 30.0
+CONST_DEFAULT_MAX_ATTEMPTS = 8
+CONST_BACKOFF_BASE = 0.2
+CONST_BACKOFF_MAX = 20.0
+# describe_tags accepts up to 200 values per filter.
+CONST_DESCRIBE_TAGS_BATCH = 200
+
+def is_throttling_error(exc):
+  response = getattr(exc, 'response', None) or {}
+  return(response.get('Error', {}).get('Code') in CONST_THROTTLING_ERROR_CODES)
+
+# A connect or read timeout of botocore, the call has returned and can be retried.
+def is_timeout_error(exc):
+  try:
+    from botocore.exceptions import ConnectTimeoutError, ReadTimeoutError
+  except ImportError:
+    return(False)
+  return(isinstance(exc, (ConnectTimeoutError, ReadTimeoutError)))
+
+class TokenBucket:
+  def __init__(self, rate, capacity) -> None:
+      self.max_rate = float(rate)
+      self.min_rate = self.max_rate / 64
+      self.rate = self.max_rate
+      self.capacity = float(capacity)
+      self.tokens = self.capacity
+      self.updated_at = time.monotonic()
+      self.lock = asyncio.Lock()
+
+  def refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+    self.updated_at = now
+
+  async def acquire(self):
+    async with self.lock:
+      self.refill()
+      while self.tokens < 1:
+        await asyncio.sleep((1 - self.tokens) / self.rate)
+        self.refill()
+      self.tokens -= 1
+
+  # Halve the rate on throttling and drain the burst, ramp back up slowly on success.
+  def on_throttle(self):
+    self.rate = max(self.min_rate, self.rate / 2)
+    self.tokens = min(self.tokens, 0)
+
+  def on_success(self):
+    self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+# A concurrency cap that backs off multiplicatively on throttling and grows additively on success.
+class AdaptiveLimiter:
+  def __init__(self, max_concurrency) -> None:
+      self.max_concurrency = max(1, int(max_concurrency))
+      self.limit = float(self.max_concurrency)
+      self.in_flight = 0
+      self.condition = asyncio.Condition()
+
+  async def __aenter__(self):
+    async with self.condition:
+      while self.in_flight >= int(self.limit):
+        await self.condition.wait()
+      self.in_flight += 1
+    return(self)
+
+  async def __aexit__(self, exc_type, exc, traceback):
+    async with self.condition:
+      self.in_flight -= 1
+      self.condition.notify_all()
+
+  def on_throttle(self):
+    self.limit = max(1.0, self.limit / 2)
+
+  def on_success(self):
+    self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+class ApiStats:
+  def __init__(self) -> None:
+      self.calls = 0
+      self.retries = 0
+      self.throttles = 0
+      self.timeouts = 0
+
+# Runs blocking boto3 calls on a thread pool, each API behind its own token bucket and
+# adaptive concurrency limit, retrying throttled and timed out calls with jittered backoff.
+# A thread cannot be cancelled, so the deadline of a call is the connect and read timeout of
+# its client, see get_client_settings, and a call is only retried once it has returned.
+class ThrottledCaller:
+  def __init__(self,
+                max_concurrency=CONST_DEFAULT_MAX_CONCURRENCY,
+                call_timeout=CONST_DEFAULT_CALL_TIMEOUT,
+                max_attempts=CONST_DEFAULT_MAX_ATTEMPTS,
+                api_rates=None) -> None:
+      self.max_concurrency = max_concurrency
+      self.call_timeout = call_timeout
+      self.max_attempts = max_attempts
+      self.api_rates = {**CONST_DEFAULT_API_RATES, **(api_rates or {})}
+      self.buckets = {}
+      self.limiters = {}
+      self.stats = {}
+      self.executor = None
+
+  def get_api_state(self, api_name):
+    if api_name not in self.buckets:
+      rate, capacity = self.api_rates.get(api_name, CONST_DEFAULT_API_RATE)
+      self.buckets[api_name] = TokenBucket(rate, capacity)
+      self.limiters[api_name] = AdaptiveLimiter(self.max_concurrency)
+      self.stats[api_name] = ApiStats()
+    return(self.buckets[api_name], self.limiters[api_name], self.stats[api_name])
+
+  # The botocore settings of the clients whose calls this caller makes. botocore does not retry,
+  # its retries would hide the throttles from the token bucket and the limiter.
+  def get_client_settings(self):
+    return(ClientSettings(max_pool_connections=self.max_concurrency, max_attempts=1,
+              connect_timeout=self.call_timeout, read_timeout=self.call_timeout))
+
+  async def call(self, api_name, operation, **kwargs):
+    bucket, limiter, stats = self.get_api_state(api_name)
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+      attempt += 1
+      await bucket.acquire()
+      async with limiter:
+        stats.calls += 1
+        try:
+          response = await loop.run_in_executor(self.executor, functools.partial(operation, **kwargs))
+          bucket.on_success()
+          limiter.on_success()
+          return(response)
+        except Exception as exc:
+          if is_timeout_error(exc):
+            stats.timeouts += 1
+          elif is_throttling_error(exc):
+            stats.throttles += 1
+            bucket.on_throttle()
+            limiter.on_throttle()
+          else:
+            raise
+          if attempt >= self.max_attempts:
+            raise
+      stats.retries += 1
+      await asyncio.sleep(random.uniform(0, min(CONST_BACKOFF_MAX, CONST_BACKOFF_BASE * 2 ** attempt)))
+
+  def print_stats(self):
+    for api_name, stats in sorted(self.stats.items()):
+      print("{0}: {1} calls, {2} retries, {3} throttled, {4} timed out, final rate {5:.1f}/s".format(
+          api_name, stats.calls, stats.retries, stats.throttles, stats.timeouts, self.buckets[api_name].rate))
+
+# The argparse type of --api-rate, API=RATE[:BURST], e.g. cloudwatch.ListMetrics=50:50 for an
+# account with a raised quota.
+def parse_api_rate(api_rate):
+  error = argparse.ArgumentTypeError("API rate must be API=RATE[:BURST] with a positive RATE, got '{0}'".format(api_rate))
+  api_name, _, rate = api_rate.partition('=')
+  rate, _, capacity = rate.partition(':')
+  try:
+    rate = float(rate)
+    capacity = int(capacity) if capacity else max(1, int(rate))
+  except (ValueError, OverflowError):
+    raise error
+  if not api_name or rate <= 0 or capacity < 1:
+    raise error
+  return(api_name, (rate, capacity))
+
+# Fleet-wide discovery of the Name tags and alarm metrics of many dimension values.
+class AsyncDiscoveryEngine:
+  def __init__(self,
+                key,
+                metric_alarms,
+                metric_fstype,
+                metric_namespaces,
+                session,
+                caller=None,
+                instrumentation=None) -> None:
+      self.dimension_key = key
+      self.metric_alarms = metric_alarms
+      self.metric_fstype = metric_fstype
+      self.metric_namespaces = metric_namespaces
+      self.instrumentation = instrumentation
+      self.caller = caller if caller is not None else ThrottledCaller()
+      # Clients are created once up front, boto3 clients are thread-safe, sessions are not.
+      self.ec2_client = self.get_client(session, 'ec2')
+      self.cloudwatch_client = self.get_client(session, 'cloudwatch')
+
+  # Clients of their own, with the timeouts of the caller instead of those of the session.
+  def get_client(self, session, service_name):
+    client = session.client(service_name, config=self.caller.get_client_settings().get_config())
+    if self.instrumentation is not None:
+      self.instrumentation.instrument_client(client, service_name)
+    return(client)
+
+  # One describe_tags call per 200 instances instead of one per instance. Returns value -> Name
+  # tag and value -> exception, a failed batch only fails its own instances.
+  async def get_tag_names(self, values):
+    tag_names = {value: '' for value in values}
+    errors = {}
+    batches = [values[ii:ii + CONST_DESCRIBE_TAGS_BATCH] for ii in range(0, len(values), CONST_DESCRIBE_TAGS_BATCH)]
+    batch_results = await asyncio.gather(*[self.get_tag_names_batch(batch, tag_names) for batch in batches],
+                      return_exceptions=True)
+    for batch, batch_result in zip(batches, batch_results):
+      if isinstance(batch_result, Exception):
+        errors.update(dict.fromkeys(batch, batch_result))
+    return(tag_names, errors)
+
+  async def get_tag_names_batch(self, batch, tag_names):
+    filters = [
+      {'Name': 'resource-type', 'Values': ['instance']},
+      {'Name': 'resource-id', 'Values': batch},
+      {'Name': 'key', 'Values': ['Name']}
+    ]
+    next_token = None
+    while True:
+      kwargs = {'DryRun': False, 'Filters': filters, 'MaxResults': 1000}
+      if next_token:
+        kwargs['NextToken'] = next_token
+      response = await self.caller.call('ec2.DescribeTags', self.ec2_client.describe_tags, **kwargs)
+      for tag in response['Tags']:
+        tag_names[tag['ResourceId']] = tag['Value']
+      next_token = response.get('NextToken')
+      if not next_token:
+        break
+
+  async def get_metrics(self, value):
+    metrics = []
+    param_dimensions = [{'Name': self.dimension_key, 'Value': value}]
+    for namespace in self.metric_namespaces:
+      next_token = None
+      while True:
+        kwargs = {'Namespace': namespace, 'Dimensions': param_dimensions}
+        if next_token:
+          kwargs['NextToken'] = next_token
+        response = await self.caller.call('cloudwatch.ListMetrics', self.cloudwatch_client.list_metrics, **kwargs)
+        for metric in response['Metrics']:
+          metric_record = get_alarm_metric(metric, self.metric_alarms, self.metric_fstype)
+          if metric_record is not None:
+            metrics.append(metric_record)
+        next_token = response.get('NextToken')
+        if not next_token:
+          break
+    return(metrics)
+
+  # Returns value -> (Name tag, metrics) and value -> exception, the Name tags are only
+  # looked up when the dimension values are instance IDs. A metric_index replaces list_metrics.
+  async def discover(self, values, metric_index=None):
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=self.caller.max_concurrency) as executor:
+      self.caller.executor = executor
+      if self.dimension_key == 'InstanceId':
+        tag_names, errors = await self.get_tag_names(values)
+      else:
+        tag_names = {value: '' for value in values}
+      # The metrics of an instance without its Name tag are not listed.
+      values = [value for value in values if value not in errors]
+      if metric_index is not None:
+        metrics = [metric_index.get_metrics(value) for value in values]
+      else:
+        metrics = await asyncio.gather(*[self.get_metrics(value) for value in values], return_exceptions=True)
+      for value, value_metrics in zip(values, metrics):
+        if isinstance(value_metrics, Exception):
+          errors[value] = value_metrics
+        else:
+          results[value] = (tag_names[value], value_metrics)
+      self.caller.executor = None
+    return(results, errors)
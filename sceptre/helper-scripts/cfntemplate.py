@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import json
+
+import yaml
+
+from alarmrules import CONST_RECOVER_ACTION
+
+CONST_FORMAT_SCEPTRE = 'sceptre'
+CONST_FORMAT_CFN_YAML = 'cfn-yaml'
+CONST_FORMAT_CFN_JSON = 'cfn-json'
+CONST_OUTPUT_FORMATS = [CONST_FORMAT_SCEPTRE, CONST_FORMAT_CFN_YAML, CONST_FORMAT_CFN_JSON]
+CONST_TEMPLATE_VERSION = '2010-09-09'
+CONST_ALARM_RESOURCE_TYPE = 'AWS::CloudWatch::Alarm'
+# Placeholder used by ConfigGenerator when no action ARN is given, it is not a valid action.
+CONST_PLACEHOLDER_ACTION = 'x'
+CONST_RECOVER_SUB = {'Fn::Sub': 'arn:aws:automate:${AWS::Region}:ec2:recover'}
+# The Id of the query of an alarm on an expression, e.g. the members of a group.
+CONST_QUERY_ID = 'members'
+
+# The libyaml emitter is several times faster than the pure Python one.
+CONST_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# The alarm YAML is fed to a Jinja template, so strings carry their own YAML quotes.
+def unquote(value):
+  if isinstance(value, str) and len(value) >= 2 and value[0] == "'" and value[-1] == "'":
+    return(value[1:-1])
+  return(value)
+
+def get_number(value):
+  number = float(value)
+  return(int(number) if number.is_integer() else number)
+
+def get_actions(actions):
+  return_value = []
+  for action in actions:
+    if action == CONST_RECOVER_ACTION:
+      return_value.append(CONST_RECOVER_SUB)
+    elif action and action != CONST_PLACEHOLDER_ACTION:
+      return_value.append(action)
+  return(return_value)
+
+# Map one alarm of ConfigGenerator.generate_yaml to AWS::CloudWatch::Alarm properties.
+def get_alarm_properties(alarm_data):
+  properties = {
+    'AlarmName': unquote(alarm_data['alarm_name']),
+    'AlarmDescription': unquote(alarm_data['alarm_description']),
+    'ActionsEnabled': alarm_data['actions_enabled'],
+    'AlarmActions': get_actions(alarm_data['alarm_actions']),
+    'OKActions': get_actions(alarm_data['ok_actions']),
+    'ComparisonOperator': alarm_data['comparison_operator'],
+    'DatapointsToAlarm': get_number(alarm_data['datapoints_to_alarm']),
+    'EvaluationPeriods': get_number(alarm_data['evaluation_period']),
+    'Period': get_number(alarm_data['period']),
+    'Threshold': get_number(alarm_data['threshold']),
+    'MetricName': alarm_data['metric_name'],
+    'Namespace': alarm_data['namespace'],
+    'Statistic': alarm_data['statistic'],
+    'Dimensions': [{'Name': name, 'Value': unquote(value)} for name, value in alarm_data['dimensions'].items()]
+  }
+  if 'expression' in alarm_data:
+    # An alarm on a query names no metric of its own.
+    for key in ['MetricName', 'Namespace', 'Statistic', 'Dimensions', 'Period']:
+      del properties[key]
+    properties['Metrics'] = [{
+      'Id': CONST_QUERY_ID,
+      'Expression': alarm_data['expression'],
+      'Period': get_number(alarm_data['period']),
+      'ReturnData': True
+    }]
+  return(properties)
+
+def get_template(alarms, description=''):
+  template = {'AWSTemplateFormatVersion': CONST_TEMPLATE_VERSION}
+  if description:
+    template['Description'] = description
+  template['Resources'] = {
+    alarm_data['name']: {
+      'Type': CONST_ALARM_RESOURCE_TYPE,
+      'Properties': get_alarm_properties(alarm_data)
+    } for alarm_data in alarms
+  }
+  return(template)
+
+def dump_template(template, file, output_format=CONST_FORMAT_CFN_YAML):
+  if output_format == CONST_FORMAT_CFN_JSON:
+    json.dump(template, file, indent=1, separators=(',', ':'))
+  else:
+    yaml.dump(template, file, Dumper=CONST_YAML_DUMPER, sort_keys=False, default_flow_style=False, width=1000)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import threading
+
+# botocore keeps 10 connections per client, fewer than the fleet workers sharing a client.
+CONST_DEFAULT_MAX_POOL_CONNECTIONS = 10
+CONST_RETRY_MODES = ['legacy', 'standard', 'adaptive']
+CONST_DEFAULT_RETRY_MODE = 'standard'
+# The attempts of the legacy mode, the first call and 4 retries.
+CONST_DEFAULT_MAX_ATTEMPTS = 5
+CONST_DEFAULT_CONNECT_TIMEOUT = 10
+CONST_DEFAULT_READ_TIMEOUT = 60
+
+# The botocore Config of the clients of a ClientPool.
+class ClientSettings:
+  def __init__(self,
+                max_pool_connections=CONST_DEFAULT_MAX_POOL_CONNECTIONS,
+                retry_mode=CONST_DEFAULT_RETRY_MODE,
+                max_attempts=CONST_DEFAULT_MAX_ATTEMPTS,
+                connect_timeout=CONST_DEFAULT_CONNECT_TIMEOUT,
+                read_timeout=CONST_DEFAULT_READ_TIMEOUT) -> None:
+      self.max_pool_connections = max(1, int(max_pool_connections))
+      self.retry_mode = retry_mode
+      self.max_attempts = max(1, int(max_attempts))
+      self.connect_timeout = connect_timeout
+      self.read_timeout = read_timeout
+
+  def get_config(self):
+    from botocore.config import Config
+    return(Config(max_pool_connections=self.max_pool_connections,
+            # max_attempts would be the retries, without the first call.
+            retries={'mode': self.retry_mode, 'total_max_attempts': self.max_attempts},
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout))
+
+class ClientStats:
+  def __init__(self) -> None:
+      self.clients = 0
+      self.requests = 0
+
+# The urllib3 connection pools of a client, empty for a client without them like the
+# benchmark stand-in. Best-effort: botocore does not expose them, they are read from its
+# private attributes, and any botocore or urllib3 version laid out differently gives none.
+def get_connection_pools(client):
+  try:
+    http_session = getattr(getattr(client, '_endpoint', None), 'http_session', None)
+    pools = getattr(getattr(http_session, '_manager', None), 'pools', None)
+    if pools is None:
+      return([])
+    return([pools[pool_key] for pool_key in list(pools.keys())])
+  except Exception:
+    return([])
+
+# A session whose client() can be called from many threads, with one client per service and
+# region shared by every caller. A client keeps its HTTPS connections, so a fleet run reuses
+# them instead of resolving the endpoint, walking the credential chain and handshaking for
+# every generator. boto3 clients are thread-safe, creating them is not, so that takes the lock.
+# The generators, FleetGenerator and AlarmReconciler take it as their session.
+class ClientPool:
+  def __init__(self, session=None, settings=None) -> None:
+      if session is None:
+        # Imported on first use, boto3 is slow to import and --help does not need it.
+        import boto3
+        session = boto3.session.Session()
+      self.session = session
+      self.region_name = session.region_name
+      self.settings = settings if settings is not None else ClientSettings()
+      self.config = None
+      # (service name, region name) -> client.
+      self.clients = {}
+      self.stats = {}
+      self.lock = threading.Lock()
+
+  def get_config(self):
+    if self.config is None:
+      self.config = self.settings.get_config()
+    return(self.config)
+
+  # The shared client of the service. A client with a Config or other custom arguments is
+  # created for the caller and not shared.
+  def client(self, service_name, **kwargs):
+    region_name = kwargs.pop('region_name', None) or self.region_name
+    with self.lock:
+      client_stats = self.stats.setdefault(service_name, ClientStats())
+      client_stats.requests += 1
+      if len(kwargs) > 0:
+        client_stats.clients += 1
+        return(self.session.client(service_name, region_name=region_name, **kwargs))
+      client_key = (service_name, region_name)
+      if client_key not in self.clients:
+        client_stats.clients += 1
+        self.clients[client_key] = self.session.client(service_name, region_name=region_name, config=self.get_config())
+      return(self.clients[client_key])
+
+  def get_credentials(self):
+    return(self.session.get_credentials())
+
+  # Per service: clients created, client() calls, and the HTTP connections opened and the
+  # requests sent over them. Far fewer connections than requests is the pool at work.
+  def get_stats(self):
+    with self.lock:
+      stats = {service_name: {'clients': client_stats.clients, 'client_requests': client_stats.requests,
+                               'connections': 0, 'http_requests': 0}
+                for service_name, client_stats in self.stats.items()}
+      clients = list(self.clients.items())
+    for (service_name, region_name), client in clients:
+      for pool in get_connection_pools(client):
+        stats[service_name]['connections'] += getattr(pool, 'num_connections', 0)
+        stats[service_name]['http_requests'] += getattr(pool, 'num_requests', 0)
+    return(dict(sorted(stats.items())))
+
+def add_client_pool_arguments(parser):
+  parser.add_argument('--max-pool-connections', dest='max_pool_connections', type=int,
+                    help='The HTTPS connections kept per AWS service, defaults to the number of workers and at least {0}'.format(
+                      CONST_DEFAULT_MAX_POOL_CONNECTIONS))
+  parser.add_argument('--retry-mode', dest='retry_mode', default=CONST_DEFAULT_RETRY_MODE, choices=CONST_RETRY_MODES,
+                    help='The botocore retry mode of the AWS API calls')
+  parser.add_argument('--max-attempts', dest='max_attempts', type=int, default=CONST_DEFAULT_MAX_ATTEMPTS,
+                    help='The attempts of an AWS API call, including the first one')
+  parser.add_argument('--connect-timeout', dest='connect_timeout', type=float, default=CONST_DEFAULT_CONNECT_TIMEOUT,
+                    help='The seconds to wait for a connection to an AWS API')
+  parser.add_argument('--read-timeout', dest='read_timeout', type=float, default=CONST_DEFAULT_READ_TIMEOUT,
+                    help='The seconds to wait for the response of an AWS API')
+
+# workers is how many threads share the clients, every one of them gets a connection.
+def get_client_settings(args, workers=1):
+  max_pool_connections = args.max_pool_connections or max(CONST_DEFAULT_MAX_POOL_CONNECTIONS, workers)
+  return(ClientSettings(max_pool_connections, args.retry_mode, args.max_attempts,
+          args.connect_timeout, args.read_timeout))
+
+# The ClientPool of a CLI run, its statistics are part of the instrumentation output.
+def get_client_pool(args, instrumentation=None, workers=1, session=None):
+  client_pool = ClientPool(session, get_client_settings(args, workers))
+  if instrumentation is not None:
+    instrumentation.add_client_pool(client_pool)
+  return(client_pool)
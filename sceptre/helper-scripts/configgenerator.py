@@ -1,14 +1,115 @@
 #!/usr/bin/env python3
 
-import boto3
-import yaml
+import contextlib
+import hashlib
+
+from alarmrules import CONST_ALARM_RULES, CONST_AWSEC2_NAMESPACE, CONST_CWAGENT_NAMESPACE, CONST_RECOVER_ACTION
+from alarmwriter import ShardedAlarmWriter
+from cfntemplate import CONST_FORMAT_SCEPTRE
+from clientpool import ClientPool
+from discoverycache import CONST_CACHE_ACCOUNT, CONST_CACHE_METRICS, CONST_CACHE_TAG_NAME, \
+  get_credential_key, get_filter_key, get_region_name
+from groupalarms import describe_group_tag_names, get_group_metrics, get_group_query
+from manifestcompiler import CompiledManifest, get_instance_attributes
+from metricrecord import MetricRecord
 
 CONST_DEFAULT_IN_ALARM = 'x'
 CONST_DEFAULT_OK_ALARM = 'x'
-CONST_CWAGENT_NAMESPACE = 'CWAgent'
-CONST_AWSEC2_NAMESPACE = 'AWS/EC2'
+CONST_LOGICAL_ID_PREFIX = 'alarm'
+CONST_LOGICAL_ID_DIGEST_LENGTH = 16
+
+# A CloudFormation logical ID derived from what the alarm watches, so it does not change
+# when list_metrics returns the metrics in another order or a new mount point appears.
+def get_alarm_logical_id(namespace, metric, level):
+  dimensions = sorted("{0}={1}".format(dimension_name, dimension_value) for dimension_name, dimension_value in metric.get_dimensions())
+  identity = '\n'.join([namespace, metric.metric_name, level] + dimensions)
+  return(CONST_LOGICAL_ID_PREFIX + hashlib.sha256(identity.encode('utf-8')).hexdigest()[:CONST_LOGICAL_ID_DIGEST_LENGTH])
+
+# Compile the manifest overrides of manifest_yaml_file, one path or a list of layers.
+# Fleet mode compiles them once for every instance.
+def load_manifest(manifest_yaml_file):
+  return(CompiledManifest(manifest_yaml_file))
+
+# Like functools.cached_property, without the lock that Python 3.11 shares across every
+# instance and that would serialize the lookups of a whole fleet. Two threads may both
+# compute the value of one instance, the last one is kept. Assigning the attribute
+# injects a value that is never computed.
+class memoized_property:
+  def __init__(self, function) -> None:
+      self.function = function
+      self.name = function.__name__
+      self.__doc__ = function.__doc__
+
+  def __get__(self, instance, owner=None):
+    if instance is None:
+      return(self)
+    value = self.function(instance)
+    instance.__dict__[self.name] = value
+    return(value)
+
+# Whether an alarm should be generated for this MetricRecord.
+def is_alarm_metric(metric, metric_alarms, metric_fstype):
+  metric_name = metric.metric_name
+  if metric_name not in metric_alarms:
+    return(False)
+  # We need to filter out any metric with fstype not defined in metric_fstype
+  if metric_name == "disk_used_percent" and metric.get_dimension("fstype") not in metric_fstype:
+    return(False)
+  return(True)
+
+# The MetricRecord of a list_metrics entry an alarm should be generated for, or None. The
+# metric name is checked on the boto3 dict, the other metrics of a sweep are never converted.
+def get_alarm_metric(metric, metric_alarms, metric_fstype):
+  if metric['MetricName'] not in metric_alarms:
+    return(None)
+  metric_record = MetricRecord.from_metric(metric)
+  if not is_alarm_metric(metric_record, metric_alarms, metric_fstype):
+    return(None)
+  return(metric_record)
 
 class ConfigGenerator:
+  # Class attributes so fleet mode can filter a bulk discovery sweep before any generator exists,
+  # every instance extends them with the rules of its manifest.
+  default_metric_alarms = ["disk_used_percent",
+                  "mem_used_percent",
+                  "CPUCreditBalance",
+                  "CPUUtilization",
+                  "StatusCheckFailed",
+                  "StatusCheckFailed_Instance",
+                  "StatusCheckFailed_System"]
+  metric_fstype = ["xfs", "ext2", "ext3", "ext4", "nfs4"]
+  # What manifest selectors match as the platform.
+  platform = 'linux'
+  # Metric name -> AlarmRule, extended per instance by the alarm_rules of a manifest.
+  default_alarm_rules = CONST_ALARM_RULES
+  default_metric_namespaces = [CONST_CWAGENT_NAMESPACE, CONST_AWSEC2_NAMESPACE]
+  # Overridden per instance by the sections of a manifest.
+  default_alert_config = {
+    'disk_used_percent' : {
+      'enabled': True,
+      'warning_threshold': '80',
+      'critical_threshold': '95'
+    },
+    'mem_used_percent' : {
+      'enabled': True,
+      'warning_threshold': '90',
+      'critical_threshold': '99'
+    },
+    'cpu_utilization' : {
+      'enabled': True,
+      'warning_threshold': '85',
+      'critical_threshold': '99'
+    },
+    'cpu_credit_balance' : {
+      'enabled': True,
+      'warning_threshold': '500',
+      'critical_threshold': '100'
+    },
+    'status_check_failed' : {
+      'enabled': True
+    }
+  }
+
   def __init__(self,
                 key,
                 value,
@@ -19,76 +120,154 @@ class ConfigGenerator:
                 ok_alarm_critical,
                 use_recover='true',
                 aws_account_name='unknown account',
-                manifest_yaml_file='') -> None:
+                manifest_yaml_file='',
+                aws_account_id='',
+                session=None,
+                cache=None,
+                output_format=CONST_FORMAT_SCEPTRE,
+                instance_tag_name=None,
+                instrumentation=None,
+                manifest=None,
+                instance_attributes=None) -> None:
       self.dimension_key = key
       self.dimension_value = value
       self.use_recover = False if use_recover.lower() == 'false' else True
       self.output_file = output
+      # sceptre_user_data YAML, or a ready-to-deploy CloudFormation template (cfn-yaml, cfn-json).
+      self.output_format = output_format
       self.in_alarm_action_warning = in_alarm_warning if len(in_alarm_warning) > 0 else CONST_DEFAULT_IN_ALARM
       self.ok_alarm_action_warning = ok_alarm_warning if len(ok_alarm_warning) > 0 else CONST_DEFAULT_OK_ALARM
       self.in_alarm_action_critical = in_alarm_critical if len(in_alarm_critical) > 0 else self.in_alarm_action_warning
       self.ok_alarm_action_critical = ok_alarm_critical if len(ok_alarm_critical) > 0 else self.ok_alarm_action_warning
-      self.instance_tag_name = self.get_instance_tag_name()
-      self.alert_config = {
-        'disk_used_percent' : {
-          'enabled': True,
-          'warning_threshold': '80',
-          'critical_threshold': '95'
-        },
-        'mem_used_percent' : {
-          'enabled': True,
-          'warning_threshold': '90',
-          'critical_threshold': '99'
-        },
-        'cpu_utilization' : {
-          'enabled': True,
-          'warning_threshold': '85',
-          'critical_threshold': '99'
-        },
-        'cpu_credit_balance' : {
-          'enabled': True,
-          'warning_threshold': '500',
-          'critical_threshold': '100'
-        },
-        'status_check_failed' : {
-          'enabled': True
-        }
-      }
+      # A ClientPool, or a boto3 session, shared with the other generators of a fleet. The
+      # generator creates its own ClientPool on the first AWS call without one.
+      self.session = session
+      # Optional DiscoveryCache for the account, Name tag and metric lookups.
+      self.cache = cache
+      # Optional Instrumentation, the phase timings and API call statistics of the run.
+      self.instrumentation = instrumentation
       self.aws_account_name = aws_account_name
-      self.aws_account_id = self.get_aws_account_id()
-      self.manifest_vars = {}
-      self.load_manifest(manifest_yaml_file)
-      self.metric_alarms = ["disk_used_percent",
-                      "mem_used_percent",
-                      "CPUCreditBalance",
-                      "CPUUtilization",
-                      "StatusCheckFailed",
-                      "StatusCheckFailed_Instance",
-                      "StatusCheckFailed_System"]
-      self.metric_fstype = ["xfs", "ext2", "ext3", "ext4", "nfs4"]
-
-  # Load manifest override from manifest_yaml_file
-  def load_manifest(self, manifest_yaml_file):
-    if manifest_yaml_file and len(manifest_yaml_file) > 0:
-      with open(manifest_yaml_file, 'r') as manifest_handler:
-        try:
-          manifest_vars = yaml.safe_load(manifest_handler)
-          print("load self.manifest_vars = {0}".format(manifest_vars))
-          updated_config = {**self.alert_config, **manifest_vars}
-          self.alert_config = updated_config
-        except yaml.YAMLError as exc:
-          print(exc)
+      self.manifest_yaml_file = manifest_yaml_file
+      # The account ID, Name tag, manifest and instance attributes are resolved on first use,
+      # a value passed in here is used as is. Fleet mode resolves the account ID, the manifest
+      # and the instance attributes once and the async discovery engine the Name tags of the
+      # whole fleet in bulk.
+      if aws_account_id:
+        self.aws_account_id = aws_account_id
+      if instance_tag_name is not None:
+        self.instance_tag_name = instance_tag_name
+      if manifest is not None:
+        self.manifest = manifest
+      if instance_attributes is not None:
+        self.instance_attributes = instance_attributes
+      # Fleet mode injects a shared MetricIndex to serve get_metrics without calling list_metrics.
+      self.metric_index = None
+      # Set by the CLI to split the output into several files, see ShardedAlarmWriter.
+      self.max_alarms_per_file = None
+      self.max_file_bytes = None
+      self.shard_dimension = None
+      # Set by the CLI for one alarm per metric of an Auto Scaling group instead of one per member.
+      self.group_mode = False
+
+  @memoized_property
+  def aws_account_id(self):
+    with self.phase('account_id'):
+      return(self.get_aws_account_id())
+
+  @memoized_property
+  def instance_tag_name(self):
+    with self.phase('tag_name'):
+      return(self.get_instance_tag_name())
+
+  # The CompiledManifest of manifest_yaml_file, see load_manifest.
+  @memoized_property
+  def manifest(self):
+    return(load_manifest(self.manifest_yaml_file))
+
+  # The platform, instance type and tags the manifest selectors match on. Only described
+  # when a selector needs more than the platform, and only an InstanceId has them.
+  @memoized_property
+  def instance_attributes(self):
+    if not self.manifest.needs_instances() or self.dimension_key != 'InstanceId':
+      return({'platform': self.platform})
+    return(self.describe_instance_attributes())
+
+  # Selectors may also match the dimension, e.g. the per-instance thresholds of thresholdtuner.py.
+  @memoized_property
+  def alert_config(self):
+    selector_attributes = dict(self.instance_attributes, dimensions={self.dimension_key: self.dimension_value})
+    return(self.manifest.get_alert_config(self.default_alert_config, selector_attributes))
+
+  @memoized_property
+  def alarm_rules(self):
+    return({**self.default_alarm_rules, **self.manifest.custom_rules})
+
+  @memoized_property
+  def metric_alarms(self):
+    return(self.get_metric_alarms(self.manifest.custom_rules))
+
+  @memoized_property
+  def metric_namespaces(self):
+    return(self.get_metric_namespaces(self.manifest.custom_rules))
+
+  # The metric names to alarm on with the custom rules of a manifest, before any instance exists.
+  @classmethod
+  def get_metric_alarms(cls, custom_rules):
+    return(cls.default_metric_alarms +
+      [metric_name for metric_name in custom_rules if metric_name not in cls.default_metric_alarms])
+
+  @classmethod
+  def get_metric_namespaces(cls, custom_rules):
+    return(cls.default_metric_namespaces +
+      [rule.namespace for rule in custom_rules.values() if rule.namespace not in cls.default_metric_namespaces])
+
+  def get_client(self, service_name):
+    if self.session is None:
+      # One pool for every lookup of the generator instead of a new client for each.
+      self.session = ClientPool()
+    client = self.session.client(service_name)
+    if self.instrumentation is not None:
+      self.instrumentation.instrument_client(client, service_name)
+    return(client)
+
+  def phase(self, name):
+    if self.instrumentation is None:
+      return(contextlib.nullcontext())
+    return(self.instrumentation.phase(name))
+
+  def get_cache_key(self, *parts):
+    return('/'.join([self.aws_account_id, get_region_name(self.session)] + list(parts)))
 
   def get_aws_account_id(self):
     retval = ''
-    client = boto3.client('sts')
+    if self.cache is not None:
+      cache_key = get_credential_key(self.session)
+      retval = self.cache.get(CONST_CACHE_ACCOUNT, cache_key)
+      if retval is not None:
+        return retval
+    client = self.get_client('sts')
     response = client.get_caller_identity()
     retval = response["Account"]
+    if self.cache is not None:
+      self.cache.put(CONST_CACHE_ACCOUNT, cache_key, retval)
     return retval
 
   def get_instance_tag_name(self):
     retval = ''
-    client = boto3.client('ec2')
+    if self.cache is not None:
+      # The Name tag of a group is not the one of an instance with the same value.
+      cache_key = self.get_cache_key(self.dimension_key, self.dimension_value) if self.group_mode \
+                    else self.get_cache_key(self.dimension_value)
+      retval = self.cache.get(CONST_CACHE_TAG_NAME, cache_key)
+      if retval is not None:
+        return retval
+      retval = ''
+    if self.group_mode:
+      retval = describe_group_tag_names(self.get_client('autoscaling'), [self.dimension_value]).get(self.dimension_value, '')
+      if self.cache is not None:
+        self.cache.put(CONST_CACHE_TAG_NAME, cache_key, retval)
+      return retval
+    client = self.get_client('ec2')
     response = client.describe_tags(
       DryRun=False,
       Filters=[
@@ -109,360 +288,164 @@ class ConfigGenerator:
     )
     if len(response["Tags"]) > 0:
       retval = response["Tags"][0]["Value"]
+    if self.cache is not None:
+      self.cache.put(CONST_CACHE_TAG_NAME, cache_key, retval)
     return retval
 
+  def describe_instance_attributes(self):
+    client = self.get_client('ec2')
+    response = client.describe_instances(Filters=[{'Name': 'instance-id', 'Values': [self.dimension_value]}])
+    for reservation in response['Reservations']:
+      for instance in reservation['Instances']:
+        return(dict(get_instance_attributes(instance), platform=self.platform))
+    return({'platform': self.platform})
+
+  # Generator over the alarm-worthy metrics of this dimension. Pages of list_metrics are
+  # fetched lazily and filtered as they arrive, so nothing past NextToken is dropped.
   def get_metrics(self):
-    client = boto3.client('cloudwatch')
+    if self.metric_index is not None:
+      yield from self.metric_index.get_metrics(self.dimension_value)
+      return
+    if self.cache is not None:
+      cache_key = self.get_cache_key(get_filter_key(self.metric_alarms, self.metric_fstype),
+                    "{0}={1}".format(self.dimension_key, self.dimension_value))
+      cached_metrics = self.cache.get(CONST_CACHE_METRICS, cache_key)
+      if cached_metrics is not None:
+        yield from (MetricRecord.from_metric(metric) for metric in cached_metrics)
+        return
+      # Only a fully consumed listing is stored.
+      metrics = []
+    client = self.get_client('cloudwatch')
+    paginator = client.get_paginator('list_metrics')
     param_dimensions = [{'Name': self.dimension_key, 'Value': self.dimension_value}]
-    metrics_data = client.list_metrics(Namespace='CWAgent',
-                      Dimensions=param_dimensions)
-    metrics = metrics_data['Metrics']
-    metrics_data = client.list_metrics(Namespace='AWS/EC2',
-                      Dimensions=param_dimensions)
-    metrics = metrics + metrics_data['Metrics']
-    return_value = []
-    for metric in metrics:
-      metric_name = metric['MetricName']
-      if metric_name in self.metric_alarms:
-        # We need to filter out any metric with fstype not defined in metric_fstype
-        if metric_name == "disk_used_percent" and self.get_dimension_by_name(metric, "fstype") not in self.metric_fstype:
-          continue
-        return_value.append(metric)
-    return(return_value)
+    for namespace in self.metric_namespaces:
+      pages = paginator.paginate(Namespace=namespace, Dimensions=param_dimensions)
+      if self.instrumentation is not None:
+        pages = self.instrumentation.timed(pages, 'list_metrics')
+      for page in pages:
+        for metric in page['Metrics']:
+          metric_record = get_alarm_metric(metric, self.metric_alarms, self.metric_fstype)
+          if metric_record is not None:
+            if self.cache is not None:
+              metrics.append(metric_record.to_metric())
+            yield metric_record
+    if self.cache is not None:
+      self.cache.put(CONST_CACHE_METRICS, cache_key, metrics)
 
   def get_alarm_dimensions(self, metric):
     dimensions = {}
-    metric_dimensions = metric['Dimensions']
-    for metric_dimension in metric_dimensions:
-      dimension_name = metric_dimension['Name']
-      dimension_value = "'{0}'".format(metric_dimension['Value'])
-      dimensions[dimension_name] = dimension_value
+    for dimension_name, dimension_value in metric.get_dimensions():
+      dimensions[dimension_name] = "'{0}'".format(dimension_value)
     return(dimensions)
 
   def get_dimension_by_name(self, metric, dimension_name):
-    return_value = ''
-    metric_dimensions = metric['Dimensions']
-    for dimension in metric_dimensions:
-      if str(dimension['Name']).lower() == dimension_name.lower():
-        return_value = dimension['Value']
-        break
-    return(return_value)
+    return(metric.get_dimension(dimension_name))
 
-  # This is for Linux
-  def get_alarm_disk_used_percent(self, metric, in_alarm_action='', ok_alarm_action='', critical_level='warning', critical_threshold='80'):
-    return_value = {}
-    return_value['comparison_operator'] = 'GreaterThanThreshold'
-    return_value['datapoints_to_alarm'] = '2'
-    return_value['evaluation_period'] = '3'
-    return_value['period'] = '60'
-    path = self.get_dimension_by_name(metric, "path")
-    return_value['alarm_description'] = "'[{0}] AWS [{5}][{6}] high disk usage on [{4}] {1}:{2} on path {3}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,
-        path,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['alarm_name'] = "'[{0}] AWS [{5}][{6}] high disk usage on [{4}] {1}:{2} on path {3}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,
-        path,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['threshold'] = critical_threshold
-    return_value['actions_enabled'] = True
-    return_value['alarm_actions'] = [in_alarm_action]
-    return_value['ok_actions'] = [ok_alarm_action]
-    return_value['metric_name'] = metric['MetricName']
-    return_value['statistic'] = 'Average'
-    return_value['namespace'] = CONST_CWAGENT_NAMESPACE
-    return_value['dimensions'] = self.get_alarm_dimensions(metric)
-    return(return_value)
+  # The template fields shared by every alarm of this generator.
+  def get_alarm_context(self):
+    return({
+      'key': self.dimension_key,
+      'value': self.dimension_value,
+      'tag_name': self.instance_tag_name,
+      'account_id': self.aws_account_id,
+      'account_name': self.aws_account_name
+    })
 
-  # This is for Windows
-  def get_alarm_disk_free_percent(self, metric, in_alarm_action='', ok_alarm_action='', critical_level='warning', critical_threshold='10'):
+  # Build one alarm for metric from rule at the given severity level.
+  def get_alarm(self, rule, metric, context, level, in_alarm_action, ok_alarm_action, threshold):
+    metric_name = metric.metric_name
+    name_context = dict(context, level=level, metric_name=metric_name)
+    for field, dimension_name in rule.dimension_fields.items():
+      name_context[field] = metric.get_dimension(dimension_name)
+    alarm_name = rule.format_name(name_context)
     return_value = {}
-    return_value['comparison_operator'] = 'LessThanThreshold'
-    return_value['datapoints_to_alarm'] = '2'
-    return_value['evaluation_period'] = '3'
-    return_value['period'] = '60'
-    drive_instance = self.get_dimension_by_name(metric, "instance")
-    return_value['alarm_description'] = "'[{0}] AWS [{5}][{6}] high disk usage on [{4}] {1}:{2} on path {3}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,
-        drive_instance,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['alarm_name'] = "'[{0}] AWS [{5}][{6}] high disk usage on [{4}] {1}:{2} on path {3}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,
-        drive_instance,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['threshold'] = critical_threshold  # Default value is '10'
+    return_value['comparison_operator'] = rule.comparison_operator
+    return_value['datapoints_to_alarm'] = rule.datapoints_to_alarm
+    return_value['evaluation_period'] = rule.evaluation_period
+    return_value['period'] = rule.period
+    return_value['alarm_description'] = alarm_name
+    return_value['alarm_name'] = alarm_name
+    return_value['threshold'] = threshold
     return_value['actions_enabled'] = True
-    return_value['alarm_actions'] = [in_alarm_action]
+    # A group alarm is not about one instance to recover.
+    if metric_name in rule.recover_metrics and self.use_recover and not self.group_mode:
+      return_value['alarm_actions'] = [in_alarm_action, CONST_RECOVER_ACTION]
+    else:
+      return_value['alarm_actions'] = [in_alarm_action]
     return_value['ok_actions'] = [ok_alarm_action]
-    return_value['metric_name'] = metric['MetricName']
-    return_value['statistic'] = 'Average'
-    return_value['namespace'] = CONST_CWAGENT_NAMESPACE
+    return_value['metric_name'] = metric_name
+    return_value['statistic'] = rule.statistic
+    return_value['namespace'] = rule.namespace
     return_value['dimensions'] = self.get_alarm_dimensions(metric)
+    return_value['name'] = get_alarm_logical_id(rule.namespace, metric, level)
+    if getattr(metric, 'member_dimension_names', None) is not None:
+      return_value['expression'] = get_group_query(rule, metric)
     return(return_value)
 
-  def get_alarm_mem_used_percent(self, metric, in_alarm_action='', ok_alarm_action='', critical_level='warning', critical_threshold='95'):
-    return_value = {}
-    return_value['comparison_operator'] = 'GreaterThanThreshold'
-    return_value['datapoints_to_alarm'] = '2'
-    return_value['evaluation_period'] = '3'
-    return_value['period'] = '60'
-    return_value['alarm_description'] = "'[{0}] AWS [{4}][{5}] high memory usage on [{3}] {1}:{2}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['alarm_name'] = "'[{0}] AWS [{4}][{5}] high memory usage on [{3}] {1}:{2}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['threshold'] = critical_threshold
-    return_value['actions_enabled'] = True
-    return_value['alarm_actions'] = [in_alarm_action]
-    return_value['ok_actions'] = [ok_alarm_action]
-    return_value['metric_name'] = metric['MetricName']
-    return_value['statistic'] = 'Average'
-    return_value['namespace'] = CONST_CWAGENT_NAMESPACE
-    return_value['dimensions'] = self.get_alarm_dimensions(metric)
-    return(return_value)
+  # The AlarmRule of metric, or None when it is not alarmed on.
+  def get_alarm_rule(self, metric):
+    rule = self.alarm_rules.get(metric.metric_name)
+    if rule is None or not self.alert_config[rule.config_key]['enabled']:
+      return(None)
+    for dimension_name in rule.skip_dimensions:
+      if metric.get_dimension(dimension_name) != '':
+        return(None)
+    return(rule)
 
-  def get_alarm_cpu_utilization(self, metric, in_alarm_action='', ok_alarm_action='', critical_level='warning', critical_threshold='85'):
-    return_value = {}
-    return_value['comparison_operator'] = 'GreaterThanThreshold'
-    return_value['datapoints_to_alarm'] = '5'
-    return_value['evaluation_period'] = '5'
-    return_value['period'] = '60'
-    return_value['alarm_description'] = "'[{0}] AWS [{4}][{5}] high CPU Utilization on [{3}] {1}:{2}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['alarm_name'] = "'[{0}] AWS [{4}][{5}] high CPU Utilization on [{3}] {1}:{2}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['threshold'] = critical_threshold
-    return_value['actions_enabled'] = True
-    return_value['alarm_actions'] = [in_alarm_action]
-    return_value['ok_actions'] = [ok_alarm_action]
-    return_value['metric_name'] = metric['MetricName']
-    return_value['statistic'] = 'Average'
-    return_value['namespace'] = CONST_AWSEC2_NAMESPACE
-    return_value['dimensions'] = self.get_alarm_dimensions(metric)
-    return(return_value)
+  # All the alarms of one metric, one per severity level of its rule.
+  def get_alarms(self, metric, context):
+    rule = self.get_alarm_rule(metric)
+    if rule is None:
+      return([])
+    alarms = []
+    for level, level_name, threshold_key in rule.severities:
+      threshold = rule.threshold if rule.threshold is not None else self.alert_config[rule.config_key][threshold_key]
+      alarms.append(self.get_alarm(rule, metric, context, level_name,
+                      getattr(self, "in_alarm_action_{0}".format(level)),
+                      getattr(self, "ok_alarm_action_{0}".format(level)),
+                      threshold))
+    return(alarms)
 
-  def get_alarm_cpu_credit_balance(self, metric, in_alarm_action='', ok_alarm_action='', critical_level='warning', critical_threshold='500'):
-    return_value = {}
-    return_value['comparison_operator'] = 'LessThanOrEqualToThreshold'
-    return_value['datapoints_to_alarm'] = '5'
-    return_value['evaluation_period'] = '5'
-    return_value['period'] = '60'
-    return_value['alarm_description'] = "'[{0}] AWS [{4}][{5}] low CPU credit balance on [{3}] {1}:{2}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['alarm_name'] = "'[{0}] AWS [{4}][{5}] low CPU credit balance on [{3}] {1}:{2}'".format(
-        critical_level.upper(),
-        self.dimension_key,
-        self.dimension_value,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['threshold'] = critical_threshold
-    return_value['actions_enabled'] = True
-    return_value['alarm_actions'] = [in_alarm_action]
-    return_value['ok_actions'] = [ok_alarm_action]
-    return_value['metric_name'] = metric['MetricName']
-    return_value['statistic'] = 'Average'
-    return_value['namespace'] = CONST_AWSEC2_NAMESPACE
-    return_value['dimensions'] = self.get_alarm_dimensions(metric)
-    return(return_value)
+  # Generator over the alarms of metrics, each logical ID once. A metric listed twice would
+  # give two resources the same logical ID.
+  def iter_alarms(self, metrics):
+    logical_ids = set()
+    context = self.get_alarm_context()
+    if self.group_mode:
+      metrics = get_group_metrics(metric for metric in metrics if self.get_alarm_rule(metric) is not None)
+    metric_count = 0
+    alarm_count = 0
+    for metric in metrics:
+      metric_count += 1
+      with self.phase('render'):
+        alarms = []
+        for alarm_data in self.get_alarms(metric, context):
+          if alarm_data['name'] in logical_ids:
+            continue
+          logical_ids.add(alarm_data['name'])
+          alarms.append(alarm_data)
+      alarm_count += len(alarms)
+      yield from alarms
+    if self.instrumentation is not None:
+      self.instrumentation.add_items('metrics', metric_count)
+      self.instrumentation.add_items('alarms', alarm_count)
 
-  def get_alarm_status_check_failed(self, metric, in_alarm_action='', ok_alarm_action='', use_recover=False):
-    return_value = {}
-    return_value['comparison_operator'] = 'GreaterThanThreshold'
-    return_value['datapoints_to_alarm'] = '2'
-    return_value['evaluation_period'] = '2'
-    return_value['period'] = '60'
-    return_value['alarm_description'] = "'[CRITICAL] {0} AWS [{4}][{5}] on [{3}] {1}:{2}'".format(
-        metric['MetricName'],
-        self.dimension_key,
-        self.dimension_value,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['alarm_name'] = "'[CRITICAL] {0} AWS [{4}][{5}] on [{3}] {1}:{2}'".format(
-        metric['MetricName'],
-        self.dimension_key,
-        self.dimension_value,
-        self.instance_tag_name,
-        self.aws_account_id,
-        self.aws_account_name)
-    return_value['threshold'] = '2'
-    return_value['actions_enabled'] = True
-    if metric['MetricName'] == 'StatusCheckFailed_System' and use_recover:
-      return_value['alarm_actions'] = [in_alarm_action, '!Sub "arn:aws:automate:${AWS::Region}:ec2:recover"']
-    else:
-      return_value['alarm_actions'] = [in_alarm_action]
-    return_value['ok_actions'] = [ok_alarm_action]
-    return_value['metric_name'] = metric['MetricName']
-    return_value['statistic'] = 'Average'
-    return_value['namespace'] = CONST_AWSEC2_NAMESPACE
-    return_value['dimensions'] = self.get_alarm_dimensions(metric)
-    return(return_value)
+  def get_alarm_list(self, metrics):
+    return(list(self.iter_alarms(metrics)))
+
+  def get_template_description(self):
+    return("CloudWatch alarms for [{0}] {1}:{2}".format(self.instance_tag_name, self.dimension_key, self.dimension_value))
 
+  # The alarms are written as they are rendered, the whole list is never held.
   def generate_yaml(self, metrics):
-    parsed_data = []
-    ii = 0
-    prefix_name = 'alarm'
-    for metric in metrics:
-      metric_name = metric['MetricName']
-      alarm_data = {}
-      if metric_name == 'disk_used_percent' \
-        and self.alert_config['disk_used_percent']['enabled']:
-        critical_alarm_data = self.get_alarm_disk_used_percent(metric,
-                              self.in_alarm_action_critical,
-                              self.ok_alarm_action_critical,
-                              'critical',
-                              self.alert_config['disk_used_percent']['critical_threshold'])
-        critical_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-        ii += 1
-        parsed_data.append(critical_alarm_data)
-        warning_alarm_data = self.get_alarm_disk_used_percent(metric,
-                              self.in_alarm_action_warning,
-                              self.ok_alarm_action_warning,
-                              'warning',
-                              self.alert_config['disk_used_percent']['warning_threshold'])
-        warning_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-        ii += 1
-        parsed_data.append(warning_alarm_data)
-      elif metric_name == 'LogicalDisk % Free Space' \
-        and self.alert_config['disk_free_percent']['enabled']:
-          critical_alarm_data = self.get_alarm_disk_free_percent(metric,
-                                  self.in_alarm_action_critical,
-                                  self.ok_alarm_action_critical,
-                                  'critical',
-                                  self.alert_config['disk_free_percent']['critical_threshold'])
-          critical_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(critical_alarm_data)
-          warning_alarm_data = self.get_alarm_disk_free_percent(metric, 
-                                  self.in_alarm_action_warning,
-                                  self.ok_alarm_action_warning,
-                                  'warning',
-                                  self.alert_config['disk_free_percent']['warning_threshold'])
-          warning_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(warning_alarm_data)
-      elif metric_name == 'mem_used_percent' \
-        and self.alert_config['mem_used_percent']['enabled']:
-          # Filter out the metric with ImageId + InstanceType dimensions.
-          if self.get_dimension_by_name(metric, 'ImageId') == '':
-            critical_alarm_data = self.get_alarm_mem_used_percent(metric,
-                                  self.in_alarm_action_critical,
-                                  self.ok_alarm_action_critical,
-                                  'critical',
-                                  self.alert_config['mem_used_percent']['critical_threshold'])
-            critical_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-            ii += 1
-            parsed_data.append(critical_alarm_data)
-            warning_alarm_data = self.get_alarm_mem_used_percent(metric,
-                                  self.in_alarm_action_warning,
-                                  self.ok_alarm_action_warning,
-                                  'warning',
-                                  self.alert_config['mem_used_percent']['warning_threshold'])
-            warning_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-            ii += 1
-            parsed_data.append(warning_alarm_data)
-      elif metric_name == 'Memory % Committed Bytes In Use' \
-        and self.alert_config['mem_used_percent']['enabled']:
-          critical_alarm_data = self.get_alarm_mem_used_percent(metric,
-                                  self.in_alarm_action_critical,
-                                  self.ok_alarm_action_critical,
-                                  'critical',
-                                  self.alert_config['mem_used_percent']['critical_threshold'])
-          critical_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(critical_alarm_data)
-          warning_alarm_data = self.get_alarm_mem_used_percent(metric,
-                                    self.in_alarm_action_warning,
-                                    self.ok_alarm_action_warning,
-                                    'warning',
-                                    self.alert_config['mem_used_percent']['warning_threshold'])
-          warning_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(warning_alarm_data)
-      elif metric_name == 'CPUUtilization' \
-        and self.alert_config['cpu_utilization']['enabled']:
-          critical_alarm_data = self.get_alarm_cpu_utilization(metric,
-                                self.in_alarm_action_critical,
-                                self.ok_alarm_action_critical,
-                                'critical',
-                                self.alert_config['cpu_utilization']['critical_threshold'])
-          critical_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(critical_alarm_data)
-          warning_alarm_data = self.get_alarm_cpu_utilization(metric,
-                                self.in_alarm_action_warning,
-                                self.ok_alarm_action_warning,
-                                'warning',
-                                self.alert_config['cpu_utilization']['warning_threshold'])
-          warning_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(warning_alarm_data)
-      elif metric_name == 'CPUCreditBalance' \
-        and self.alert_config['cpu_credit_balance']['enabled']:
-          critical_alarm_data = self.get_alarm_cpu_credit_balance(metric,
-                                self.in_alarm_action_critical,
-                                self.ok_alarm_action_critical,
-                                'critical',
-                                self.alert_config['cpu_credit_balance']['critical_threshold'])
-          critical_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(critical_alarm_data)
-          warning_alarm_data = self.get_alarm_cpu_credit_balance(metric,
-                                self.in_alarm_action_warning,
-                                self.ok_alarm_action_warning,
-                                'warning',
-                                self.alert_config['cpu_credit_balance']['warning_threshold'])
-          warning_alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(warning_alarm_data)
-      elif metric_name in ['StatusCheckFailed', 'StatusCheckFailed_Instance', 'StatusCheckFailed_System'] \
-        and self.alert_config['status_check_failed']['enabled']:
-          alarm_data = self.get_alarm_status_check_failed(metric,
-                                self.in_alarm_action_critical,
-                                self.ok_alarm_action_critical,
-                                self.use_recover)
-          alarm_data['name'] = "{0}{1:03d}".format(prefix_name, ii)
-          ii += 1
-          parsed_data.append(alarm_data)
-    with open(self.output_file, 'a') as file:
-      outputs = yaml.dump(parsed_data, file)
+    return(self.write_alarms(self.iter_alarms(metrics)))
 
+  # Returns the files written, more than output_file when the output is sharded.
+  def write_alarms(self, alarms):
+    description = self.get_template_description() if self.output_format != CONST_FORMAT_SCEPTRE else ''
+    with ShardedAlarmWriter(self.output_file, self.output_format, description,
+            self.max_alarms_per_file, self.max_file_bytes, self.shard_dimension) as writer:
+      for alarm_data in alarms:
+        with self.phase('serialize'):
+          writer.write(alarm_data)
+    return(writer.output_files)
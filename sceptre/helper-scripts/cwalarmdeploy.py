@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+from accountorchestrator import load_accounts
+from alarmreconciler import AlarmReconciler, get_alarm_name_prefixes
+from clientpool import add_client_pool_arguments, get_client_pool
+from configgenerator import load_manifest
+from deploystate import CONST_DEFAULT_STATE_FILE, DeployState, generate_changed, get_state_key
+from discoverycache import get_region_name
+from fleetgenerator import CONST_DESCRIBE_INSTANCES_BATCH
+from generatorclasses import CONST_GENERATOR_CLASSES
+from manifestcompiler import get_instance_attributes
+
+CONST_UNKNOWN_ACCOUNT_NAME = 'UNKNOWN_AWS_ACCOUNT'
+CONST_CWALARM_YAML = 'sceptre/generated-config/ec2instance.yaml'
+CONST_TEMPLATE_CONFIG_PATH = 'sceptre/helper-templates/cwalarm-config-template.yaml'
+CONST_SCEPTRE_CONFIG_DIR = 'sceptre/config'
+CONST_DEPLOY_SCRIPT = './deploy-cfn-nodocker.sh'
+CONST_ACTION_DESTROY = 'destroy'
+# Applied with the CloudWatch API instead of a stack, plan only reports the differences.
+CONST_RECONCILE_ACTIONS = ['reconcile', 'plan']
+
+# The running instance of every Name, one describe_instances call per 200 names instead of
+# the two per instance of the AWS CLI lookups. The first instance wins when names repeat.
+def describe_named_instances(client, instance_names):
+  instances = {}
+  paginator = client.get_paginator('describe_instances')
+  for ii in range(0, len(instance_names), CONST_DESCRIBE_INSTANCES_BATCH):
+    batch = instance_names[ii:ii + CONST_DESCRIBE_INSTANCES_BATCH]
+    filters = [{'Name': 'tag:Name', 'Values': batch}, {'Name': 'instance-state-name', 'Values': ['running']}]
+    for page in paginator.paginate(Filters=filters):
+      for reservation in page['Reservations']:
+        for instance in reservation['Instances']:
+          instances.setdefault(get_instance_attributes(instance)['tags'].get('Name', ''), instance)
+  return(instances)
+
+def get_account_name(accounts_file, aws_account_id):
+  for account in load_accounts(accounts_file):
+    if account['Id'] == aws_account_id:
+      return(account.get('Name', CONST_UNKNOWN_ACCOUNT_NAME))
+  return(CONST_UNKNOWN_ACCOUNT_NAME)
+
+def get_stack_output(client, stack_name, output_key):
+  for stack in client.describe_stacks(StackName=stack_name)['Stacks']:
+    for output in stack.get('Outputs', []):
+      if output['OutputKey'] == output_key:
+        return(output['OutputValue'])
+  raise ValueError("stack {0} has no output {1}".format(stack_name, output_key))
+
+# The sceptre stack of an instance, like deploy-cwalarm.sh: its Name without non-word characters.
+def get_sceptre_item(instance_name):
+  return("cwalarm/{0}.yaml".format(re.sub(r'\W', '', instance_name)))
+
+# What deploy-cwalarm.sh did with a fresh virtualenv, five AWS CLI processes and the generator
+# for every instance, in one process: the account, the SNS topic and the manifests are resolved
+# once, the instances are described in bulk and every generator gets them injected, so only
+# list_metrics is left per instance. The stacks are still deployed by deploy-cfn-nodocker.sh.
+class DeployDriver:
+  def __init__(self,
+                session,
+                action,
+                sns_topic_arn,
+                manifest_yaml_file=None,
+                accounts_file='accounts.json',
+                use_recover='false',
+                deploy_state=None,
+                force=False,
+                deploy_script=CONST_DEPLOY_SCRIPT) -> None:
+      self.session = session
+      self.action = action
+      self.sns_topic_arn = sns_topic_arn
+      self.manifest_yaml_file = manifest_yaml_file
+      self.manifest = load_manifest(manifest_yaml_file)
+      self.use_recover = use_recover
+      self.deploy_state = deploy_state
+      # Deploy even when the alarms did not change since the last deploy.
+      self.force = force
+      self.deploy_script = deploy_script
+      self.region_name = get_region_name(session)
+      self.aws_account_id = session.client('sts').get_caller_identity()['Account']
+      self.aws_account_name = get_account_name(accounts_file, self.aws_account_id)
+
+  def get_config_generator(self, instance, output_file):
+    instance_attributes = get_instance_attributes(instance)
+    platform = instance_attributes['platform']
+    print("platform of {0} is [{1}]".format(instance['InstanceId'], platform))
+    return(CONST_GENERATOR_CLASSES[platform](
+            'InstanceId', instance['InstanceId'],
+            output_file,
+            self.sns_topic_arn, self.sns_topic_arn, '', '',
+            self.use_recover, self.aws_account_name,
+            self.manifest_yaml_file,
+            self.aws_account_id,
+            session=self.session,
+            instance_tag_name=instance_attributes['tags'].get('Name', ''),
+            manifest=self.manifest,
+            instance_attributes=instance_attributes))
+
+  def run_deploy_script(self, action, sceptre_item):
+    subprocess.run([self.deploy_script, '-e', "aws_region={0}".format(self.region_name), '-n', action, '-i', sceptre_item],
+      check=True)
+
+  def reconcile(self, config_generator):
+    alarms = config_generator.get_alarm_list(config_generator.get_metrics())
+    alarm_reconciler = AlarmReconciler(config_generator.dimension_key, [config_generator.dimension_value],
+                          get_alarm_name_prefixes(config_generator.alarm_rules), self.session)
+    alarm_reconciler.reconcile(alarms, self.action == 'plan')
+
+  def deploy(self, instance_name, instance):
+    sceptre_item = get_sceptre_item(instance_name)
+    sceptre_config_path = os.path.join(CONST_SCEPTRE_CONFIG_DIR, sceptre_item)
+    config_generator = self.get_config_generator(instance, CONST_CWALARM_YAML)
+    if self.action in CONST_RECONCILE_ACTIONS:
+      self.reconcile(config_generator)
+      return
+    skip_unchanged = self.action != CONST_ACTION_DESTROY and not self.force
+    if not generate_changed(config_generator, config_generator.get_metrics(), self.deploy_state, skip_unchanged,
+              self.manifest_yaml_file):
+      print("Alarms of {0} unchanged since the last deploy, use --force to deploy anyway".format(instance_name))
+      return
+    os.makedirs(os.path.dirname(sceptre_config_path), exist_ok=True)
+    print("cp '{0}' '{1}'".format(CONST_TEMPLATE_CONFIG_PATH, sceptre_config_path))
+    shutil.copyfile(CONST_TEMPLATE_CONFIG_PATH, sceptre_config_path)
+    # Remove the old CloudFormation stack if exists
+    self.run_deploy_script(CONST_ACTION_DESTROY, sceptre_item)
+    state_key = get_state_key(self.aws_account_id, self.session, 'InstanceId', instance['InstanceId'])
+    if self.action != CONST_ACTION_DESTROY:
+      self.run_deploy_script(self.action, sceptre_item)
+      self.deploy_state.mark_deployed(state_key)
+    else:
+      self.deploy_state.forget(state_key)
+
+  # Returns instance name -> exception, a name without a running instance included.
+  def run(self, instance_names):
+    errors = {}
+    instances = describe_named_instances(self.session.client('ec2'), instance_names)
+    for instance_name in instance_names:
+      try:
+        if instance_name not in instances:
+          raise ValueError("no running instance is named {0}".format(instance_name))
+        self.deploy(instance_name, instances[instance_name])
+      except Exception as exc:
+        errors[instance_name] = exc
+        print("failed to deploy {0}: {1}".format(instance_name, exc))
+      finally:
+        # Saved after every instance, a failure later on keeps the deploys done so far.
+        if self.deploy_state is not None and self.action not in CONST_RECONCILE_ACTIONS:
+          self.deploy_state.save()
+    return(errors)
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Generate and deploy the CloudWatch alarms of instances by Name")
+  parser.add_argument('-i', '--instance-name', dest='instance_names', action='append', required=True,
+                    help='The Name tag of the instance. Can be repeated')
+  parser.add_argument('-n', '--action', dest='action', required=True,
+                    help='deploy or destroy the stacks, or reconcile or plan the alarms without a stack')
+  parser.add_argument('-sta', '--sns-topic-arn', dest='sns_topic_arn', default='',
+                    help='The SNS topic ARN of the alarm actions')
+  parser.add_argument('-t', '--sns-topic-cfn-name', dest='sns_topic_cfn_name',
+                    help='Without --sns-topic-arn, the CloudFormation stack with the SNS topic ARN')
+  parser.add_argument('-o', '--sns-topic-output-name', dest='sns_topic_output_name',
+                    help='Without --sns-topic-arn, the stack output with the SNS topic ARN')
+  parser.add_argument('-m', '--cwalarm-manifest', dest='manifest', action='append',
+                    help='The path to manifest YAML. Can be repeated, a later manifest overrides an earlier one')
+  parser.add_argument('-r', dest='userecover', default='false',
+                    help='Add the EC2 recover action to the status check alarms')
+  parser.add_argument('-f', '--force', dest='force', action='store_true',
+                    help='Deploy even when the alarms did not change since the last deploy')
+  parser.add_argument('--accounts-file', dest='accounts_file', default='accounts.json',
+                    help='The accounts file the account name is looked up in, see accounts.json.example')
+  parser.add_argument('--state-file', dest='state_file', default=CONST_DEFAULT_STATE_FILE,
+                    help='The deploy state file')
+  parser.add_argument('--deploy-script', dest='deploy_script', default=CONST_DEPLOY_SCRIPT,
+                    help='The script deploying one sceptre stack')
+  parser.add_argument('--profile', dest='profile',
+                    help='The AWS profile, defaults to the credentials of the environment')
+  add_client_pool_arguments(parser)
+
+  args = parser.parse_args()
+  if not args.sns_topic_arn and not (args.sns_topic_cfn_name and args.sns_topic_output_name):
+    parser.error('--sns-topic-arn, or --sns-topic-cfn-name with --sns-topic-output-name, is required')
+  # Imported after parsing, boto3 is slow to import and --help does not need it.
+  import boto3
+  session = get_client_pool(args, session=boto3.session.Session(profile_name=args.profile))
+  # deploy-cfn-nodocker.sh gets the region on its command line, it cannot fall back to a default.
+  if not get_region_name(session):
+    parser.error('no AWS region is configured, set AWS_DEFAULT_REGION or the region of --profile')
+  sns_topic_arn = args.sns_topic_arn or \
+    get_stack_output(session.client('cloudformation'), args.sns_topic_cfn_name, args.sns_topic_output_name)
+  deploy_driver = DeployDriver(
+                    session,
+                    args.action,
+                    sns_topic_arn,
+                    args.manifest,
+                    args.accounts_file,
+                    args.userecover,
+                    DeployState(args.state_file),
+                    args.force,
+                    args.deploy_script)
+  errors = deploy_driver.run(list(dict.fromkeys(args.instance_names)))
+  sys.exit(0 if len(errors) == 0 else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,55 @@
 #!/usr/bin/env python3
 
 import argparse
+import sys
 
+from alarmreconciler import add_reconcile_arguments, run_reconcile
+from alarmwriter import add_output_arguments
+from cfntemplate import CONST_FORMAT_SCEPTRE, CONST_OUTPUT_FORMATS
+from clientpool import add_client_pool_arguments, get_client_pool
 from configgenerator import ConfigGenerator
+from deploystate import add_state_arguments, run_generate_changed
+from discoverycache import add_cache_arguments, get_cache
+from fleetgenerator import add_fleet_arguments, is_fleet_mode, run_fleet
+from groupalarms import CONST_GROUP_DIMENSION, add_group_arguments
+from instrumentation import add_instrumentation_arguments, instrumented
+from thresholdtuner import add_tune_arguments, run_tune
 
 class WindowsConfigGenerator(ConfigGenerator):
-  def __init__(self,
-                key,
-                value,
-                output,
-                in_alarm_warning,
-                ok_alarm_warning,
-                in_alarm_critical,
-                ok_alarm_critical,
-                use_recover='false',
-                aws_account_alias='unknown account',
-                manifest_yaml_file='') -> None:
-      super().__init__(key,
-                      value,
-                      output,
-                      in_alarm_warning,
-                      ok_alarm_warning,
-                      in_alarm_critical,
-                      ok_alarm_critical,
-                      use_recover,
-                      aws_account_alias,
-                      manifest_yaml_file)
-      self.alert_config = {
-        'disk_free_percent' : {
-          'enabled': True,
-          'warning_threshold': '10',
-          'critical_threshold': '5'
-        },
-        'mem_used_percent' : {
-          'enabled': True,
-          'warning_threshold': '90',
-          'critical_threshold': '99'
-        },
-        'cpu_utilization' : {
-          'enabled': True,
-          'warning_threshold': '85',
-          'critical_threshold': '99'
-        },
-        'cpu_credit_balance' : {
-          'enabled': True,
-          'warning_threshold': '500',
-          'critical_threshold': '100'
-        },
-        'status_check_failed' : {
-          'enabled': True
-        }
-      }
-      # Call this again to override values from manifest file.
-      self.load_manifest(manifest_yaml_file)
-      self.metric_alarms = ['LogicalDisk % Free Space',
-                      'Memory % Committed Bytes In Use',
-                      'CPUCreditBalance',
-                      'CPUUtilization',
-                      'StatusCheckFailed',
-                      'StatusCheckFailed_Instance',
-                      'StatusCheckFailed_System']
+  platform = 'windows'
+  default_metric_alarms = ['LogicalDisk % Free Space',
+                  'Memory % Committed Bytes In Use',
+                  'CPUCreditBalance',
+                  'CPUUtilization',
+                  'StatusCheckFailed',
+                  'StatusCheckFailed_Instance',
+                  'StatusCheckFailed_System']
+  default_alert_config = {
+    'disk_free_percent' : {
+      'enabled': True,
+      'warning_threshold': '10',
+      'critical_threshold': '5'
+    },
+    'mem_used_percent' : {
+      'enabled': True,
+      'warning_threshold': '90',
+      'critical_threshold': '99'
+    },
+    'cpu_utilization' : {
+      'enabled': True,
+      'warning_threshold': '85',
+      'critical_threshold': '99'
+    },
+    'cpu_credit_balance' : {
+      'enabled': True,
+      'warning_threshold': '500',
+      'critical_threshold': '100'
+    },
+    'status_check_failed' : {
+      'enabled': True
+    }
+  }
 
-      
 def main():
 
   parser = argparse.ArgumentParser(description="Generate YAML for sceptre_user_data")
@@ -83,19 +71,61 @@ def main():
                     help='The ARN for OK action for [CRITICAL]')
   parser.add_argument('-a', dest='account_alias', default='unknown account',
                     help='The AWS account name/alias')
-  parser.add_argument('-m', dest='manifest', help='The path to manifest YAML')
+  parser.add_argument('-m', dest='manifest', action='append',
+                    help='The path to manifest YAML. Can be repeated, a later manifest overrides an earlier one')
+  parser.add_argument('-f', '--format', dest='output_format', default=CONST_FORMAT_SCEPTRE, choices=CONST_OUTPUT_FORMATS,
+                    help='The output format, sceptre_user_data YAML or a CloudFormation template')
+  add_output_arguments(parser)
+  add_fleet_arguments(parser)
+  add_cache_arguments(parser)
+  add_reconcile_arguments(parser)
+  add_state_arguments(parser)
+  add_tune_arguments(parser)
+  add_group_arguments(parser)
+  add_client_pool_arguments(parser)
+  add_instrumentation_arguments(parser)
 
   args = parser.parse_args()
-  config_generator = WindowsConfigGenerator(
-                      args.key, args.value,
-                      args.output,
-                      args.in_alarm_warning, args.ok_alarm_warning,
-                      args.in_alarm_critical, args.ok_alarm_critical,
-                      args.userecover, args.account_alias,
-                      args.manifest)
+  if args.group_mode and args.key != CONST_GROUP_DIMENSION:
+    parser.error("--group-mode needs -k {0}".format(CONST_GROUP_DIMENSION))
+  if args.group_mode and args.output_format == CONST_FORMAT_SCEPTRE and not args.reconcile:
+    parser.error('--group-mode alarms on Metrics Insights queries, which the sceptre_user_data template does not support, '
+      'use -f cfn-yaml, -f cfn-json or --reconcile')
+  with instrumented(args) as instrumentation:
+    if is_fleet_mode(args):
+      if args.reconcile:
+        parser.error('--reconcile applies the alarms of one dimension value, not fleet mode')
+      if args.max_alarms_per_file or args.max_file_bytes or args.shard_dimension:
+        parser.error('--max-alarms-per-file, --max-file-bytes and --shard-by split the output of one dimension value, not fleet mode')
+      sys.exit(run_fleet(WindowsConfigGenerator, args, instrumentation))
 
-  metrics = config_generator.get_metrics()
-  config_generator.generate_yaml(metrics)
+    config_generator = WindowsConfigGenerator(
+                        args.key, args.value,
+                        args.output,
+                        args.in_alarm_warning, args.ok_alarm_warning,
+                        args.in_alarm_critical, args.ok_alarm_critical,
+                        args.userecover, args.account_alias,
+                        args.manifest,
+                        session=get_client_pool(args, instrumentation),
+                        cache=get_cache(args),
+                        output_format=args.output_format,
+                        instrumentation=instrumentation)
+    config_generator.max_alarms_per_file = args.max_alarms_per_file
+    config_generator.max_file_bytes = args.max_file_bytes
+    config_generator.shard_dimension = args.shard_dimension
+    config_generator.group_mode = args.group_mode
+
+    if args.reconcile:
+      sys.exit(run_reconcile(config_generator, args))
+
+    if args.tune_manifest:
+      sys.exit(run_tune(config_generator, args))
+
+    if args.state_file:
+      sys.exit(run_generate_changed(config_generator, args))
+
+    metrics = config_generator.get_metrics()
+    config_generator.generate_yaml(metrics)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from discoverycache import get_region_name
+from manifestcompiler import get_manifest_files
+
+CONST_DEFAULT_STATE_FILE = 'sceptre/generated-config/deploy-state.json'
+# The exit status of a generator that skipped an instance whose alarms did not change.
+CONST_EXIT_UNCHANGED = 3
+
+# A canonical digest of the rendered alarms and the manifests that produced them, the
+# alarms are sorted by logical ID so the list_metrics order does not matter.
+def get_alarm_digest(alarms, manifest_yaml_file='', output_format=''):
+  digest = hashlib.sha256()
+  canonical_alarms = sorted(alarms, key=lambda alarm_data: alarm_data['name'])
+  digest.update(json.dumps([output_format, canonical_alarms], sort_keys=True, separators=(',', ':')).encode('utf-8'))
+  for manifest_file in get_manifest_files(manifest_yaml_file):
+    if os.path.exists(manifest_file):
+      with open(manifest_file, 'rb') as file:
+        digest.update(file.read())
+  return(digest.hexdigest())
+
+def get_state_key(aws_account_id, session, key, value):
+  return("{0}/{1}/{2}={3}".format(aws_account_id, get_region_name(session), key, value))
+
+# The digest of the last deployed alarms of every instance. A generator records the digest
+# it rendered as pending, and the deploy marks it deployed once the stack is up, so a failed
+# deploy is retried on the next run.
+class DeployState:
+  def __init__(self, state_file=CONST_DEFAULT_STATE_FILE) -> None:
+      self.state_file = state_file
+      self.entries = {}
+      self.lock = threading.Lock()
+      if os.path.exists(state_file):
+        with open(state_file, 'r') as file:
+          self.entries = json.load(file).get('entries', {})
+
+  def is_changed(self, state_key, digest):
+    with self.lock:
+      return(self.entries.get(state_key, {}).get('deployed') != digest)
+
+  def set_pending(self, state_key, digest):
+    with self.lock:
+      self.entries.setdefault(state_key, {})['pending'] = digest
+
+  # The state keys ending with /KEY=VALUE, the shell scripts do not know the account ID.
+  def find_keys(self, dimension):
+    with self.lock:
+      return([state_key for state_key in self.entries if state_key.endswith("/{0}".format(dimension))])
+
+  def mark_deployed(self, state_key):
+    with self.lock:
+      entry = self.entries.get(state_key, {})
+      if 'pending' in entry:
+        entry['deployed'] = entry.pop('pending')
+
+  def forget(self, state_key):
+    with self.lock:
+      self.entries.pop(state_key, None)
+
+  def save(self):
+    with self.lock:
+      os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+      with open(self.state_file + '.tmp', 'w') as file:
+        json.dump({'entries': self.entries}, file, indent=2, sort_keys=True)
+      os.replace(self.state_file + '.tmp', self.state_file)
+
+def add_state_arguments(parser):
+  parser.add_argument('--state-file', dest='state_file',
+                    help='Record the digest of the rendered alarms in this deploy state file')
+  parser.add_argument('--skip-unchanged', dest='skip_unchanged', action='store_true',
+                    help="With --state-file, do not write the output of an instance whose alarms and manifest "
+                    "did not change since its last deploy, exit {0} when nothing changed".format(CONST_EXIT_UNCHANGED))
+
+def get_deploy_state(args):
+  if not args.state_file:
+    return(None)
+  return(DeployState(args.state_file))
+
+# Render the alarms of one generator, returns False when they are unchanged and skipped.
+def generate_changed(config_generator, metrics, deploy_state, skip_unchanged, manifest_yaml_file):
+  alarms = config_generator.get_alarm_list(metrics)
+  state_key = get_state_key(config_generator.aws_account_id, config_generator.session,
+                config_generator.dimension_key, config_generator.dimension_value)
+  digest = get_alarm_digest(alarms, manifest_yaml_file, config_generator.output_format)
+  if skip_unchanged and not deploy_state.is_changed(state_key, digest):
+    return(False)
+  config_generator.write_alarms(alarms)
+  deploy_state.set_pending(state_key, digest)
+  return(True)
+
+def run_generate_changed(config_generator, args):
+  deploy_state = get_deploy_state(args)
+  changed = generate_changed(config_generator, config_generator.get_metrics(), deploy_state, args.skip_unchanged, args.manifest)
+  deploy_state.save()
+  if not changed:
+    print("{0}={1} unchanged since the last deploy".format(config_generator.dimension_key, config_generator.dimension_value))
+    return(CONST_EXIT_UNCHANGED)
+  return(0)
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Mark the alarms of instances deployed, or forget them after a destroy")
+  parser.add_argument('-s', dest='state_file', default=CONST_DEFAULT_STATE_FILE,
+                    help='The deploy state file')
+  parser.add_argument('--mark-deployed', dest='mark_deployed', nargs='+', default=[],
+                    help='KEY=VALUE of the instances whose pending alarms were deployed, e.g. InstanceId=i-0123456789abcdef0')
+  parser.add_argument('--all', dest='mark_all', action='store_true',
+                    help='Mark every pending alarm set deployed, after deploying the whole fleet')
+  parser.add_argument('--forget', dest='forget', nargs='+', default=[],
+                    help='KEY=VALUE of the instances whose alarms were destroyed')
+
+  args = parser.parse_args()
+  deploy_state = DeployState(args.state_file)
+  state_keys = list(deploy_state.entries) if args.mark_all else \
+    [state_key for dimension in args.mark_deployed for state_key in deploy_state.find_keys(dimension)]
+  for state_key in state_keys:
+    deploy_state.mark_deployed(state_key)
+  for dimension in args.forget:
+    for state_key in deploy_state.find_keys(dimension):
+      deploy_state.forget(state_key)
+  deploy_state.save()
+  sys.exit(0)
+
+if __name__ == "__main__":
+    main()
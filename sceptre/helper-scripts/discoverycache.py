@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CONST_DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'cwalarm')
+CONST_CACHE_FILE = 'discovery.sqlite3'
+CONST_CACHE_ACCOUNT = 'account'
+CONST_CACHE_TAG_NAME = 'tag_name'
+CONST_CACHE_METRICS = 'metrics'
+# Seconds. Account IDs do not change for a set of credentials, Name tags and metric sets rarely do.
+CONST_DEFAULT_CACHE_TTLS = {
+  CONST_CACHE_ACCOUNT: 30 * 86400,
+  CONST_CACHE_TAG_NAME: 3600,
+  CONST_CACHE_METRICS: 900
+}
+
+class DiscoveryCache:
+  def __init__(self,
+                cache_dir=CONST_DEFAULT_CACHE_DIR,
+                ttls=None,
+                refresh=False) -> None:
+      self.cache_dir = cache_dir
+      self.cache_file = os.path.join(cache_dir, CONST_CACHE_FILE)
+      self.ttls = {**CONST_DEFAULT_CACHE_TTLS, **(ttls or {})}
+      # With refresh, every lookup is a miss but fresh results are still stored.
+      self.refresh = refresh
+      self.thread_local = threading.local()
+      self.hits = 0
+      self.misses = 0
+      os.makedirs(cache_dir, exist_ok=True)
+      with self.get_connection() as connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                            'kind TEXT NOT NULL, '
+                            'key TEXT NOT NULL, '
+                            'value TEXT NOT NULL, '
+                            'expires_at REAL NOT NULL, '
+                            'PRIMARY KEY (kind, key))')
+
+  # sqlite3 connections cannot be shared between threads, keep one per thread.
+  def get_connection(self):
+    connection = getattr(self.thread_local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.cache_file, timeout=30)
+      connection.execute('PRAGMA journal_mode=WAL')
+      self.thread_local.connection = connection
+    return(connection)
+
+  def get(self, kind, key):
+    if self.refresh:
+      self.misses += 1
+      return(None)
+    row = self.get_connection().execute(
+            'SELECT value, expires_at FROM entries WHERE kind = ? AND key = ?',
+            (kind, key)).fetchone()
+    if row is None or row[1] < time.time():
+      self.misses += 1
+      return(None)
+    self.hits += 1
+    return(json.loads(row[0]))
+
+  def put(self, kind, key, value, ttl=None):
+    if ttl is None:
+      ttl = self.ttls.get(kind, 0)
+    with self.get_connection() as connection:
+      connection.execute('INSERT OR REPLACE INTO entries (kind, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                          (kind, key, json.dumps(value), time.time() + ttl))
+
+  # Drop one entry, every entry of a kind, or everything when called without arguments.
+  def invalidate(self, kind=None, key=None):
+    with self.get_connection() as connection:
+      if kind is None:
+        connection.execute('DELETE FROM entries')
+      elif key is None:
+        connection.execute('DELETE FROM entries WHERE kind = ?', (kind,))
+      else:
+        connection.execute('DELETE FROM entries WHERE kind = ? AND key = ?', (kind, key))
+
+  def purge_expired(self):
+    with self.get_connection() as connection:
+      connection.execute('DELETE FROM entries WHERE expires_at < ?', (time.time(),))
+
+# The account ID is cached per set of credentials, not per profile name.
+def get_credential_key(session=None):
+  if session is None:
+    import boto3
+    session = boto3.session.Session()
+  credentials = session.get_credentials()
+  access_key = credentials.access_key if credentials is not None else ''
+  return(hashlib.sha256(access_key.encode('utf-8')).hexdigest())
+
+def get_region_name(session=None):
+  if session is None:
+    import boto3
+    session = boto3.session.Session()
+  return(session.region_name or '')
+
+# Metric sets are filtered per generator class, so the filter is part of the cache key.
+def get_filter_key(metric_alarms, metric_fstype):
+  filter_data = json.dumps([sorted(metric_alarms), sorted(metric_fstype)])
+  return(hashlib.sha256(filter_data.encode('utf-8')).hexdigest()[:16])
+
+# The argparse type of --cache-ttl, KIND=SECONDS -> (kind, seconds).
+def parse_cache_ttl(cache_ttl):
+  kind, _, seconds = cache_ttl.partition('=')
+  if not seconds.isdigit():
+    raise argparse.ArgumentTypeError("cache TTL must be KIND=SECONDS, got '{0}'".format(cache_ttl))
+  if kind not in CONST_DEFAULT_CACHE_TTLS:
+    raise argparse.ArgumentTypeError("unknown cache kind '{0}', expected one of {1}".format(
+      kind, list(CONST_DEFAULT_CACHE_TTLS)))
+  return(kind, int(seconds))
+
+def add_cache_arguments(parser):
+  parser.add_argument('--cache', dest='use_cache', action='store_true',
+                    help='Read and write the discovery cache, a metric published or a filesystem mounted within '
+                    'the metrics TTL gets no alarm until the entry expires')
+  parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                    help='Do not read or write the discovery cache, the default')
+  parser.add_argument('--refresh', dest='refresh_cache', action='store_true',
+                    help='With --cache, ignore cached entries and store fresh lookups')
+  parser.add_argument('--clear-cache', dest='clear_cache', action='store_true',
+                    help='Drop every entry of the discovery cache before running')
+  parser.add_argument('--cache-dir', dest='cache_dir',
+                    default=os.environ.get('CWALARM_CACHE_DIR', CONST_DEFAULT_CACHE_DIR),
+                    help='The directory of the discovery cache')
+  parser.add_argument('--cache-ttl', dest='cache_ttls', action='append', default=[], type=parse_cache_ttl,
+                    help='Override a cache TTL, KIND=SECONDS where KIND is one of {0}. Can be repeated'.format(
+                      ', '.join(CONST_DEFAULT_CACHE_TTLS)))
+
+# The cache is opt-in, a stale metric list silently drops the alarms of new metrics.
+def get_cache(args):
+  if not args.use_cache and not args.clear_cache:
+    return(None)
+  cache = DiscoveryCache(args.cache_dir, dict(args.cache_ttls), args.refresh_cache)
+  if args.clear_cache:
+    cache.invalidate()
+  return(cache if args.use_cache else None)
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from alarmwriter import AlarmWriter
+from asyncdiscovery import CONST_DEFAULT_CALL_TIMEOUT, AsyncDiscoveryEngine, ThrottledCaller, parse_api_rate
+from cfntemplate import CONST_FORMAT_CFN_JSON, CONST_FORMAT_SCEPTRE
+from clientpool import CONST_DEFAULT_MAX_POOL_CONNECTIONS, ClientPool, ClientSettings, get_client_pool
+from configgenerator import load_manifest
+from deploystate import generate_changed, get_deploy_state, get_state_key
+from discoverycache import CONST_CACHE_ACCOUNT, get_cache, get_credential_key
+from groupalarms import describe_group_tag_names, find_group_names
+from manifestcompiler import get_instance_attributes
+from metricindex import MetricIndex
+from renderpipeline import CONST_DEFAULT_QUEUE_SIZE, RenderPipeline, RenderSettings
+from thresholdtuner import get_threshold_tuner
+
+CONST_DEFAULT_FLEET_WORKERS = 16
+CONST_DEFAULT_FLEET_OUTPUT_DIR = 'generated-config'
+CONST_ENGINE_THREADS = 'threads'
+CONST_ENGINE_ASYNC = 'async'
+CONST_FLEET_ENGINES = [CONST_ENGINE_THREADS, CONST_ENGINE_ASYNC]
+# Values per describe_instances filter.
+CONST_DESCRIBE_INSTANCES_BATCH = 200
+
+class FleetGenerator:
+  def __init__(self,
+                generator_class,
+                key,
+                values,
+                output_dir,
+                in_alarm_warning,
+                ok_alarm_warning,
+                in_alarm_critical,
+                ok_alarm_critical,
+                use_recover='false',
+                aws_account_name='unknown account',
+                manifest_yaml_file='',
+                max_workers=CONST_DEFAULT_FLEET_WORKERS,
+                bulk_discovery=False,
+                cache=None,
+                output_format=CONST_FORMAT_SCEPTRE,
+                session=None,
+                engine=CONST_ENGINE_THREADS,
+                caller=None,
+                deploy_state=None,
+                skip_unchanged=False,
+                instrumentation=None,
+                render_processes=0,
+                render_queue_size=CONST_DEFAULT_QUEUE_SIZE,
+                group_mode=False) -> None:
+      self.generator_class = generator_class
+      self.dimension_key = key
+      # Keep the order given by the caller but drop duplicates.
+      self.dimension_values = list(dict.fromkeys(values))
+      self.output_dir = output_dir
+      self.in_alarm_warning = in_alarm_warning
+      self.ok_alarm_warning = ok_alarm_warning
+      self.in_alarm_critical = in_alarm_critical
+      self.ok_alarm_critical = ok_alarm_critical
+      self.use_recover = use_recover
+      self.aws_account_name = aws_account_name
+      self.manifest_yaml_file = manifest_yaml_file
+      # Compiled once and shared by every generator of the fleet.
+      self.manifest = None
+      # Value -> the attributes manifest selectors match on, described in bulk when needed.
+      self.instance_attributes = {}
+      self.max_workers = max(1, int(max_workers))
+      self.session_lock = threading.Lock()
+      self.aws_account_id = ''
+      self.bulk_discovery = bulk_discovery
+      self.metric_index = None
+      self.cache = cache
+      self.output_format = output_format
+      # The ClientPool shared by every worker, see get_session.
+      self.session = session
+      # threads: one discovery chain per instance on the worker pool.
+      # async: AsyncDiscoveryEngine, rate limited and throttle-aware, with bulk Name tag lookups.
+      self.engine = engine
+      self.caller = caller
+      # Optional DeployState, with skip_unchanged the instances whose alarms did not change are not rewritten.
+      self.deploy_state = deploy_state
+      self.skip_unchanged = skip_unchanged
+      self.unchanged = []
+      # Optional Instrumentation shared by every generator of the fleet.
+      self.instrumentation = instrumentation
+      # With render processes, a RenderPipeline renders on every core instead of the worker threads.
+      self.render_processes = render_processes
+      self.render_queue_size = render_queue_size
+      # One alarm per metric of each Auto Scaling group, see ConfigGenerator.group_mode.
+      self.group_mode = group_mode
+
+  # One ClientPool shared by every worker thread, created on first use without a session.
+  def get_session(self):
+    with self.session_lock:
+      if self.session is None:
+        self.session = ClientPool(settings=ClientSettings(max(CONST_DEFAULT_MAX_POOL_CONNECTIONS, self.max_workers)))
+      return(self.session)
+
+  # A client of the shared session, its API calls recorded like those of the generators.
+  def get_client(self, service_name):
+    client = self.get_session().client(service_name)
+    if self.instrumentation is not None:
+      self.instrumentation.instrument_client(client, service_name)
+    return(client)
+
+  def get_aws_account_id(self):
+    if self.cache is not None:
+      cache_key = get_credential_key(self.get_session())
+      aws_account_id = self.cache.get(CONST_CACHE_ACCOUNT, cache_key)
+      if aws_account_id is not None:
+        return(aws_account_id)
+    client = self.get_client('sts')
+    response = client.get_caller_identity()
+    if self.cache is not None:
+      self.cache.put(CONST_CACHE_ACCOUNT, cache_key, response["Account"])
+    return(response["Account"])
+
+  def get_manifest(self):
+    if self.manifest is None:
+      self.manifest = load_manifest(self.manifest_yaml_file)
+    return(self.manifest)
+
+  def get_output_file(self, value):
+    extension = 'json' if self.output_format == CONST_FORMAT_CFN_JSON else 'yaml'
+    return(os.path.join(self.output_dir, "{0}.{1}".format(value, extension)))
+
+  def get_config_generator(self, value, instance_tag_name=None, instance_attributes=None):
+    if instance_attributes is None:
+      instance_attributes = self.instance_attributes.get(value)
+    config_generator = self.generator_class(
+                        self.dimension_key, value,
+                        self.get_output_file(value),
+                        self.in_alarm_warning, self.ok_alarm_warning,
+                        self.in_alarm_critical, self.ok_alarm_critical,
+                        self.use_recover, self.aws_account_name,
+                        self.manifest_yaml_file,
+                        self.aws_account_id,
+                        self.get_session(),
+                        self.cache,
+                        self.output_format,
+                        instance_tag_name,
+                        self.instrumentation,
+                        self.get_manifest(),
+                        instance_attributes)
+    config_generator.metric_index = self.metric_index
+    config_generator.group_mode = self.group_mode
+    return(config_generator)
+
+  # Returns the output file, or None when the alarms are unchanged and the file is kept.
+  def generate_one(self, value, instance_tag_name=None, metrics=None, instance_attributes=None):
+    output_file = self.get_output_file(value)
+    config_generator = self.get_config_generator(value, instance_tag_name, instance_attributes)
+    if metrics is None:
+      metrics = config_generator.get_metrics()
+    if self.deploy_state is None:
+      config_generator.generate_yaml(metrics)
+      return(output_file)
+    # An unchanged instance is still written when its file is missing, stackpacker reads them all.
+    skip_unchanged = self.skip_unchanged and os.path.exists(output_file)
+    if not generate_changed(config_generator, metrics, self.deploy_state, skip_unchanged, self.manifest_yaml_file):
+      return(None)
+    return(output_file)
+
+  # The discovery stage of a RenderPipeline: everything a render worker needs to render one
+  # value without calling AWS, the Name tag, the metrics and the instance attributes.
+  def discover_one(self, value, instance_tag_name=None, metrics=None):
+    config_generator = self.get_config_generator(value, instance_tag_name)
+    if metrics is None:
+      metrics = config_generator.get_metrics()
+    return(config_generator.instance_tag_name, list(metrics), config_generator.instance_attributes)
+
+  def get_render_settings(self):
+    return(RenderSettings(self.generator_class,
+            self.dimension_key,
+            self.in_alarm_warning, self.ok_alarm_warning,
+            self.in_alarm_critical, self.ok_alarm_critical,
+            self.use_recover, self.aws_account_name,
+            self.manifest_yaml_file,
+            self.aws_account_id,
+            self.output_format,
+            self.get_manifest(),
+            self.deploy_state is not None,
+            self.group_mode))
+
+  # The write stage of a RenderPipeline, the same output and deploy state as generate_one.
+  def write_rendered(self, rendered):
+    output_file = self.get_output_file(rendered.value)
+    start = time.perf_counter()
+    if self.deploy_state is not None:
+      state_key = get_state_key(self.aws_account_id, self.get_session(), self.dimension_key, rendered.value)
+      # An unchanged instance is still written when its file is missing, stackpacker reads them all.
+      if self.skip_unchanged and os.path.exists(output_file) and not self.deploy_state.is_changed(state_key, rendered.digest):
+        return(None)
+    alarm_writer = AlarmWriter(output_file, self.output_format, rendered.description).open()
+    try:
+      for alarm_text in rendered.alarm_texts:
+        alarm_writer.write(None, alarm_text)
+      alarm_writer.close()
+    except Exception:
+      alarm_writer.abort()
+      raise
+    if self.deploy_state is not None:
+      self.deploy_state.set_pending(state_key, rendered.digest)
+    if self.instrumentation is not None:
+      self.instrumentation.add_phase_time('render', rendered.render_seconds)
+      self.instrumentation.add_phase_time('serialize', rendered.serialize_seconds + time.perf_counter() - start)
+      self.instrumentation.add_items('metrics', rendered.metric_count)
+      self.instrumentation.add_items('alarms', len(rendered.alarm_texts))
+    return(output_file)
+
+  def get_metric_filters(self):
+    custom_rules = self.get_manifest().custom_rules
+    return(self.generator_class.get_metric_alarms(custom_rules),
+      self.generator_class.metric_fstype,
+      self.generator_class.get_metric_namespaces(custom_rules))
+
+  def discover_async(self):
+    metric_alarms, metric_fstype, metric_namespaces = self.get_metric_filters()
+    caller = self.caller if self.caller is not None else ThrottledCaller(max_concurrency=self.max_workers)
+    engine = AsyncDiscoveryEngine(self.dimension_key,
+                metric_alarms, metric_fstype, metric_namespaces,
+                self.get_session(), caller, self.instrumentation)
+    results, errors = asyncio.run(engine.discover(self.dimension_values, self.metric_index))
+    caller.print_stats()
+    for value, exc in errors.items():
+      print("failed to discover {0}: {1}".format(value, exc))
+    return(results, errors)
+
+  # The attributes of every instance without them, one describe_instances per batch.
+  def describe_instances(self):
+    instance_ids = [value for value in self.dimension_values if value not in self.instance_attributes]
+    paginator = self.get_client('ec2').get_paginator('describe_instances')
+    for ii in range(0, len(instance_ids), CONST_DESCRIBE_INSTANCES_BATCH):
+      batch = instance_ids[ii:ii + CONST_DESCRIBE_INSTANCES_BATCH]
+      for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': batch}]):
+        for reservation in page['Reservations']:
+          for instance in reservation['Instances']:
+            self.instance_attributes[instance['InstanceId']] = dict(get_instance_attributes(instance),
+                                                                  platform=self.generator_class.platform)
+    # A missing instance has no tags to match, do not describe it again per instance.
+    for instance_id in instance_ids:
+      self.instance_attributes.setdefault(instance_id, {'platform': self.generator_class.platform})
+
+  def add_result(self, value, output_file, exc, outputs, errors):
+    if exc is not None:
+      errors[value] = exc
+      print("failed to generate {0}: {1}".format(value, exc))
+    elif output_file is None:
+      self.unchanged.append(value)
+    else:
+      outputs[value] = output_file
+      print("generated {0}".format(output_file))
+
+  # Everything shared by the fleet, then the async discovery. Returns a dict of value ->
+  # (Name tag, metrics), both None when the generator looks them up, and a dict of value -> exception.
+  def discover(self):
+    if not self.aws_account_id:
+      self.aws_account_id = self.get_aws_account_id()
+    if self.get_manifest().needs_instances() and self.dimension_key == 'InstanceId':
+      self.describe_instances()
+    if self.bulk_discovery and self.metric_index is None:
+      metric_alarms, metric_fstype, metric_namespaces = self.get_metric_filters()
+      self.metric_index = MetricIndex(self.dimension_key,
+                            metric_alarms, metric_fstype, metric_namespaces,
+                            session=self.get_session(), instrumentation=self.instrumentation).build()
+    if self.engine == CONST_ENGINE_ASYNC:
+      discovered, errors = self.discover_async()
+    else:
+      discovered, errors = {value: (None, None) for value in self.dimension_values}, {}
+    if self.group_mode:
+      # The Name tags of the groups in bulk, a missing group is not looked up again per group.
+      tag_names = describe_group_tag_names(self.get_client('autoscaling'), list(discovered))
+      discovered = {value: (tag_names.get(value, ''), metrics) for value, (tag_name, metrics) in discovered.items()}
+    return(discovered, errors)
+
+  # Returns a dict of value -> output file and a dict of value -> exception.
+  def generate(self):
+    outputs = {}
+    errors = {}
+    if len(self.dimension_values) == 0:
+      return(outputs, errors)
+    os.makedirs(self.output_dir, exist_ok=True)
+    discovered, errors = self.discover()
+    if self.render_processes > 0:
+      results, render_errors = RenderPipeline(self, self.render_processes, self.render_queue_size).run(discovered)
+      for value in discovered:
+        self.add_result(value, results.get(value), render_errors.get(value), outputs, errors)
+    else:
+      with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+        futures = {executor.submit(self.generate_one, value, *discovered[value]): value for value in discovered}
+        for future in as_completed(futures):
+          try:
+            self.add_result(futures[future], future.result(), None, outputs, errors)
+          except Exception as exc:
+            self.add_result(futures[future], None, exc, outputs, errors)
+    if self.deploy_state is not None:
+      self.deploy_state.save()
+    return(outputs, errors)
+
+  def tune_one(self, threshold_tuner, value, instance_tag_name=None, metrics=None):
+    config_generator = self.get_config_generator(value, instance_tag_name)
+    if metrics is None:
+      metrics = config_generator.get_metrics()
+    threshold_tuner.add_generator(config_generator, metrics)
+
+  # Adds the metrics of every value to threshold_tuner and tunes them, see ThresholdTuner.
+  # Returns a dict of value -> exception.
+  def tune(self, threshold_tuner):
+    if len(self.dimension_values) == 0:
+      return({})
+    discovered, errors = self.discover()
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      futures = {executor.submit(self.tune_one, threshold_tuner, value, *discovered[value]): value for value in discovered}
+      for future in as_completed(futures):
+        try:
+          future.result()
+        except Exception as exc:
+          errors[futures[future]] = exc
+          print("failed to discover {0}: {1}".format(futures[future], exc))
+    threshold_tuner.tune(self.get_client('cloudwatch'))
+    return(errors)
+
+# Parse Key=Value[,Value...] into an EC2 describe_instances filter.
+def parse_tag_filter(tag_filter):
+  if '=' not in tag_filter:
+    raise ValueError("tag filter must be Key=Value, got '{0}'".format(tag_filter))
+  tag_key, tag_values = tag_filter.split('=', 1)
+  return({'Name': 'tag:{0}'.format(tag_key), 'Values': tag_values.split(',')})
+
+# The argparse type of --tag-filter, the filter is kept as given and parsed where it is used.
+def check_tag_filter(tag_filter):
+  try:
+    parse_tag_filter(tag_filter)
+  except ValueError as exc:
+    raise argparse.ArgumentTypeError(str(exc))
+  return(tag_filter)
+
+# Instance ID -> the attributes manifest selectors match on, of the running instances matching tag_filters.
+def find_instances(tag_filters, session=None):
+  if session is None:
+    session = ClientPool()
+  client = session.client('ec2')
+  filters = [parse_tag_filter(tag_filter) for tag_filter in tag_filters]
+  filters.append({'Name': 'instance-state-name', 'Values': ['running']})
+  instances = {}
+  paginator = client.get_paginator('describe_instances')
+  for page in paginator.paginate(Filters=filters):
+    for reservation in page['Reservations']:
+      for instance in reservation['Instances']:
+        instances[instance['InstanceId']] = get_instance_attributes(instance)
+  return(instances)
+
+def find_instance_ids(tag_filters, session=None):
+  return(list(find_instances(tag_filters, session)))
+
+def add_fleet_arguments(parser):
+  parser.add_argument('--instance-ids', dest='instance_ids', nargs='+', default=[],
+                    help='Fleet mode: the Dimension Values to generate, one output per value')
+  parser.add_argument('--tag-filter', dest='tag_filters', action='append', default=[], type=check_tag_filter,
+                    help='Fleet mode: select running instances by tag, Key=Value[,Value...]. Can be repeated')
+  parser.add_argument('--output-dir', dest='output_dir', default=CONST_DEFAULT_FLEET_OUTPUT_DIR,
+                    help='Fleet mode: the directory for the per-instance output files')
+  parser.add_argument('--workers', dest='workers', type=int, default=CONST_DEFAULT_FLEET_WORKERS,
+                    help='Fleet mode: the maximum number of instances discovered concurrently')
+  parser.add_argument('--bulk-discovery', dest='bulk_discovery', action='store_true',
+                    help='Fleet mode: list metrics once per namespace for the whole account/region instead of once per instance')
+  parser.add_argument('--engine', dest='engine', default=CONST_ENGINE_THREADS, choices=CONST_FLEET_ENGINES,
+                    help='Fleet mode: threads runs one discovery per instance, async rate limits every API and backs off on throttling')
+  parser.add_argument('--api-rate', dest='api_rates', action='append', default=[], type=parse_api_rate,
+                    help='Fleet mode, async engine: override the rate limit of an API, API=RATE[:BURST], e.g. cloudwatch.ListMetrics=50:50. Can be repeated')
+  parser.add_argument('--call-timeout', dest='call_timeout', type=float, default=CONST_DEFAULT_CALL_TIMEOUT,
+                    help='Fleet mode, async engine: the connect and read timeout in seconds of every API call')
+  parser.add_argument('--render-processes', dest='render_processes', type=int, default=0,
+                    help='Fleet mode: render the alarms in this many worker processes, 0 renders them on the discovery threads')
+  parser.add_argument('--render-queue-size', dest='render_queue_size', type=int, default=CONST_DEFAULT_QUEUE_SIZE,
+                    help='Fleet mode, render processes: the maximum number of instances waiting between two stages')
+
+def is_fleet_mode(args):
+  return(len(args.instance_ids) > 0 or len(args.tag_filters) > 0)
+
+def run_fleet(generator_class, args, instrumentation=None):
+  values = []
+  for value in args.instance_ids:
+    values.extend([item for item in value.split(',') if item])
+  # Every worker gets a pooled connection to each service.
+  client_pool = get_client_pool(args, instrumentation, args.workers)
+  if len(args.tag_filters) > 0 and args.group_mode:
+    values.extend(find_group_names([parse_tag_filter(tag_filter) for tag_filter in args.tag_filters],
+                    client_pool.client('autoscaling')))
+  elif len(args.tag_filters) > 0:
+    values.extend(find_instance_ids(args.tag_filters, client_pool))
+  fleet_generator = FleetGenerator(
+                      generator_class,
+                      args.key, values,
+                      args.output_dir,
+                      args.in_alarm_warning, args.ok_alarm_warning,
+                      args.in_alarm_critical, args.ok_alarm_critical,
+                      args.userecover, args.account_alias,
+                      args.manifest,
+                      args.workers,
+                      args.bulk_discovery,
+                      get_cache(args),
+                      args.output_format,
+                      session=client_pool,
+                      engine=args.engine,
+                      caller=ThrottledCaller(max_concurrency=args.workers,
+                              call_timeout=args.call_timeout,
+                              api_rates=dict(args.api_rates)),
+                      deploy_state=get_deploy_state(args),
+                      skip_unchanged=args.skip_unchanged,
+                      instrumentation=instrumentation,
+                      render_processes=args.render_processes,
+                      render_queue_size=args.render_queue_size,
+                      group_mode=args.group_mode)
+  if args.tune_manifest:
+    threshold_tuner = get_threshold_tuner(args, instrumentation)
+    errors = fleet_generator.tune(threshold_tuner)
+    threshold_tuner.write_manifest(args.tune_manifest)
+    return(0 if len(errors) == 0 else 1)
+  outputs, errors = fleet_generator.generate()
+  print("fleet generation done: {0} generated, {1} unchanged, {2} failed".format(
+      len(outputs), len(fleet_generator.unchanged), len(errors)))
+  return(0 if len(errors) == 0 else 1)
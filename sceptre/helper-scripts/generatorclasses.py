@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+
+from cwalarmlinux import LinuxConfigGenerator
+from cwalarmwindows import WindowsConfigGenerator
+
+# The generator of every platform get_instance_attributes reports, shared by the scripts that
+# generate instances of both. Not in fleetgenerator.py, which the generators import.
+CONST_GENERATOR_CLASSES = {
+  'linux': LinuxConfigGenerator,
+  'windows': WindowsConfigGenerator
+}
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+from metricrecord import MetricRecord
+
+CONST_GROUP_DIMENSION = 'AutoScalingGroupName'
+# Dimensions that tell the members of a group apart, the CloudWatch agent appends the last two.
+CONST_MEMBER_DIMENSIONS = ['InstanceId', 'ImageId', 'InstanceType']
+# describe_auto_scaling_groups accepts up to 100 names per call.
+CONST_DESCRIBE_GROUPS_BATCH = 100
+
+# The metric of a whole group. member_dimension_names is None when the group metric is
+# published, e.g. the AWS/EC2 CPUUtilization of an Auto Scaling group or a CloudWatch agent
+# aggregation_dimensions entry. Otherwise it is the dimensions of the member metrics it is
+# aggregated from, by a Metrics Insights query.
+class GroupMetricRecord(MetricRecord):
+  __slots__ = ('member_dimension_names',)
+
+  def __init__(self, namespace, metric_name, dimension_names, dimension_values, member_dimension_names=None) -> None:
+      super().__init__(namespace, metric_name, dimension_names, dimension_values)
+      self.member_dimension_names = member_dimension_names
+
+  def __reduce__(self):
+    return(GroupMetricRecord, (self.namespace, self.metric_name, self.dimension_names, self.dimension_values,
+            self.member_dimension_names))
+
+# Collapse the member metrics of a group into one metric per name and remaining dimensions,
+# e.g. the disk_used_percent of path / on every instance into one. A published group metric
+# is preferred over aggregating the members. Returns GroupMetricRecords in the order seen.
+def get_group_metrics(metrics):
+  group_metrics = {}
+  for metric in metrics:
+    dimensions = [(dimension_name, dimension_value) for dimension_name, dimension_value in metric.get_dimensions()
+                    if dimension_name not in CONST_MEMBER_DIMENSIONS]
+    group_key = (metric.namespace, metric.metric_name, tuple(sorted(dimensions)))
+    is_member = len(dimensions) < len(metric.dimension_names)
+    group_metric = group_metrics.get(group_key)
+    if group_metric is not None and (is_member or group_metric.member_dimension_names is None):
+      continue
+    group_metrics[group_key] = GroupMetricRecord(metric.namespace, metric.metric_name,
+                                [dimension_name for dimension_name, dimension_value in dimensions],
+                                [dimension_value for dimension_name, dimension_value in dimensions],
+                                metric.dimension_names if is_member else None)
+  return(group_metrics.values())
+
+def quote_identifier(identifier):
+  return('"{0}"'.format(identifier.replace('"', '\\"')))
+
+def quote_string(value):
+  return("'{0}'".format(value.replace("'", "\\'")))
+
+# The WHERE condition of a query on the dimension, also how the reconciler finds the group alarms.
+def get_dimension_condition(dimension_name, dimension_value):
+  return("{0} = {1}".format(quote_identifier(dimension_name), quote_string(dimension_value)))
+
+# The Metrics Insights query of a group alarm, the worst member in every period: the maximum
+# for the greater-than rules, the minimum for the less-than ones. New members are part of
+# the query as soon as they publish, the alarm is not regenerated on a scale-out.
+def get_group_query(rule, metric):
+  function = 'MAX' if rule.comparison_operator.startswith('Greater') else 'MIN'
+  schema = ', '.join(quote_identifier(name) for name in [metric.namespace] + list(metric.member_dimension_names))
+  conditions = ' AND '.join(get_dimension_condition(dimension_name, dimension_value)
+                              for dimension_name, dimension_value in metric.get_dimensions())
+  return("SELECT {0}({1}) FROM SCHEMA({2}) WHERE {3}".format(function, quote_identifier(metric.metric_name), schema, conditions))
+
+# Auto Scaling group name -> its Name tag, or '' without one, one call per 100 groups.
+def describe_group_tag_names(client, group_names):
+  tag_names = {}
+  paginator = client.get_paginator('describe_auto_scaling_groups')
+  for ii in range(0, len(group_names), CONST_DESCRIBE_GROUPS_BATCH):
+    batch = group_names[ii:ii + CONST_DESCRIBE_GROUPS_BATCH]
+    for page in paginator.paginate(AutoScalingGroupNames=batch, MaxRecords=CONST_DESCRIBE_GROUPS_BATCH):
+      for group in page['AutoScalingGroups']:
+        tag_names[group['AutoScalingGroupName']] = get_group_tag_name(group)
+  return(tag_names)
+
+def get_group_tag_name(group):
+  for tag in group.get('Tags', []):
+    if tag['Key'] == 'Name':
+      return(tag['Value'])
+  return('')
+
+# The names of the Auto Scaling groups matching filters, e.g. [{'Name': 'tag:Environment', 'Values': ['prod']}].
+def find_group_names(filters, client):
+  group_names = []
+  paginator = client.get_paginator('describe_auto_scaling_groups')
+  for page in paginator.paginate(Filters=filters):
+    for group in page['AutoScalingGroups']:
+      group_names.append(group['AutoScalingGroupName'])
+  return(group_names)
+
+def add_group_arguments(parser):
+  parser.add_argument('--group-mode', dest='group_mode', action='store_true',
+                    help='With -k AutoScalingGroupName, one alarm per metric of the group, on the worst member, '
+                    'instead of one per instance. Needs -f cfn-yaml, -f cfn-json or --reconcile')
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+from asyncdiscovery import CONST_THROTTLING_ERROR_CODES
+
+CONST_METRIC_PREFIX = 'cwalarm'
+
+class PhaseStats:
+  def __init__(self) -> None:
+      self.seconds = 0.0
+      self.calls = 0
+
+class ApiCallStats:
+  def __init__(self) -> None:
+      self.calls = 0
+      self.seconds = 0.0
+      self.max_seconds = 0.0
+      self.retries = 0
+      self.throttles = 0
+      self.errors = 0
+
+# Per-phase wall time, per-API call counts, latencies, retries and throttles, and item
+# counts of a run. Shared by the worker threads of fleet mode, so every update takes the lock.
+class Instrumentation:
+  def __init__(self) -> None:
+      self.phases = {}
+      self.api_calls = {}
+      self.items = {}
+      self.started_at = time.perf_counter()
+      # The ClientPools of the run, their statistics are read when the summary is.
+      self.client_pools = []
+      self.lock = threading.Lock()
+
+  def add_phase_time(self, name, seconds, calls=1):
+    with self.lock:
+      phase_stats = self.phases.setdefault(name, PhaseStats())
+      phase_stats.seconds += seconds
+      phase_stats.calls += calls
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add_phase_time(name, time.perf_counter() - start)
+
+  # Yield from iterable, adding the time spent waiting for each item to the phase,
+  # e.g. the pages of a paginator that fetches them lazily.
+  def timed(self, iterable, name):
+    iterator = iter(iterable)
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        self.add_phase_time(name, time.perf_counter() - start, 0)
+        return
+      self.add_phase_time(name, time.perf_counter() - start)
+      yield item
+
+  def add_items(self, name, count=1):
+    with self.lock:
+      self.items[name] = self.items.get(name, 0) + count
+
+  def record_api_call(self, api_name, seconds, retries=0, error_code=None):
+    with self.lock:
+      api_call_stats = self.api_calls.setdefault(api_name, ApiCallStats())
+      api_call_stats.calls += 1
+      api_call_stats.seconds += seconds
+      api_call_stats.max_seconds = max(api_call_stats.max_seconds, seconds)
+      api_call_stats.retries += retries
+      if error_code is not None:
+        api_call_stats.errors += 1
+
+  def record_throttle(self, api_name):
+    with self.lock:
+      self.api_calls.setdefault(api_name, ApiCallStats()).throttles += 1
+
+  def add_client_pool(self, client_pool):
+    with self.lock:
+      self.client_pools.append(client_pool)
+
+  # The statistics of every ClientPool added, summed per service.
+  def get_client_pool_stats(self):
+    with self.lock:
+      client_pools = list(self.client_pools)
+    client_pool_stats = {}
+    for client_pool in client_pools:
+      for service_name, stats in client_pool.get_stats().items():
+        service_stats = client_pool_stats.setdefault(service_name, dict.fromkeys(stats, 0))
+        for field, count in stats.items():
+          service_stats[field] += count
+    return(dict(sorted(client_pool_stats.items())))
+
+  # Hook the botocore events of a client: before-call and after-call time every API call
+  # including its retries, needs-retry sees the throttled attempts. Clients without a
+  # botocore event system, like the benchmark stand-in, are left alone.
+  def instrument_client(self, client, service_name):
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+      return(client)
+
+    def get_api_name(model):
+      return("{0}.{1}".format(service_name, model.name))
+
+    def before_call(model=None, context=None, **kwargs):
+      context['cwalarm_started_at'] = time.perf_counter()
+
+    def after_call(parsed=None, model=None, context=None, **kwargs):
+      started_at = context.pop('cwalarm_started_at', None)
+      if started_at is None:
+        return
+      metadata = parsed.get('ResponseMetadata', {})
+      self.record_api_call(get_api_name(model), time.perf_counter() - started_at,
+        metadata.get('RetryAttempts', 0), parsed.get('Error', {}).get('Code'))
+
+    def needs_retry(response=None, operation=None, **kwargs):
+      if response is not None and response[1].get('Error', {}).get('Code') in CONST_THROTTLING_ERROR_CODES:
+        self.record_throttle(get_api_name(operation))
+
+    # A shared client is handed out many times, unique_id registers the handlers only once.
+    unique_id = "cwalarm-instrumentation-{0}".format(id(self))
+    events.register('before-call.*', before_call, unique_id=unique_id + '-before-call')
+    events.register('after-call.*', after_call, unique_id=unique_id + '-after-call')
+    # First, the retry handler stops the event at the first handler that returns a delay.
+    events.register_first('needs-retry.*', needs_retry, unique_id=unique_id + '-needs-retry')
+    return(client)
+
+  def get_summary(self):
+    client_pool_stats = self.get_client_pool_stats()
+    with self.lock:
+      return({
+        'seconds': time.perf_counter() - self.started_at,
+        'phases': {name: {'seconds': phase_stats.seconds, 'calls': phase_stats.calls}
+                    for name, phase_stats in sorted(self.phases.items())},
+        'api_calls': {api_name: {'calls': api_call_stats.calls,
+                                  'seconds': api_call_stats.seconds,
+                                  'max_seconds': api_call_stats.max_seconds,
+                                  'retries': api_call_stats.retries,
+                                  'throttles': api_call_stats.throttles,
+                                  'errors': api_call_stats.errors}
+                        for api_name, api_call_stats in sorted(self.api_calls.items())},
+        'items': dict(sorted(self.items.items())),
+        'client_pools': client_pool_stats
+      })
+
+  def get_prometheus_text(self):
+    summary = self.get_summary()
+    metric_families = [
+      ('run_seconds', 'gauge', 'Wall time of the run.', [('', summary['seconds'])]),
+      ('phase_seconds_total', 'counter', 'Wall time spent per phase.',
+        [('phase', name, phase_stats['seconds']) for name, phase_stats in summary['phases'].items()]),
+      ('phase_calls_total', 'counter', 'Times each phase ran.',
+        [('phase', name, phase_stats['calls']) for name, phase_stats in summary['phases'].items()]),
+      ('items_total', 'counter', 'Items processed.',
+        [('item', name, count) for name, count in summary['items'].items()])
+    ]
+    for field, metric_type, help_text in [('calls', 'counter', 'API calls.'),
+                                          ('seconds', 'counter', 'API call latency including retries.'),
+                                          ('max_seconds', 'gauge', 'Slowest API call.'),
+                                          ('retries', 'counter', 'API call retries.'),
+                                          ('throttles', 'counter', 'Throttled API call attempts.'),
+                                          ('errors', 'counter', 'API calls that failed.')]:
+      name = "api_{0}".format(field) + ('_total' if metric_type == 'counter' else '')
+      metric_families.append((name, metric_type, help_text,
+        [('api', api_name, api_call_stats[field]) for api_name, api_call_stats in summary['api_calls'].items()]))
+    for field, help_text in [('clients', 'AWS clients created.'),
+                              ('client_requests', 'AWS clients handed out by the client pool.'),
+                              ('connections', 'HTTPS connections opened.'),
+                              ('http_requests', 'HTTP requests sent over the pooled connections.')]:
+      metric_families.append(("client_pool_{0}_total".format(field), 'counter', help_text,
+        [('service', service_name, stats[field]) for service_name, stats in summary['client_pools'].items()]))
+    lines = []
+    for name, metric_type, help_text, samples in metric_families:
+      metric_name = "{0}_{1}".format(CONST_METRIC_PREFIX, name)
+      lines.append("# HELP {0} {1}".format(metric_name, help_text))
+      lines.append("# TYPE {0} {1}".format(metric_name, metric_type))
+      for sample in samples:
+        if len(sample) == 2:
+          lines.append("{0} {1}".format(metric_name, sample[1]))
+        else:
+          lines.append('{0}{{{1}="{2}"}} {3}'.format(metric_name, sample[0], sample[1], sample[2]))
+    return('\n'.join(lines) + '\n')
+
+  # Written to a temporary file and renamed, a textfile collector never reads half a file.
+  def write_file(self, file_name, content):
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+    with open(file_name + '.tmp', 'w') as file:
+      file.write(content)
+    os.replace(file_name + '.tmp', file_name)
+
+  def write_json(self, file_name):
+    self.write_file(file_name, json.dumps(self.get_summary(), indent=2) + '\n')
+
+  def write_prometheus(self, file_name):
+    self.write_file(file_name, self.get_prometheus_text())
+
+def add_instrumentation_arguments(parser):
+  parser.add_argument('--metrics-json', dest='metrics_json',
+                    help='Write the phase timings and the API call statistics of the run to this JSON file')
+  parser.add_argument('--metrics-prom', dest='metrics_prom',
+                    help='Write the phase timings and the API call statistics in the Prometheus text format to this file')
+  parser.add_argument('--profile', dest='profile',
+                    help='Write a cProfile dump of the run to this file, only the main thread in fleet mode')
+
+# Yields an Instrumentation, or None when no output asks for one. The outputs are written
+# when the block exits, also through sys.exit.
+@contextlib.contextmanager
+def instrumented(args):
+  instrumentation = Instrumentation() if args.metrics_json or args.metrics_prom else None
+  profiler = cProfile.Profile() if args.profile else None
+  if profiler is not None:
+    profiler.enable()
+  try:
+    yield instrumentation
+  finally:
+    if profiler is not None:
+      profiler.disable()
+      profiler.dump_stats(args.profile)
+    if instrumentation is not None and args.metrics_json:
+      instrumentation.write_json(args.metrics_json)
+    if instrumentation is not None and args.metrics_prom:
+      instrumentation.write_prometheus(args.metrics_prom)
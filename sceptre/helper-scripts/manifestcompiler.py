@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import yaml
+
+from alarmrules import pop_manifest_rules
+
+CONST_SELECTORS_KEY = 'selectors'
+CONST_SELECTOR_KEYS = ['match', 'config']
+# What a selector can match on, every attribute it names has to match.
+CONST_MATCH_ATTRIBUTES = ['platform', 'instance_type', 'tags', 'dimensions']
+# The prefixes of the criteria on a mapping attribute, e.g. tag:Environment.
+CONST_MAPPING_ATTRIBUTES = {'tags': 'tag', 'dimensions': 'dimension'}
+CONST_SECTION_KEYS = ['enabled', 'warning_threshold', 'critical_threshold']
+
+# None, one path or a list of paths, the later manifests override the earlier ones.
+def get_manifest_files(manifest_yaml_file):
+  if not manifest_yaml_file:
+    return([])
+  if isinstance(manifest_yaml_file, str):
+    return([manifest_yaml_file])
+  return([file_name for file_name in manifest_yaml_file if file_name])
+
+# A new dict with override merged into base, nested mappings are merged key by key so a
+# manifest that sets only warning_threshold keeps enabled and critical_threshold.
+def deep_merge(base, override):
+  merged = dict(base)
+  for key, value in override.items():
+    if isinstance(value, dict) and isinstance(merged.get(key), dict):
+      merged[key] = deep_merge(merged[key], value)
+    else:
+      merged[key] = value
+  return(merged)
+
+def is_threshold(value):
+  if isinstance(value, bool):
+    return(False)
+  try:
+    float(value)
+  except (TypeError, ValueError):
+    return(False)
+  return(True)
+
+# alert_config sections, e.g. cpu_credit_balance: {enabled: True, warning_threshold: 100}.
+def validate_sections(sections, source):
+  if not isinstance(sections, dict):
+    raise ValueError("{0}: the alert config must be a mapping".format(source))
+  for section_name, section in sections.items():
+    if not isinstance(section, dict):
+      raise ValueError("{0}: '{1}' must be a mapping of {2}".format(source, section_name, CONST_SECTION_KEYS))
+    unknown_keys = [key for key in section if key not in CONST_SECTION_KEYS]
+    if len(unknown_keys) > 0:
+      raise ValueError("{0}: '{1}' has unknown keys {2}".format(source, section_name, unknown_keys))
+    if 'enabled' in section and not isinstance(section['enabled'], bool):
+      raise ValueError("{0}: '{1}' enabled must be True or False".format(source, section_name))
+    for key in ['warning_threshold', 'critical_threshold']:
+      if key in section and not is_threshold(section[key]):
+        raise ValueError("{0}: '{1}' {2} must be a number, got '{3}'".format(source, section_name, key, section[key]))
+
+# The (attribute, value) pairs an instance is looked up by, e.g. ('tag:Environment', 'prod').
+def get_instance_keys(instance_attributes):
+  instance_keys = []
+  for attribute in ['platform', 'instance_type']:
+    if instance_attributes.get(attribute):
+      instance_keys.append((attribute, instance_attributes[attribute]))
+  for attribute, prefix in CONST_MAPPING_ATTRIBUTES.items():
+    for key, value in instance_attributes.get(attribute, {}).items():
+      instance_keys.append(("{0}:{1}".format(prefix, key), value))
+  return(instance_keys)
+
+# The selector attributes of a describe_instances entry.
+def get_instance_attributes(instance):
+  return({
+    'platform': 'windows' if instance.get('Platform') == 'windows' else 'linux',
+    'instance_type': instance.get('InstanceType', ''),
+    'tags': {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+  })
+
+# One selector of a manifest, e.g.
+#   selectors:
+#     - match:
+#         platform: linux
+#         instance_type: [t3.micro, t3.small]
+#         tags:
+#           Environment: prod
+#       config:
+#         cpu_credit_balance:
+#           warning_threshold: 50
+# A list matches any of its values, every attribute named has to match. dimensions matches the
+# dimension of the generator, e.g. InstanceId: i-0123456789abcdef0 or AutoScalingGroupName: web.
+class Selector:
+  def __init__(self, position, selector_spec, source) -> None:
+      if not isinstance(selector_spec, dict):
+        raise ValueError("{0}: selector {1} must be a mapping".format(source, position))
+      unknown_keys = [key for key in selector_spec if key not in CONST_SELECTOR_KEYS]
+      if len(unknown_keys) > 0:
+        raise ValueError("{0}: selector {1} has unknown keys {2}".format(source, position, unknown_keys))
+      match = selector_spec.get('match') or {}
+      unknown_attributes = [attribute for attribute in match if attribute not in CONST_MATCH_ATTRIBUTES]
+      if len(unknown_attributes) > 0:
+        raise ValueError("{0}: selector {1} cannot match on {2}, only on {3}".format(
+            source, position, unknown_attributes, CONST_MATCH_ATTRIBUTES))
+      # The position across every layer, selectors apply in this order.
+      self.position = position
+      self.sections = selector_spec.get('config') or {}
+      validate_sections(self.sections, "{0}: selector {1}".format(source, position))
+      # Attribute -> the values it may have, one entry per criterion.
+      self.criteria = {}
+      for attribute in ['platform', 'instance_type']:
+        if attribute in match:
+          self.criteria[attribute] = self.get_values(match[attribute])
+      for attribute, prefix in CONST_MAPPING_ATTRIBUTES.items():
+        mapping = match.get(attribute) or {}
+        if not isinstance(mapping, dict):
+          raise ValueError("{0}: selector {1} {2} must be a mapping".format(source, position, attribute))
+        for key, values in mapping.items():
+          self.criteria["{0}:{1}".format(prefix, key)] = self.get_values(values)
+
+  # Without duplicates, every value is indexed once and a criterion counts once per instance.
+  def get_values(self, values):
+    values = values if isinstance(values, list) else [values]
+    return(list(dict.fromkeys(str(value) for value in values)))
+
+  # Whether this selector needs more than the platform and the dimension, which the generator knows.
+  def needs_instance(self):
+    return(any(attribute != 'platform' and not attribute.startswith('dimension:') for attribute in self.criteria))
+
+# Every layer of a run merged and validated once. The selectors are compiled into an index
+# of (attribute, value) -> selector positions, so resolving an instance costs one lookup per
+# tag instead of a scan of every selector. The effective config is cached per set of matched
+# selectors, a fleet of 10000 instances has a handful of distinct sets.
+class CompiledManifest:
+  def __init__(self, manifest_files=None) -> None:
+      self.manifest_files = get_manifest_files(manifest_files)
+      # The merged top-level sections, applied to every instance.
+      self.manifest_vars = {}
+      # Metric name -> AlarmRule, a later layer replaces the rule of an earlier one.
+      self.custom_rules = {}
+      self.selectors = []
+      self.index = {}
+      # Selectors without criteria match every instance.
+      self.match_all = []
+      self.resolved = {}
+      for manifest_file in self.manifest_files:
+        self.add_layer(manifest_file)
+      for selector in self.selectors:
+        if len(selector.criteria) == 0:
+          self.match_all.append(selector.position)
+        for attribute, values in selector.criteria.items():
+          for value in values:
+            self.index.setdefault((attribute, value), []).append(selector.position)
+
+  def add_layer(self, manifest_file):
+    with open(manifest_file, 'r') as manifest_handler:
+      try:
+        manifest_vars = yaml.safe_load(manifest_handler) or {}
+      except yaml.YAMLError as exc:
+        raise ValueError("{0}: {1}".format(manifest_file, exc))
+    print("load self.manifest_vars = {0}".format(manifest_vars))
+    if not isinstance(manifest_vars, dict):
+      raise ValueError("{0}: a manifest must be a mapping".format(manifest_file))
+    self.custom_rules.update(pop_manifest_rules(manifest_vars))
+    selector_specs = manifest_vars.pop(CONST_SELECTORS_KEY, None) or []
+    if not isinstance(selector_specs, list):
+      raise ValueError("{0}: {1} must be a list".format(manifest_file, CONST_SELECTORS_KEY))
+    validate_sections(manifest_vars, manifest_file)
+    self.manifest_vars = deep_merge(self.manifest_vars, manifest_vars)
+    for selector_spec in selector_specs:
+      self.selectors.append(Selector(len(self.selectors), selector_spec, manifest_file))
+
+  # Whether resolving needs the tags or the instance type of an instance.
+  def needs_instances(self):
+    return(any(selector.needs_instance() for selector in self.selectors))
+
+  # The positions of the selectors matching the instance, in the order they apply.
+  def get_matches(self, instance_attributes):
+    hits = {}
+    for instance_key in get_instance_keys(instance_attributes):
+      for position in self.index.get(instance_key, []):
+        hits[position] = hits.get(position, 0) + 1
+    matches = self.match_all + [position for position, count in hits.items()
+                                if count == len(self.selectors[position].criteria)]
+    return(tuple(sorted(matches)))
+
+  # The effective alert config of an instance: the defaults of the generator class, every
+  # layer, then every matching selector. Callers must not modify the returned dict.
+  def get_alert_config(self, default_alert_config, instance_attributes):
+    # The defaults are a class attribute, their identity tells the generator classes apart.
+    resolved_key = (id(default_alert_config), self.get_matches(instance_attributes))
+    alert_config = self.resolved.get(resolved_key)
+    if alert_config is None:
+      alert_config = deep_merge(default_alert_config, self.manifest_vars)
+      for position in resolved_key[1]:
+        alert_config = deep_merge(alert_config, self.selectors[position].sections)
+      for metric_name, rule in self.custom_rules.items():
+        if rule.config_key not in alert_config:
+          raise ValueError("alarm rule for '{0}' needs a '{1}' section with enabled and the thresholds".format(
+              metric_name, rule.config_key))
+      self.resolved[resolved_key] = alert_config
+    return(alert_config)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+from clientpool import ClientPool
+from configgenerator import ConfigGenerator, get_alarm_metric
+
+class MetricIndex:
+  def __init__(self,
+                key,
+                metric_alarms,
+                metric_fstype,
+                namespaces=ConfigGenerator.default_metric_namespaces,
+                session=None,
+                instrumentation=None) -> None:
+      self.dimension_key = key
+      self.metric_alarms = set(metric_alarms)
+      self.metric_fstype = set(metric_fstype)
+      self.namespaces = namespaces
+      self.session = session
+      self.instrumentation = instrumentation
+      self.metrics_by_value = {}
+      self.metrics_seen = 0
+      self.metrics_indexed = 0
+
+  def get_client(self, service_name):
+    if self.session is None:
+      self.session = ClientPool()
+    client = self.session.client(service_name)
+    if self.instrumentation is not None:
+      self.instrumentation.instrument_client(client, service_name)
+    return(client)
+
+  # One paginated list_metrics sweep per namespace for every metric carrying the dimension key.
+  def build(self):
+    client = self.get_client('cloudwatch')
+    paginator = client.get_paginator('list_metrics')
+    param_dimensions = [{'Name': self.dimension_key}]
+    for namespace in self.namespaces:
+      for page in paginator.paginate(Namespace=namespace, Dimensions=param_dimensions):
+        for metric in page['Metrics']:
+          self.add_metric(metric)
+    print("indexed {0} of {1} metrics for {2} {3} values".format(
+        self.metrics_indexed,
+        self.metrics_seen,
+        len(self.metrics_by_value),
+        self.dimension_key))
+    return(self)
+
+  def add_metric(self, metric):
+    self.metrics_seen += 1
+    metric_record = get_alarm_metric(metric, self.metric_alarms, self.metric_fstype)
+    if metric_record is None:
+      return
+    value = metric_record.get_dimension(self.dimension_key)
+    if value:
+      self.metrics_by_value.setdefault(value, []).append(metric_record)
+      self.metrics_indexed += 1
+
+  def get_metrics(self, value):
+    return(list(self.metrics_by_value.get(value, [])))
+
+  def values(self):
+    return(list(self.metrics_by_value.keys()))
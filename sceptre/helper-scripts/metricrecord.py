@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import sys
+
+# Dimension names -> (the shared names tuple, name -> position). The records of one kind of
+# metric, e.g. every disk_used_percent with path, device and fstype, share both.
+dimension_schemas = {}
+
+def get_dimension_schema(dimension_names):
+  dimension_schema = dimension_schemas.get(dimension_names)
+  if dimension_schema is None:
+    dimension_names = tuple(sys.intern(dimension_name) for dimension_name in dimension_names)
+    dimension_index = {}
+    for position, dimension_name in enumerate(dimension_names):
+      dimension_index.setdefault(dimension_name.lower(), position)
+    # The exact names resolve to the first case-insensitive match as well, so the usual
+    # lookup does not lowercase its argument.
+    for dimension_name in dimension_names:
+      dimension_index.setdefault(dimension_name, dimension_index[dimension_name.lower()])
+    dimension_schema = (dimension_names, dimension_index)
+    dimension_schemas[dimension_names] = dimension_schema
+  return(dimension_schema)
+
+# One list_metrics entry. Much smaller than the boto3 dict with its list of Name/Value
+# dicts: the strings are interned, so an instance ID or a mount path repeated across
+# thousands of metrics is stored once, and the dimension names and their index are shared
+# by every record with the same names.
+class MetricRecord:
+  __slots__ = ('namespace', 'metric_name', 'dimension_names', 'dimension_values', 'dimension_index')
+
+  def __init__(self, namespace, metric_name, dimension_names, dimension_values) -> None:
+      self.namespace = sys.intern(namespace)
+      self.metric_name = sys.intern(metric_name)
+      self.dimension_names, self.dimension_index = get_dimension_schema(tuple(dimension_names))
+      self.dimension_values = tuple(sys.intern(dimension_value) for dimension_value in dimension_values)
+
+  @classmethod
+  def from_metric(cls, metric):
+    dimensions = metric.get('Dimensions', [])
+    return(cls(metric.get('Namespace', ''), metric['MetricName'],
+            [dimension['Name'] for dimension in dimensions],
+            [dimension['Value'] for dimension in dimensions]))
+
+  # Pickled by value and rebuilt through __init__, so a render worker process interns the
+  # strings and shares the dimension schemas again instead of receiving a copy of each.
+  def __reduce__(self):
+    return(MetricRecord, (self.namespace, self.metric_name, self.dimension_names, self.dimension_values))
+
+  # The list_metrics entry again, e.g. for the discovery cache.
+  def to_metric(self):
+    return({
+      'Namespace': self.namespace,
+      'MetricName': self.metric_name,
+      'Dimensions': [{'Name': dimension_name, 'Value': dimension_value}
+                      for dimension_name, dimension_value in self.get_dimensions()]
+    })
+
+  # The value of the dimension named dimension_name (case-insensitive), or ''.
+  def get_dimension(self, dimension_name):
+    position = self.dimension_index.get(dimension_name)
+    if position is None:
+      position = self.dimension_index.get(dimension_name.lower())
+      if position is None:
+        return('')
+    return(self.dimension_values[position])
+
+  # (name, value) pairs in the list_metrics order.
+  def get_dimensions(self):
+    return(zip(self.dimension_names, self.dimension_values))
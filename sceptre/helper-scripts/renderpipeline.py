@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import collections
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from alarmwriter import AlarmWriter
+from deploystate import get_alarm_digest
+
+CONST_DEFAULT_QUEUE_SIZE = 64
+# Put on the discovery queue after the last dimension value.
+CONST_END_OF_VALUES = None
+
+# The rendered alarms of one dimension value, serialized by a render worker.
+class RenderedAlarms:
+  def __init__(self, value, description, alarm_texts, digest, metric_count, render_seconds, serialize_seconds) -> None:
+      self.value = value
+      self.description = description
+      self.alarm_texts = alarm_texts
+      # The deploy-state digest of the alarms, None without a deploy state.
+      self.digest = digest
+      self.metric_count = metric_count
+      self.render_seconds = render_seconds
+      self.serialize_seconds = serialize_seconds
+
+# What a render worker needs to build the generators, sent once per worker process. The
+# generators get every lookup injected, a worker never calls AWS.
+class RenderSettings:
+  def __init__(self,
+                generator_class,
+                key,
+                in_alarm_warning,
+                ok_alarm_warning,
+                in_alarm_critical,
+                ok_alarm_critical,
+                use_recover,
+                aws_account_name,
+                manifest_yaml_file,
+                aws_account_id,
+                output_format,
+                manifest,
+                with_digest=False,
+                group_mode=False) -> None:
+      self.generator_class = generator_class
+      self.dimension_key = key
+      self.in_alarm_warning = in_alarm_warning
+      self.ok_alarm_warning = ok_alarm_warning
+      self.in_alarm_critical = in_alarm_critical
+      self.ok_alarm_critical = ok_alarm_critical
+      self.use_recover = use_recover
+      self.aws_account_name = aws_account_name
+      self.manifest_yaml_file = manifest_yaml_file
+      self.aws_account_id = aws_account_id
+      self.output_format = output_format
+      self.manifest = manifest
+      self.with_digest = with_digest
+      self.group_mode = group_mode
+
+  def render(self, value, instance_tag_name, metrics, instance_attributes):
+    start = time.perf_counter()
+    config_generator = self.generator_class(
+                        self.dimension_key, value,
+                        None,
+                        self.in_alarm_warning, self.ok_alarm_warning,
+                        self.in_alarm_critical, self.ok_alarm_critical,
+                        self.use_recover, self.aws_account_name,
+                        self.manifest_yaml_file,
+                        self.aws_account_id,
+                        output_format=self.output_format,
+                        instance_tag_name=instance_tag_name,
+                        manifest=self.manifest,
+                        instance_attributes=instance_attributes)
+    config_generator.group_mode = self.group_mode
+    alarms = config_generator.get_alarm_list(metrics)
+    rendered_at = time.perf_counter()
+    # Only format_alarm is used, the writer never opens a file here.
+    alarm_writer = AlarmWriter('', self.output_format)
+    alarm_texts = [alarm_writer.format_alarm(alarm_data) for alarm_data in alarms]
+    digest = get_alarm_digest(alarms, self.manifest_yaml_file, self.output_format) if self.with_digest else None
+    return(RenderedAlarms(value,
+            config_generator.get_template_description(),
+            alarm_texts,
+            digest,
+            len(metrics),
+            rendered_at - start,
+            time.perf_counter() - rendered_at))
+
+# The RenderSettings of this worker process, set by its initializer.
+render_settings = None
+
+def init_render_worker(settings):
+  global render_settings
+  render_settings = settings
+
+def render_alarms(value, instance_tag_name, metrics, instance_attributes):
+  return(render_settings.render(value, instance_tag_name, metrics, instance_attributes))
+
+# Fleet generation in three stages connected by bounded queues:
+# - discovery, the Name tag and the metrics of every value on FleetGenerator's worker threads,
+# - render, alarm names, dimensions and YAML or JSON text in a pool of processes, so it is
+#   not bound to the one core the GIL allows,
+# - write, one thread writing the files and the deploy state in the order of the values.
+# At most queue_size values wait between two stages, a slow stage holds the one before it
+# back instead of letting rendered output pile up in memory.
+class RenderPipeline:
+  def __init__(self, fleet_generator, processes, queue_size=CONST_DEFAULT_QUEUE_SIZE) -> None:
+      self.fleet_generator = fleet_generator
+      self.processes = max(1, int(processes))
+      self.queue_size = max(1, int(queue_size))
+      self.discovered = queue.Queue(maxsize=self.queue_size)
+
+  # Discovers the values on a thread pool and puts (value, (Name tag, metrics, attributes)),
+  # or (value, exception), on the discovered queue in the order of the values.
+  def discover(self, values, discovered):
+    fleet_generator = self.fleet_generator
+    try:
+      with ThreadPoolExecutor(max_workers=fleet_generator.max_workers) as executor:
+        pending = collections.deque()
+        for value in values:
+          pending.append((value, executor.submit(fleet_generator.discover_one, value, *discovered[value])))
+          if len(pending) >= self.queue_size:
+            self.put_discovered(*pending.popleft())
+        while len(pending) > 0:
+          self.put_discovered(*pending.popleft())
+    finally:
+      self.discovered.put(CONST_END_OF_VALUES)
+
+  def put_discovered(self, value, future):
+    try:
+      self.discovered.put((value, future.result()))
+    except Exception as exc:
+      self.discovered.put((value, exc))
+
+  # Returns a dict of value -> output file, or None when unchanged, and a dict of value -> exception.
+  def run(self, discovered):
+    fleet_generator = self.fleet_generator
+    settings = fleet_generator.get_render_settings()
+    discovery = threading.Thread(target=self.discover, args=(list(discovered), discovered), daemon=True)
+    discovery.start()
+    results = {}
+    errors = {}
+    # spawn, a forked child would inherit the locks the discovery threads hold.
+    with ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+          initializer=init_render_worker, initargs=(settings,)) as executor:
+      pending = collections.deque()
+      while True:
+        item = self.discovered.get()
+        if item is CONST_END_OF_VALUES:
+          break
+        value, discovery_result = item
+        if isinstance(discovery_result, Exception):
+          pending.append((value, discovery_result))
+        else:
+          pending.append((value, executor.submit(render_alarms, value, *discovery_result)))
+        if len(pending) >= self.queue_size:
+          self.write(*pending.popleft(), results, errors)
+      while len(pending) > 0:
+        self.write(*pending.popleft(), results, errors)
+    discovery.join()
+    return(results, errors)
+
+  def write(self, value, future, results, errors):
+    try:
+      if isinstance(future, Exception):
+        raise future
+      results[value] = self.fleet_generator.write_rendered(future.result())
+    except Exception as exc:
+      errors[value] = exc
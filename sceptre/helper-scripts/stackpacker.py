@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import sys
+
+import yaml
+
+from cfntemplate import CONST_FORMAT_CFN_JSON, CONST_FORMAT_CFN_YAML, dump_template, get_template
+
+# CloudFormation quotas: 500 resources per stack, 51,200 bytes for a template body
+# passed directly, 1 MB for a template uploaded to S3 (template_bucket_name in Sceptre).
+CONST_MAX_STACK_RESOURCES = 500
+CONST_MAX_TEMPLATE_BYTES = 51200
+# Headroom for the template header and the serializer not being exactly additive.
+CONST_TEMPLATE_OVERHEAD_BYTES = 1024
+CONST_DEFAULT_STACK_PREFIX = 'cwalarm-packed'
+CONST_DEFAULT_INPUT_DIR = 'sceptre/generated-config/fleet'
+CONST_DEFAULT_TEMPLATE_DIR = 'sceptre/templates'
+CONST_DEFAULT_CONFIG_DIR = 'sceptre/config'
+CONST_DEFAULT_STATE_FILE = 'sceptre/generated-config/stack-assignments.json'
+CONST_CONFIG_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helper-templates', 'cwalarm-packed-config-template.yaml')
+CONST_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+class InstanceAlarms:
+  def __init__(self, value, alarms, output_format) -> None:
+      self.value = value
+      # The logical IDs are derived from the alarm dimensions, which include the instance,
+      # so they are unique across the instances packed into one stack.
+      self.resources = get_template(alarms)['Resources']
+      self.resource_count = len(self.resources)
+      buffer = io.StringIO()
+      dump_template({'Resources': self.resources}, buffer, output_format)
+      self.template_bytes = len(buffer.getvalue().encode('utf-8'))
+
+class Stack:
+  def __init__(self, name) -> None:
+      self.name = name
+      self.instances = []
+      self.resource_count = 0
+      self.template_bytes = CONST_TEMPLATE_OVERHEAD_BYTES
+
+  def fits(self, instance_alarms, max_resources, max_template_bytes):
+    return(self.resource_count + instance_alarms.resource_count <= max_resources
+      and self.template_bytes + instance_alarms.template_bytes <= max_template_bytes)
+
+  def add(self, instance_alarms):
+    self.instances.append(instance_alarms)
+    self.resource_count += instance_alarms.resource_count
+    self.template_bytes += instance_alarms.template_bytes
+
+# Bin-packs the alarms of many instances into stacks within the CloudFormation limits.
+# Assignments are kept in a state file so an instance stays in its stack across runs,
+# only new instances and instances evicted from a stack that outgrew the limits move.
+class StackPacker:
+  def __init__(self,
+                max_resources=CONST_MAX_STACK_RESOURCES,
+                max_template_bytes=CONST_MAX_TEMPLATE_BYTES,
+                previous_assignments=None) -> None:
+      self.max_resources = max_resources
+      self.max_template_bytes = max_template_bytes
+      self.previous_assignments = previous_assignments or {}
+      self.stacks = {}
+      self.unplaced = []
+
+  def get_stack_name(self, number):
+    return("stack-{0:03d}".format(number))
+
+  def new_stack(self):
+    number = 0
+    while self.get_stack_name(number) in self.stacks or self.get_stack_name(number) in self.previous_assignments.values():
+      number += 1
+    stack = Stack(self.get_stack_name(number))
+    self.stacks[stack.name] = stack
+    return(stack)
+
+  def pack(self, instances):
+    pending = []
+    # Keep the previous assignments while they still fit, evicting in instance order.
+    for instance_alarms in sorted(instances, key=lambda item: item.value):
+      stack_name = self.previous_assignments.get(instance_alarms.value)
+      if stack_name is None:
+        pending.append(instance_alarms)
+        continue
+      stack = self.stacks.setdefault(stack_name, Stack(stack_name))
+      if stack.fits(instance_alarms, self.max_resources, self.max_template_bytes):
+        stack.add(instance_alarms)
+      else:
+        pending.append(instance_alarms)
+    # First-fit decreasing for the rest.
+    pending.sort(key=lambda item: (-item.template_bytes, item.value))
+    for instance_alarms in pending:
+      if instance_alarms.resource_count > self.max_resources or \
+        instance_alarms.template_bytes + CONST_TEMPLATE_OVERHEAD_BYTES > self.max_template_bytes:
+        self.unplaced.append(instance_alarms)
+        continue
+      for stack in sorted(self.stacks.values(), key=lambda item: item.name):
+        if stack.fits(instance_alarms, self.max_resources, self.max_template_bytes):
+          stack.add(instance_alarms)
+          break
+      else:
+        self.new_stack().add(instance_alarms)
+    return(self.stacks)
+
+  def get_assignments(self):
+    return({instance_alarms.value: stack.name for stack in self.stacks.values() for instance_alarms in stack.instances})
+
+# Only the sceptre_user_data alarm lists of fleet mode's default -f sceptre can be packed, a
+# CloudFormation template of -f cfn-yaml or cfn-json is rejected instead of skipped or misread.
+def load_instance_alarms(input_dir, output_format):
+  instances = []
+  for file_name in sorted(os.listdir(input_dir)):
+    value, extension = os.path.splitext(file_name)
+    input_file = os.path.join(input_dir, file_name)
+    if extension == '.json':
+      raise ValueError("{0}: a CloudFormation template, generate the fleet with -f sceptre to pack it".format(input_file))
+    if extension not in ['.yaml', '.yml']:
+      continue
+    with open(input_file, 'r') as file:
+      alarms = yaml.load(file, Loader=CONST_YAML_LOADER) or []
+    if isinstance(alarms, dict) and 'Resources' in alarms:
+      raise ValueError("{0}: a CloudFormation template, generate the fleet with -f sceptre to pack it".format(input_file))
+    if not isinstance(alarms, list) or not all(isinstance(alarm, dict) and 'name' in alarm for alarm in alarms):
+      raise ValueError("{0}: not a sceptre_user_data alarm list".format(input_file))
+    instances.append(InstanceAlarms(value, alarms, output_format))
+  return(instances)
+
+def load_assignments(state_file):
+  if not os.path.exists(state_file):
+    return({})
+  with open(state_file, 'r') as file:
+    return(json.load(file).get('assignments', {}))
+
+def write_stacks(stacks, previous_assignments, template_dir, config_dir, stack_prefix, output_format):
+  extension = 'json' if output_format == CONST_FORMAT_CFN_JSON else 'yaml'
+  template_group_dir = os.path.join(template_dir, stack_prefix)
+  config_group_dir = os.path.join(config_dir, stack_prefix)
+  os.makedirs(template_group_dir, exist_ok=True)
+  os.makedirs(config_group_dir, exist_ok=True)
+  with open(CONST_CONFIG_TEMPLATE, 'r') as file:
+    config_template = file.read()
+  for stack in stacks.values():
+    if len(stack.instances) == 0:
+      continue
+    template = get_template([], "CloudWatch alarms packed stack {0}".format(stack.name))
+    for instance_alarms in stack.instances:
+      template['Resources'].update(instance_alarms.resources)
+    with open(os.path.join(template_group_dir, "{0}.{1}".format(stack.name, extension)), 'w') as file:
+      dump_template(template, file, output_format)
+    with open(os.path.join(config_group_dir, "{0}.yaml".format(stack.name)), 'w') as file:
+      file.write(config_template.replace('TEMPLATE_PATH', "{0}/{1}.{2}".format(stack_prefix, stack.name, extension)))
+    print("{0}: {1} instances, {2} alarms, {3} template bytes".format(
+        stack.name, len(stack.instances), stack.resource_count, stack.template_bytes))
+  # Stacks left without instances have to be deleted, not updated to an empty template.
+  for stack_name in sorted(set(previous_assignments.values())):
+    if stack_name not in stacks or len(stacks[stack_name].instances) == 0:
+      for path in [os.path.join(template_group_dir, "{0}.{1}".format(stack_name, extension)),
+                    os.path.join(config_group_dir, "{0}.yaml".format(stack_name))]:
+        if os.path.exists(path):
+          os.remove(path)
+      print("{0}: no instances left, delete the stack".format(stack_name))
+
+def save_assignments(state_file, assignments):
+  os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+  with open(state_file + '.tmp', 'w') as file:
+    json.dump({'assignments': assignments}, file, indent=2, sort_keys=True)
+  os.replace(state_file + '.tmp', state_file)
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Pack the per-instance alarm YAML of fleet mode into CloudFormation stacks")
+  parser.add_argument('-d', dest='input_dir', default=CONST_DEFAULT_INPUT_DIR,
+                    help='The directory of per-instance alarm YAML written by fleet mode with -f sceptre')
+  parser.add_argument('-s', dest='state_file', default=CONST_DEFAULT_STATE_FILE,
+                    help='The file keeping the instance to stack assignments between runs')
+  parser.add_argument('-p', dest='stack_prefix', default=CONST_DEFAULT_STACK_PREFIX,
+                    help='The Sceptre stack group, the directory of the packed stack configs and templates')
+  parser.add_argument('-f', '--format', dest='output_format', default=CONST_FORMAT_CFN_YAML,
+                    choices=[CONST_FORMAT_CFN_YAML, CONST_FORMAT_CFN_JSON], help='The template format')
+  parser.add_argument('--template-dir', dest='template_dir', default=CONST_DEFAULT_TEMPLATE_DIR,
+                    help='The Sceptre templates directory')
+  parser.add_argument('--config-dir', dest='config_dir', default=CONST_DEFAULT_CONFIG_DIR,
+                    help='The Sceptre config directory')
+  parser.add_argument('--max-resources', dest='max_resources', type=int, default=CONST_MAX_STACK_RESOURCES,
+                    help='The maximum number of alarms per stack')
+  parser.add_argument('--max-template-bytes', dest='max_template_bytes', type=int, default=CONST_MAX_TEMPLATE_BYTES,
+                    help='The maximum template size, 1000000 when Sceptre uploads the templates to S3')
+
+  args = parser.parse_args()
+  previous_assignments = load_assignments(args.state_file)
+  try:
+    instances = load_instance_alarms(args.input_dir, args.output_format)
+  except ValueError as exc:
+    parser.error(str(exc))
+  stack_packer = StackPacker(args.max_resources, args.max_template_bytes, previous_assignments)
+  stacks = stack_packer.pack(instances)
+  write_stacks(stacks, previous_assignments, args.template_dir, args.config_dir, args.stack_prefix, args.output_format)
+  save_assignments(args.state_file, stack_packer.get_assignments())
+  for instance_alarms in stack_packer.unplaced:
+    print("{0}: {1} alarms, {2} bytes, does not fit in one stack".format(
+        instance_alarms.value, instance_alarms.resource_count, instance_alarms.template_bytes))
+  sys.exit(0 if len(stack_packer.unplaced) == 0 else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import datetime
+import threading
+
+import yaml
+
+from manifestcompiler import CONST_SELECTORS_KEY
+
+# get_metric_data accepts up to 500 queries per call.
+CONST_METRIC_DATA_BATCH = 500
+CONST_DEFAULT_TUNE_DAYS = 14
+# Five-minute statistics are kept for 63 days, one-minute ones only for 15.
+CONST_DEFAULT_TUNE_PERIOD = 300
+CONST_DEFAULT_WARNING_PERCENTILE = 99.0
+CONST_DEFAULT_CRITICAL_PERCENTILE = 99.9
+CONST_DEFAULT_TUNE_MARGIN = 0.1
+# Sections whose thresholds are percentages and never suggested above 100.
+CONST_PERCENT_CONFIG_KEYS = ['disk_used_percent', 'disk_free_percent', 'mem_used_percent', 'cpu_utilization']
+
+# Imported on first use, only tuning needs NumPy.
+def import_numpy():
+  try:
+    import numpy
+  except ImportError:
+    raise RuntimeError("threshold tuning needs NumPy, pip install numpy")
+  return(numpy)
+
+# The metric of one get_metric_data query and the manifest section it tunes.
+class TunedMetric:
+  def __init__(self, dimension_key, dimension_value, rule, metric) -> None:
+      self.dimension_key = dimension_key
+      self.dimension_value = dimension_value
+      self.config_key = rule.config_key
+      # Greater than: a busy host alarms above its usual peak. Less than: below its usual low.
+      self.is_upper = rule.comparison_operator.startswith('Greater')
+      self.levels = [level for level, level_name, threshold_key in rule.severities]
+      self.namespace = rule.namespace
+      self.metric_name = metric.metric_name
+      self.dimensions = [{'Name': dimension_name, 'Value': dimension_value}
+                          for dimension_name, dimension_value in metric.get_dimensions()]
+      self.statistic = rule.statistic
+
+  def get_query(self, query_id, period):
+    return({
+      'Id': query_id,
+      'MetricStat': {
+        'Metric': {'Namespace': self.namespace, 'MetricName': self.metric_name, 'Dimensions': self.dimensions},
+        'Period': period,
+        'Stat': self.statistic
+      },
+      'ReturnData': True
+    })
+
+# Suggests thresholds from the recent history of the alarmed metrics. The history is pulled
+# with get_metric_data, 500 metrics per call, and the percentiles of each batch are computed
+# in one NumPy pass, so memory holds one batch of history however large the fleet is.
+#   warning  = the warning_percentile of the history, plus margin
+#   critical = the critical_percentile of the history, plus margin
+# The percentiles are mirrored, e.g. the 1st instead of the 99th, and the margin subtracted for
+# the less-than rules like cpu_credit_balance. A section covering several metrics of one value,
+# e.g. the disk_used_percent of every path, gets the least sensitive threshold of them.
+class ThresholdTuner:
+  def __init__(self,
+                days=CONST_DEFAULT_TUNE_DAYS,
+                period=CONST_DEFAULT_TUNE_PERIOD,
+                warning_percentile=CONST_DEFAULT_WARNING_PERCENTILE,
+                critical_percentile=CONST_DEFAULT_CRITICAL_PERCENTILE,
+                margin=CONST_DEFAULT_TUNE_MARGIN,
+                instrumentation=None) -> None:
+      self.days = days
+      self.period = int(period)
+      self.percentiles = {'warning': warning_percentile, 'critical': critical_percentile}
+      self.margin = margin
+      self.instrumentation = instrumentation
+      self.tuned_metrics = []
+      # (dimension key, dimension value) -> config key -> level -> threshold.
+      self.thresholds = {}
+      # Fleet mode adds the metrics of several values at once.
+      self.lock = threading.Lock()
+
+  # Add the metrics of a generator that it would alarm on with a threshold of alert_config.
+  def add_generator(self, config_generator, metrics):
+    tuned_metrics = []
+    for metric in metrics:
+      rule = config_generator.get_alarm_rule(metric)
+      if rule is None or rule.threshold is not None or not rule.comparison_operator.startswith(('Greater', 'Less')):
+        continue
+      tuned_metrics.append(TunedMetric(config_generator.dimension_key, config_generator.dimension_value, rule, metric))
+    with self.lock:
+      self.tuned_metrics.extend(tuned_metrics)
+
+  # Fetch the history of every metric added and suggest its thresholds.
+  def tune(self, client):
+    # Fail before reading any history.
+    import_numpy()
+    end_time = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+    start_time = end_time - datetime.timedelta(days=self.days)
+    paginator = client.get_paginator('get_metric_data')
+    for ii in range(0, len(self.tuned_metrics), CONST_METRIC_DATA_BATCH):
+      batch = self.tuned_metrics[ii:ii + CONST_METRIC_DATA_BATCH]
+      # The Ids only need to be unique within a call and to start with a lowercase letter.
+      queries = [tuned_metric.get_query("m{0}".format(position), self.period) for position, tuned_metric in enumerate(batch)]
+      history = [[] for tuned_metric in batch]
+      pages = paginator.paginate(MetricDataQueries=queries, StartTime=start_time, EndTime=end_time)
+      if self.instrumentation is not None:
+        pages = self.instrumentation.timed(pages, 'get_metric_data')
+      for page in pages:
+        for result in page['MetricDataResults']:
+          history[int(result['Id'][1:])].extend(result['Values'])
+      self.add_history(batch, history)
+    return(self.thresholds)
+
+  def add_history(self, batch, history):
+    numpy = import_numpy()
+    rows = [position for position, values in enumerate(history) if len(values) > 0]
+    if len(rows) == 0:
+      return
+    lengths = numpy.array([len(history[position]) for position in rows])
+    # One row per metric, padded with NaN to the longest history of the batch.
+    matrix = numpy.full((len(rows), lengths.max()), numpy.nan)
+    matrix[numpy.arange(matrix.shape[1]) < lengths[:, None]] = numpy.concatenate([history[position] for position in rows])
+    is_upper = numpy.array([batch[position].is_upper for position in rows])
+    suggestions = {}
+    for level, percentile in self.percentiles.items():
+      upper = numpy.nanpercentile(matrix, percentile, axis=1) * (1 + self.margin)
+      lower = numpy.nanpercentile(matrix, 100 - percentile, axis=1) * (1 - self.margin)
+      suggestions[level] = numpy.maximum(numpy.where(is_upper, upper, lower), 0)
+    for row, position in enumerate(rows):
+      tuned_metric = batch[position]
+      for level in tuned_metric.levels:
+        self.add_threshold(tuned_metric, level, float(suggestions[level][row]))
+
+  def add_threshold(self, tuned_metric, level, threshold):
+    if tuned_metric.config_key in CONST_PERCENT_CONFIG_KEYS:
+      threshold = min(threshold, 100.0)
+    threshold = round(threshold, 2)
+    levels = self.thresholds.setdefault((tuned_metric.dimension_key, tuned_metric.dimension_value), {}) \
+              .setdefault(tuned_metric.config_key, {})
+    previous = levels.get(level)
+    if previous is not None:
+      threshold = max(previous, threshold) if tuned_metric.is_upper else min(previous, threshold)
+    levels[level] = threshold
+
+  # A manifest with one selector per dimension value, layer it over the hand-written ones:
+  #   cwalarmlinux.py -m small_cpu_credit.yaml -m tuned.yaml ...
+  def get_manifest(self):
+    selectors = []
+    for (dimension_key, dimension_value), sections in sorted(self.thresholds.items()):
+      config = {config_key: {"{0}_threshold".format(level): threshold for level, threshold in levels.items()}
+                  for config_key, levels in sorted(sections.items())}
+      selectors.append({'match': {'dimensions': {dimension_key: dimension_value}}, 'config': config})
+    return({CONST_SELECTORS_KEY: selectors})
+
+  def write_manifest(self, manifest_file):
+    header = "# Suggested by thresholdtuner.py from {0} days of {1}s statistics, warning at p{2}, " \
+             "critical at p{3}, margin {4}.\n".format(self.days, self.period, self.percentiles['warning'],
+                self.percentiles['critical'], self.margin)
+    with open(manifest_file, 'w') as file:
+      file.write(header)
+      yaml.safe_dump(self.get_manifest(), file, sort_keys=False, default_flow_style=False)
+    print("suggested thresholds for {0} values in {1}".format(len(self.thresholds), manifest_file))
+    return(manifest_file)
+
+def add_tune_arguments(parser):
+  parser.add_argument('--tune-thresholds', dest='tune_manifest',
+                    help='Write thresholds suggested by the metric history to this manifest instead of generating alarms')
+  parser.add_argument('--tune-days', dest='tune_days', type=int, default=CONST_DEFAULT_TUNE_DAYS,
+                    help='Tuning: the days of history to read')
+  parser.add_argument('--tune-period', dest='tune_period', type=int, default=CONST_DEFAULT_TUNE_PERIOD,
+                    help='Tuning: the period in seconds of the statistics read')
+  parser.add_argument('--warning-percentile', dest='warning_percentile', type=float, default=CONST_DEFAULT_WARNING_PERCENTILE,
+                    help='Tuning: the percentile of the history the warning threshold is set at')
+  parser.add_argument('--critical-percentile', dest='critical_percentile', type=float, default=CONST_DEFAULT_CRITICAL_PERCENTILE,
+                    help='Tuning: the percentile of the history the critical threshold is set at')
+  parser.add_argument('--tune-margin', dest='tune_margin', type=float, default=CONST_DEFAULT_TUNE_MARGIN,
+                    help='Tuning: the headroom added to the percentiles, 0.1 is 10%%')
+
+def get_threshold_tuner(args, instrumentation=None):
+  return(ThresholdTuner(args.tune_days, args.tune_period,
+          args.warning_percentile, args.critical_percentile,
+          args.tune_margin, instrumentation))
+
+def run_tune(config_generator, args):
+  threshold_tuner = get_threshold_tuner(args, config_generator.instrumentation)
+  threshold_tuner.add_generator(config_generator, config_generator.get_metrics())
+  threshold_tuner.tune(config_generator.get_client('cloudwatch'))
+  threshold_tuner.write_manifest(args.tune_manifest)
+  return(0)
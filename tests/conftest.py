@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The helper scripts import each other as top-level modules, and the benchmark's AWS
+# stand-in serves the tests, so neither boto3 nor credentials are needed.
+CONST_REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(CONST_REPO_DIR, 'sceptre', 'helper-scripts'))
+sys.path.insert(0, os.path.join(CONST_REPO_DIR, 'benchmarks'))
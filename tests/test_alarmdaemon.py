@@ -0,0 +1,40 @@
+import io
+import queue
+
+from alarmdaemon import CONST_END_OF_EVENTS, Debouncer, read_events
+
+def test_debouncer_waits_for_quiet_period():
+  debouncer = Debouncer(delay=5, max_delay=60)
+  debouncer.touch('i-1', 100)
+  assert debouncer.get_timeout(100) == 5
+  debouncer.touch('i-1', 103)
+  assert debouncer.pop_due(106) == []
+  assert debouncer.get_timeout(106) == 2
+  assert debouncer.pop_due(108) == ['i-1']
+  assert debouncer.get_timeout(108) is None
+
+def test_debouncer_max_delay_bounds_a_busy_key():
+  debouncer = Debouncer(delay=5, max_delay=12)
+  for now in range(100, 112, 2):
+    debouncer.touch('i-1', now)
+  assert debouncer.pop_due(111) == []
+  assert debouncer.pop_due(112) == ['i-1']
+  # The next burst starts a new max_delay window.
+  debouncer.touch('i-1', 113)
+  assert debouncer.get_timeout(113) == 5
+
+def test_debouncer_pops_due_keys_sorted():
+  debouncer = Debouncer(delay=5, max_delay=60)
+  debouncer.touch('i-2', 100)
+  debouncer.touch('i-1', 101)
+  debouncer.touch('i-3', 110)
+  assert debouncer.pop_due(106) == ['i-1', 'i-2']
+  assert debouncer.get_timeout(200) == 0.0
+  debouncer.touch('i-4', 110)
+  # Without a time, every pending key is popped, e.g. at the end of the events.
+  assert debouncer.pop_due() == ['i-3', 'i-4']
+
+def test_read_events_skips_malformed_lines():
+  events = queue.Queue()
+  read_events(io.StringIO('{"a": 1}\n\nnot json\n{"b": 2}\n'), events)
+  assert [events.get_nowait() for _ in range(3)] == [{'a': 1}, {'b': 2}, CONST_END_OF_EVENTS]
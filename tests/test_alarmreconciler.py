@@ -0,0 +1,87 @@
+import os
+
+from alarmreconciler import AlarmReconciler, get_alarm_name_prefixes, get_changed_fields
+from cwalarmlinux import LinuxConfigGenerator
+from fakeaws import FakeFleet, FakeSession
+
+def get_generator(session, instance_id, use_recover='false'):
+  return(LinuxConfigGenerator('InstanceId', instance_id, os.devnull,
+          'arn:warning', 'arn:warning', 'arn:critical', 'arn:critical', use_recover, 'test', '',
+          session=session))
+
+def get_reconciler(session, config_generator):
+  return(AlarmReconciler('InstanceId', [config_generator.dimension_value],
+          get_alarm_name_prefixes(config_generator.alarm_rules), session))
+
+def get_alarms(config_generator):
+  return(config_generator.get_alarm_list(config_generator.get_metrics()))
+
+def test_reconcile_creates_then_leaves_alarms_unchanged():
+  fleet = FakeFleet(1, 6)
+  session = FakeSession(fleet)
+  config_generator = get_generator(session, fleet.instance_ids[0])
+  alarms = get_alarms(config_generator)
+  alarm_diff = get_reconciler(session, config_generator).reconcile(alarms)
+  assert len(alarm_diff.created) == len(alarms) > 0
+  assert len(session.alarms) == len(alarms)
+  alarm_diff = get_reconciler(session, config_generator).reconcile(alarms)
+  assert not alarm_diff.has_changes()
+  assert len(alarm_diff.unchanged) == len(alarms)
+
+def test_reconcile_updates_changed_fields_only():
+  fleet = FakeFleet(1, 6)
+  session = FakeSession(fleet)
+  config_generator = get_generator(session, fleet.instance_ids[0])
+  alarms = get_alarms(config_generator)
+  get_reconciler(session, config_generator).reconcile(alarms)
+  alarm_name = sorted(session.alarms)[0]
+  session.alarms[alarm_name]['Threshold'] += 1
+  # Dimensions in another order are the same alarm.
+  session.alarms[alarm_name]['Dimensions'].reverse()
+  alarm_diff = get_reconciler(session, config_generator).diff(alarms)
+  assert [(request['AlarmName'], list(changed_fields)) for request, changed_fields in alarm_diff.updated] == \
+    [(alarm_name, ['Threshold'])]
+  assert alarm_diff.created == [] and alarm_diff.deleted == []
+
+def test_reconcile_deletes_stale_alarms_of_its_instance_only():
+  fleet = FakeFleet(2, 6)
+  session = FakeSession(fleet)
+  generators = [get_generator(session, instance_id) for instance_id in fleet.instance_ids]
+  for config_generator in generators:
+    get_reconciler(session, config_generator).reconcile(get_alarms(config_generator))
+  stale_names = ["[WARNING] stale {0:03d}".format(ii) for ii in range(150)]
+  for alarm_name in stale_names:
+    session.alarms[alarm_name] = {'AlarmName': alarm_name,
+                                  'Dimensions': [{'Name': 'InstanceId', 'Value': fleet.instance_ids[0]}]}
+  session.alarms['[WARNING] unmanaged'] = {'AlarmName': '[WARNING] unmanaged', 'Dimensions': []}
+  other_alarms = {alarm_name for alarm_name, alarm in session.alarms.items()
+                  if {'Name': 'InstanceId', 'Value': fleet.instance_ids[1]} in alarm['Dimensions']}
+  session.reset_calls()
+  alarm_diff = get_reconciler(session, generators[0]).reconcile(get_alarms(generators[0]))
+  assert alarm_diff.deleted == stale_names
+  # delete_alarms takes up to 100 names per call.
+  assert session.reset_calls()['cloudwatch.DeleteAlarms'] == 2
+  assert other_alarms <= set(session.alarms)
+  assert '[WARNING] unmanaged' in session.alarms
+
+def test_dry_run_changes_nothing():
+  fleet = FakeFleet(1, 6)
+  session = FakeSession(fleet)
+  config_generator = get_generator(session, fleet.instance_ids[0])
+  alarm_diff = get_reconciler(session, config_generator).reconcile(get_alarms(config_generator), dry_run=True)
+  assert len(alarm_diff.created) > 0
+  assert session.alarms == {}
+
+def test_recover_action_is_resolved_for_the_region():
+  fleet = FakeFleet(1, 6)
+  session = FakeSession(fleet)
+  config_generator = get_generator(session, fleet.instance_ids[0], use_recover='true')
+  get_reconciler(session, config_generator).reconcile(get_alarms(config_generator))
+  actions = [action for alarm in session.alarms.values() for action in alarm['AlarmActions']]
+  assert 'arn:aws:automate:ap-southeast-2:ec2:recover' in actions
+
+def test_changed_fields_ignore_number_types_and_action_order():
+  existing_alarm = {'Threshold': 80.0, 'Period': 300, 'AlarmActions': ['b', 'a']}
+  request = {'Threshold': '80', 'Period': 300, 'AlarmActions': ['a', 'b']}
+  assert get_changed_fields(existing_alarm, request) == {}
+  assert list(get_changed_fields(existing_alarm, dict(request, Threshold=90))) == ['Threshold']
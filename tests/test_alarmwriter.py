@@ -0,0 +1,115 @@
+import json
+import os
+
+import pytest
+import yaml
+
+from alarmwriter import AlarmWriter, ShardedAlarmWriter
+from cfntemplate import CONST_FORMAT_CFN_JSON, CONST_FORMAT_CFN_YAML, CONST_FORMAT_SCEPTRE, CONST_YAML_DUMPER, \
+  dump_template, get_template
+from cwalarmlinux import LinuxConfigGenerator
+from fakeaws import FakeFleet, FakeSession
+
+@pytest.fixture(scope='module')
+def alarms():
+  fleet = FakeFleet(1, 8)
+  config_generator = LinuxConfigGenerator('InstanceId', fleet.instance_ids[0], os.devnull,
+                      'arn:warning', 'arn:warning', 'arn:critical', 'arn:critical', 'true', 'test', '',
+                      session=FakeSession(fleet))
+  return(config_generator.get_alarm_list(config_generator.get_metrics()))
+
+def write_alarms(output_file, alarms, **kwargs):
+  with ShardedAlarmWriter(output_file, **kwargs) as sharded_writer:
+    for alarm_data in alarms:
+      sharded_writer.write(alarm_data)
+  return(sharded_writer.output_files)
+
+def load_alarms(output_files):
+  alarms = []
+  for output_file in output_files:
+    with open(output_file, 'r') as output_handler:
+      alarms.extend(yaml.safe_load(output_handler))
+  return(alarms)
+
+def get_names(output_dir):
+  return(sorted(os.listdir(output_dir)))
+
+@pytest.mark.parametrize('output_format', [CONST_FORMAT_SCEPTRE, CONST_FORMAT_CFN_YAML, CONST_FORMAT_CFN_JSON])
+@pytest.mark.parametrize('alarm_count', [0, 1, 5])
+def test_streamed_output_matches_a_single_dump(tmp_path, alarms, output_format, alarm_count):
+  output_file = str(tmp_path / 'out.yaml')
+  writer = AlarmWriter(output_file, output_format, 'test alarms').open()
+  for alarm_data in alarms[:alarm_count]:
+    writer.write(alarm_data)
+  writer.close()
+  with open(output_file, 'r') as output_handler:
+    text = output_handler.read()
+  if output_format == CONST_FORMAT_SCEPTRE:
+    assert text == yaml.dump(alarms[:alarm_count], Dumper=CONST_YAML_DUMPER, default_flow_style=False)
+  else:
+    expected_file = str(tmp_path / 'expected.yaml')
+    with open(expected_file, 'w') as expected_handler:
+      dump_template(get_template(alarms[:alarm_count], 'test alarms'), expected_handler, output_format)
+    with open(expected_file, 'r') as expected_handler:
+      expected_text = expected_handler.read()
+    if output_format == CONST_FORMAT_CFN_JSON:
+      assert json.loads(text) == json.loads(expected_text)
+    else:
+      assert text == expected_text
+
+def test_rotation_by_alarm_count(tmp_path, alarms):
+  output_files = write_alarms(str(tmp_path / 'out.yaml'), alarms, max_alarms=4)
+  assert [os.path.basename(output_file) for output_file in output_files][:2] == ['out.yaml', 'out-002.yaml']
+  assert len(output_files) == (len(alarms) + 3) // 4
+  assert load_alarms(output_files) == alarms
+
+def test_rotation_by_size(tmp_path, alarms):
+  max_bytes = 2000
+  output_files = write_alarms(str(tmp_path / 'out.yaml'), alarms, max_bytes=max_bytes)
+  assert len(output_files) > 1
+  assert all(os.path.getsize(output_file) <= max_bytes for output_file in output_files)
+  assert load_alarms(output_files) == alarms
+
+def test_shard_dimension(tmp_path, alarms):
+  output_files = write_alarms(str(tmp_path / 'out.yaml'), alarms, shard_dimension='device')
+  # The alarms without the dimension go to the output file itself.
+  assert 'out.yaml' in get_names(tmp_path)
+  assert 'out-nvme0n1.yaml' in get_names(tmp_path)
+  with open(str(tmp_path / 'out-nvme0n1.yaml'), 'r') as output_handler:
+    assert all(alarm_data['dimensions']['device'].strip("'") == 'nvme0n1'
+               for alarm_data in yaml.safe_load(output_handler))
+  assert sorted(alarm_data['name'] for alarm_data in load_alarms(output_files)) == \
+    sorted(alarm_data['name'] for alarm_data in alarms)
+
+def test_index_removes_stale_shards_only(tmp_path, alarms):
+  (tmp_path / 'out-prod.yaml').write_text('unrelated\n')
+  write_alarms(str(tmp_path / 'out.yaml'), alarms, max_alarms=4)
+  with open(str(tmp_path / 'out.shards'), 'r') as index_handler:
+    assert len(json.load(index_handler)) > 2
+  write_alarms(str(tmp_path / 'out.yaml'), alarms[:5], max_alarms=4)
+  assert get_names(tmp_path) == ['out-002.yaml', 'out-prod.yaml', 'out.shards', 'out.yaml']
+  # An unsplit run removes the index and the shards it listed.
+  write_alarms(str(tmp_path / 'out.yaml'), alarms)
+  assert get_names(tmp_path) == ['out-prod.yaml', 'out.yaml']
+
+def test_index_cannot_point_outside_the_output_dir(tmp_path, alarms):
+  output_dir = tmp_path / 'output'
+  output_dir.mkdir()
+  (tmp_path / 'keep.yaml').write_text('keep\n')
+  (output_dir / 'out.shards').write_text(json.dumps(['../keep.yaml', 'out-009.yaml']))
+  (output_dir / 'out-009.yaml').write_text('stale\n')
+  write_alarms(str(output_dir / 'out.yaml'), alarms, max_alarms=100)
+  assert (tmp_path / 'keep.yaml').exists()
+  assert get_names(output_dir) == ['out.shards', 'out.yaml']
+
+def test_abort_keeps_the_previous_files(tmp_path, alarms):
+  output_file = str(tmp_path / 'out.yaml')
+  output_files = write_alarms(output_file, alarms, max_alarms=4)
+  previous_alarms = load_alarms(output_files)
+  with pytest.raises(RuntimeError):
+    with ShardedAlarmWriter(output_file, max_alarms=2) as sharded_writer:
+      for alarm_data in alarms[:5]:
+        sharded_writer.write(alarm_data)
+      raise RuntimeError('render failed')
+  assert load_alarms(output_files) == previous_alarms
+  assert not any(name.endswith('.tmp') for name in get_names(tmp_path))
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import pytest
+
+import asyncdiscovery
+from asyncdiscovery import AdaptiveLimiter, AsyncDiscoveryEngine, ThrottledCaller, TokenBucket
+from fakeaws import FakeFleet, FakeSession, FakeThrottlingError
+
+# The clients of the stand-in take no botocore Config.
+class StandInSettings:
+  def get_config(self):
+    return(None)
+
+class StandInCaller(ThrottledCaller):
+  def get_client_settings(self):
+    return(StandInSettings())
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+  monkeypatch.setattr(asyncdiscovery, 'CONST_BACKOFF_BASE', 0.0)
+
+def test_token_bucket_halves_on_throttle_and_ramps_up_on_success():
+  bucket = TokenBucket(10, 10)
+  bucket.on_throttle()
+  assert bucket.rate == 5
+  assert bucket.tokens <= 0
+  for ii in range(20):
+    bucket.on_throttle()
+  assert bucket.rate == 10 / 64
+  bucket.rate = 9.95
+  bucket.on_success()
+  assert bucket.rate == 10
+
+def test_token_bucket_waits_for_a_token():
+  bucket = TokenBucket(20, 1)
+
+  async def acquire_twice():
+    await bucket.acquire()
+    start = time.monotonic()
+    await bucket.acquire()
+    return(time.monotonic() - start)
+
+  assert asyncio.run(acquire_twice()) >= 0.04
+
+def test_adaptive_limiter_backs_off_multiplicatively_and_grows_additively():
+  limiter = AdaptiveLimiter(8)
+  limiter.on_throttle()
+  assert limiter.limit == 4
+  for ii in range(10):
+    limiter.on_throttle()
+  assert limiter.limit == 1
+  limiter.on_success()
+  assert limiter.limit == 2
+  limiter.on_success()
+  assert limiter.limit == 2.5
+
+def test_adaptive_limiter_caps_in_flight_calls():
+  limiter = AdaptiveLimiter(8)
+  limiter.limit = 2.0
+  in_flight = []
+
+  async def call():
+    async with limiter:
+      in_flight.append(limiter.in_flight)
+      await asyncio.sleep(0.01)
+
+  async def run_calls():
+    await asyncio.gather(*[call() for ii in range(6)])
+
+  asyncio.run(run_calls())
+  assert max(in_flight) == 2
+  assert limiter.in_flight == 0
+
+def test_throttled_caller_retries_throttles_and_backs_off():
+  outcomes = [FakeThrottlingError('ec2.DescribeTags'), FakeThrottlingError('ec2.DescribeTags'), {'Tags': []}]
+
+  def operation():
+    outcome = outcomes.pop(0)
+    if isinstance(outcome, Exception):
+      raise outcome
+    return(outcome)
+
+  caller = ThrottledCaller(max_concurrency=4)
+  assert asyncio.run(caller.call('ec2.DescribeTags', operation)) == {'Tags': []}
+  bucket, limiter, stats = caller.get_api_state('ec2.DescribeTags')
+  assert (stats.calls, stats.retries, stats.throttles) == (3, 2, 2)
+  assert bucket.rate < bucket.max_rate
+  assert limiter.limit < 4
+
+def test_throttled_caller_gives_up_after_max_attempts():
+  def operation():
+    raise FakeThrottlingError('cloudwatch.ListMetrics')
+
+  caller = ThrottledCaller(max_attempts=3)
+  with pytest.raises(FakeThrottlingError):
+    asyncio.run(caller.call('cloudwatch.ListMetrics', operation))
+  assert caller.stats['cloudwatch.ListMetrics'].calls == 3
+
+def test_throttled_caller_does_not_retry_other_errors():
+  def operation():
+    raise KeyError('InstanceId')
+
+  caller = ThrottledCaller()
+  with pytest.raises(KeyError):
+    asyncio.run(caller.call('cloudwatch.ListMetrics', operation))
+  assert caller.stats['cloudwatch.ListMetrics'].calls == 1
+
+def test_failed_tag_batch_fails_only_its_instances():
+  fleet = FakeFleet(450, 1)
+  # The stand-in does not throttle, the published rates would only slow the test down.
+  caller = StandInCaller(api_rates={'ec2.DescribeTags': (10000.0, 10000), 'cloudwatch.ListMetrics': (10000.0, 10000)})
+  engine = AsyncDiscoveryEngine('InstanceId', ['CPUUtilization'], [], ['AWS/EC2'], FakeSession(fleet), caller)
+  describe_tags = engine.ec2_client.describe_tags
+  failing_value = fleet.instance_ids[250]
+
+  def failing_describe_tags(**kwargs):
+    if failing_value in kwargs['Filters'][1]['Values']:
+      raise RuntimeError('connection reset')
+    return(describe_tags(**kwargs))
+
+  engine.ec2_client.describe_tags = failing_describe_tags
+  results, errors = asyncio.run(engine.discover(fleet.instance_ids))
+  assert sorted(errors) == fleet.instance_ids[200:400]
+  assert sorted(results) == fleet.instance_ids[:200] + fleet.instance_ids[400:]
+  tag_name, metrics = results[fleet.instance_ids[0]]
+  assert tag_name == "bench-{0}".format(fleet.instance_ids[0])
+  assert [metric_record.metric_name for metric_record in metrics] == ['CPUUtilization']
@@ -0,0 +1,46 @@
+import os
+
+from configgenerator import CONST_LOGICAL_ID_PREFIX, get_alarm_logical_id
+from cwalarmlinux import LinuxConfigGenerator
+from fakeaws import FakeFleet, FakeSession
+from metricrecord import MetricRecord
+
+def get_disk_metric(path, device='xvda1', dimension_order=None):
+  dimensions = {'InstanceId': 'i-0123', 'path': path, 'device': device, 'fstype': 'xfs'}
+  dimension_names = dimension_order or list(dimensions)
+  return(MetricRecord('CWAgent', 'disk_used_percent', dimension_names,
+          [dimensions[dimension_name] for dimension_name in dimension_names]))
+
+def test_logical_id_is_alphanumeric_and_stable():
+  logical_id = get_alarm_logical_id('CWAgent', get_disk_metric('/'), 'warning')
+  assert logical_id.startswith(CONST_LOGICAL_ID_PREFIX)
+  assert logical_id.isalnum()
+  assert logical_id == get_alarm_logical_id('CWAgent', get_disk_metric('/'), 'warning')
+
+def test_logical_id_ignores_dimension_order():
+  reordered_metric = get_disk_metric('/', dimension_order=['fstype', 'path', 'InstanceId', 'device'])
+  assert get_alarm_logical_id('CWAgent', reordered_metric, 'warning') == \
+    get_alarm_logical_id('CWAgent', get_disk_metric('/'), 'warning')
+
+def test_logical_id_differs_per_identity():
+  logical_ids = {
+    get_alarm_logical_id('CWAgent', get_disk_metric('/'), 'warning'),
+    get_alarm_logical_id('CWAgent', get_disk_metric('/'), 'critical'),
+    get_alarm_logical_id('CWAgent', get_disk_metric('/data'), 'warning'),
+    get_alarm_logical_id('CWAgent', get_disk_metric('/', device='xvdb'), 'warning'),
+    get_alarm_logical_id('AWS/EC2', get_disk_metric('/'), 'warning'),
+  }
+  assert len(logical_ids) == 5
+
+def test_alarm_names_do_not_depend_on_metric_order():
+  fleet = FakeFleet(1, 12)
+  session = FakeSession(fleet)
+  config_generator = LinuxConfigGenerator('InstanceId', fleet.instance_ids[0], os.devnull,
+                      'arn:warning', 'arn:warning', '', '', 'false', 'test', '', session=session)
+  metrics = list(config_generator.get_metrics())
+  alarms = config_generator.get_alarm_list(metrics)
+  reversed_alarms = config_generator.get_alarm_list(metrics[::-1])
+  assert len(alarms) > 0
+  assert sorted(alarm['name'] for alarm in alarms) == sorted(alarm['name'] for alarm in reversed_alarms)
+  # A metric listed twice renders its alarms once.
+  assert len(config_generator.get_alarm_list(metrics + metrics)) == len(alarms)
@@ -0,0 +1,93 @@
+import pytest
+import yaml
+
+from manifestcompiler import CompiledManifest, deep_merge
+
+CONST_DEFAULTS = {
+  'cpu_utilization': {'enabled': True, 'warning_threshold': 80, 'critical_threshold': 95},
+  'memory_used_percent': {'enabled': True, 'warning_threshold': 85, 'critical_threshold': 95},
+}
+
+def write_manifest(tmp_path, name, manifest_vars):
+  manifest_file = tmp_path / name
+  manifest_file.write_text(yaml.safe_dump(manifest_vars))
+  return(str(manifest_file))
+
+def get_attributes(platform='linux', instance_type='t3.micro', **tags):
+  return({'platform': platform, 'instance_type': instance_type, 'tags': tags})
+
+def test_deep_merge_keeps_unset_keys():
+  merged = deep_merge(CONST_DEFAULTS, {'cpu_utilization': {'warning_threshold': 70}})
+  assert merged['cpu_utilization'] == {'enabled': True, 'warning_threshold': 70, 'critical_threshold': 95}
+  assert merged['memory_used_percent'] == CONST_DEFAULTS['memory_used_percent']
+  # The inputs are not modified.
+  assert CONST_DEFAULTS['cpu_utilization']['warning_threshold'] == 80
+
+def test_layers_override_in_order(tmp_path):
+  manifest = CompiledManifest([
+    write_manifest(tmp_path, 'base.yaml', {'cpu_utilization': {'warning_threshold': 70, 'critical_threshold': 90}}),
+    write_manifest(tmp_path, 'team.yaml', {'cpu_utilization': {'warning_threshold': 60}}),
+  ])
+  alert_config = manifest.get_alert_config(CONST_DEFAULTS, get_attributes())
+  assert alert_config['cpu_utilization'] == {'enabled': True, 'warning_threshold': 60, 'critical_threshold': 90}
+
+def test_selectors_match_every_criterion(tmp_path):
+  manifest = CompiledManifest(write_manifest(tmp_path, 'manifest.yaml', {'selectors': [
+    {'match': {'tags': {'Environment': 'prod'}},
+     'config': {'cpu_utilization': {'warning_threshold': 50}}},
+    {'match': {'instance_type': ['t3.micro', 't3.small'], 'tags': {'Environment': 'prod'}},
+     'config': {'cpu_utilization': {'critical_threshold': 60}}},
+    {'match': {'platform': 'windows'},
+     'config': {'memory_used_percent': {'enabled': False}}},
+  ]}))
+  assert manifest.get_matches(get_attributes(Environment='prod')) == (0, 1)
+  assert manifest.get_matches(get_attributes(instance_type='m5.large', Environment='prod')) == (0,)
+  assert manifest.get_matches(get_attributes(Environment='dev')) == ()
+  assert manifest.get_matches(get_attributes(platform='windows', instance_type='t3.small')) == (2,)
+  alert_config = manifest.get_alert_config(CONST_DEFAULTS, get_attributes(Environment='prod'))
+  assert alert_config['cpu_utilization'] == {'enabled': True, 'warning_threshold': 50, 'critical_threshold': 60}
+  assert manifest.needs_instances()
+
+def test_later_selectors_win_across_layers(tmp_path):
+  manifest = CompiledManifest([
+    write_manifest(tmp_path, 'base.yaml', {'selectors': [
+      {'match': {'tags': {'Environment': 'prod'}}, 'config': {'cpu_utilization': {'warning_threshold': 50}}}]}),
+    write_manifest(tmp_path, 'team.yaml', {'selectors': [
+      {'match': {'tags': {'Team': 'web'}}, 'config': {'cpu_utilization': {'warning_threshold': 40}}}]}),
+  ])
+  alert_config = manifest.get_alert_config(CONST_DEFAULTS, get_attributes(Environment='prod', Team='web'))
+  assert alert_config['cpu_utilization']['warning_threshold'] == 40
+
+def test_duplicate_values_count_once(tmp_path):
+  manifest = CompiledManifest(write_manifest(tmp_path, 'manifest.yaml', {'selectors': [
+    {'match': {'instance_type': ['t3.micro', 't3.micro'], 'tags': {'Environment': 'prod'}},
+     'config': {'cpu_utilization': {'warning_threshold': 50}}},
+  ]}))
+  assert manifest.get_matches(get_attributes(instance_type='t3.micro')) == ()
+  assert manifest.get_matches(get_attributes(instance_type='t3.micro', Environment='prod')) == (0,)
+
+def test_selector_without_criteria_matches_everything(tmp_path):
+  manifest = CompiledManifest(write_manifest(tmp_path, 'manifest.yaml', {'selectors': [
+    {'config': {'cpu_utilization': {'warning_threshold': 50}}},
+    {'match': {'platform': 'linux'}, 'config': {'cpu_utilization': {'warning_threshold': 55}}},
+  ]}))
+  assert manifest.get_matches(get_attributes(platform='windows')) == (0,)
+  assert manifest.get_matches(get_attributes()) == (0, 1)
+  assert not manifest.needs_instances()
+
+def test_resolved_config_is_cached_per_match(tmp_path):
+  manifest = CompiledManifest(write_manifest(tmp_path, 'manifest.yaml', {'selectors': [
+    {'match': {'tags': {'Environment': 'prod'}}, 'config': {'cpu_utilization': {'warning_threshold': 50}}}]}))
+  first_config = manifest.get_alert_config(CONST_DEFAULTS, get_attributes(Environment='prod', Name='a'))
+  second_config = manifest.get_alert_config(CONST_DEFAULTS, get_attributes(Environment='prod', Name='b'))
+  assert first_config is second_config
+
+@pytest.mark.parametrize('manifest_vars, message', [
+  ({'selectors': [{'match': {'region': 'x'}}]}, 'cannot match on'),
+  ({'selectors': [{'config': {'cpu_utilization': {'warning_threshold': 'high'}}}]}, 'must be a number'),
+  ({'cpu_utilization': {'enabled': 'yes'}}, 'must be True or False'),
+  ({'selectors': {'match': {}}}, 'must be a list'),
+])
+def test_invalid_manifests_are_rejected(tmp_path, manifest_vars, message):
+  with pytest.raises(ValueError, match=message):
+    CompiledManifest(write_manifest(tmp_path, 'manifest.yaml', manifest_vars))
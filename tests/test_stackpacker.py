@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from cfntemplate import CONST_FORMAT_CFN_JSON, CONST_FORMAT_CFN_YAML, CONST_FORMAT_SCEPTRE
+from cwalarmlinux import LinuxConfigGenerator
+from fakeaws import FakeFleet, FakeSession
+from stackpacker import CONST_TEMPLATE_OVERHEAD_BYTES, StackPacker, load_instance_alarms
+
+# The sizes StackPacker packs by, without rendering any alarms.
+class SizedInstance:
+  def __init__(self, value, resource_count, template_bytes=0) -> None:
+      self.value = value
+      self.resource_count = resource_count
+      self.template_bytes = template_bytes
+
+def get_stack_values(stacks):
+  return({stack.name: sorted(instance.value for instance in stack.instances) for stack in stacks.values()})
+
+def test_first_fit_decreasing():
+  instances = [SizedInstance(value, count, count * 100) for value, count in [('a', 2), ('b', 6), ('c', 3), ('d', 5), ('e', 4)]]
+  stack_packer = StackPacker(max_resources=10)
+  assert get_stack_values(stack_packer.pack(instances)) == {'stack-000': ['b', 'e'], 'stack-001': ['a', 'c', 'd']}
+  assert stack_packer.unplaced == []
+
+def test_previous_assignments_are_kept():
+  instances = [SizedInstance('a', 2), SizedInstance('b', 2), SizedInstance('c', 2)]
+  stack_packer = StackPacker(max_resources=10, previous_assignments={'b': 'stack-001'})
+  stacks = stack_packer.pack(instances)
+  # The new instances fill the existing stack instead of taking the free stack-000.
+  assert get_stack_values(stacks) == {'stack-001': ['a', 'b', 'c']}
+  assert stack_packer.get_assignments() == {'a': 'stack-001', 'b': 'stack-001', 'c': 'stack-001'}
+
+def test_new_stack_skips_previously_assigned_names():
+  instances = [SizedInstance('a', 8), SizedInstance('b', 8)]
+  stack_packer = StackPacker(max_resources=10, previous_assignments={'a': 'stack-000', 'gone': 'stack-001'})
+  assert get_stack_values(stack_packer.pack(instances)) == {'stack-000': ['a'], 'stack-002': ['b']}
+
+def test_instances_that_outgrew_their_stack_are_evicted_in_instance_order():
+  instances = [SizedInstance('a', 4), SizedInstance('b', 4), SizedInstance('c', 4)]
+  previous_assignments = {'a': 'stack-000', 'b': 'stack-000', 'c': 'stack-000'}
+  stack_packer = StackPacker(max_resources=10, previous_assignments=previous_assignments)
+  assert get_stack_values(stack_packer.pack(instances)) == {'stack-000': ['a', 'b'], 'stack-001': ['c']}
+
+def test_instances_too_large_for_any_stack_are_unplaced():
+  instances = [SizedInstance('a', 11), SizedInstance('b', 1, 2000), SizedInstance('c', 1, 100)]
+  stack_packer = StackPacker(max_resources=10, max_template_bytes=CONST_TEMPLATE_OVERHEAD_BYTES + 1000)
+  assert get_stack_values(stack_packer.pack(instances)) == {'stack-000': ['c']}
+  assert sorted(instance.value for instance in stack_packer.unplaced) == ['a', 'b']
+
+def write_fleet_output(output_dir, output_format, instance_count=2):
+  fleet = FakeFleet(instance_count, 6)
+  session = FakeSession(fleet)
+  extension = 'json' if output_format == CONST_FORMAT_CFN_JSON else 'yaml'
+  for instance_id in fleet.instance_ids:
+    config_generator = LinuxConfigGenerator('InstanceId', instance_id,
+                          os.path.join(output_dir, "{0}.{1}".format(instance_id, extension)),
+                          'arn:warning', 'arn:warning', '', '', 'false', 'test', '',
+                          session=session, output_format=output_format)
+    config_generator.generate_yaml(config_generator.get_metrics())
+  return(fleet.instance_ids)
+
+def test_load_instance_alarms_of_sceptre_output(tmp_path):
+  instance_ids = write_fleet_output(str(tmp_path), CONST_FORMAT_SCEPTRE)
+  instances = load_instance_alarms(str(tmp_path), CONST_FORMAT_CFN_YAML)
+  assert [instance.value for instance in instances] == instance_ids
+  assert all(instance.resource_count > 0 for instance in instances)
+
+@pytest.mark.parametrize('output_format', [CONST_FORMAT_CFN_YAML, CONST_FORMAT_CFN_JSON])
+def test_load_instance_alarms_rejects_templates(tmp_path, output_format):
+  write_fleet_output(str(tmp_path), output_format)
+  with pytest.raises(ValueError, match='generate the fleet with -f sceptre'):
+    load_instance_alarms(str(tmp_path), CONST_FORMAT_CFN_YAML)